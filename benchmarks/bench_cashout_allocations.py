@@ -0,0 +1,88 @@
+"""
+Allocation benchmark of the Cashout construction and solve path, per market.
+
+Run from the repository root:
+    python -m benchmarks.bench_cashout_allocations --markets 200 --selections 3 --levels 3
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+import tracemalloc
+import numpy as np
+from src.utils import Order
+from src.exchanges.exchange import BookNormalized
+from src.utils_cashout import Cashout
+
+
+def make_market(rng : np.random.Generator, market_id : str, selections_qty : int, levels_qty : int, orders_qty : int):
+    fair_prob = rng.dirichlet(np.ones(selections_qty))
+    back_prices = np.maximum(1.01, 1 / (fair_prob * 1.02))
+    lay_prices = np.maximum(back_prices + 0.01, 1 / (fair_prob * 0.98))
+    data = np.empty((4, levels_qty, selections_qty))
+    for level in range(levels_qty):
+        data[0, level] = np.round(back_prices - 0.02 * level, 2)
+        data[2, level] = np.round(lay_prices + 0.02 * level, 2)
+    data[[1, 3]] = rng.uniform(10, 500, (2, levels_qty, selections_qty))
+    selection_ids = list(range(1000, 1000 + selections_qty))
+    book = BookNormalized.from_array(market_id=market_id, data=data, selection_ids=selection_ids)
+
+    matched_orders = {}
+    for _ in range(orders_qty):
+        selection_id = int(rng.choice(selection_ids))
+        side = "BACK" if rng.random() < 0.5 else "LAY"
+        order = Order(market_id, selection_id, float(np.round(rng.uniform(1.5, 10), 2)), 0, float(np.round(rng.uniform(1, 50), 2)), side)
+        matched_orders.setdefault(selection_id, {"BACK": [], "LAY": []})[side].append(order)
+    return book, matched_orders
+
+
+def run(markets_qty : int, selections_qty : int, levels_qty : int, orders_qty : int, constrain_by_volume : bool, seed : int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    markets = [make_market(rng, f"1.{i}", selections_qty, levels_qty, orders_qty) for i in range(markets_qty)]
+
+    # Warm up the problem template cache so that compilation is not measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        for book, matched_orders in markets[:2]:
+            Cashout(book, matched_orders, {}, "taker", constrain_by_volume, 1)._get_neutralizer_orders(max_std_allowed=1)
+
+    orders_emitted = 0
+    peaks, retained, elapsed = [], [], 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        for book, matched_orders in markets:
+            current_before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            cashout_output = Cashout(book, matched_orders, {}, "taker", constrain_by_volume, 1)._get_neutralizer_orders(max_std_allowed=1)
+            elapsed += time.perf_counter() - start
+            orders_emitted += len(cashout_output.orders)
+            del cashout_output
+            current_after, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - current_before)
+            retained.append(current_after - current_before)
+        tracemalloc.stop()
+
+    return {
+        "markets": markets_qty,
+        "selections": selections_qty,
+        "levels": levels_qty,
+        "matched_orders_per_market": orders_qty,
+        "constrain_by_volume": constrain_by_volume,
+        "seconds_per_market": elapsed / markets_qty,
+        "peak_bytes_per_market": float(np.mean(peaks)),
+        "retained_bytes_per_market": float(np.mean(retained)),
+        "orders_emitted_per_market": orders_emitted / markets_qty,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--markets", type=int, default=200)
+    parser.add_argument("--selections", type=int, default=3)
+    parser.add_argument("--levels", type=int, default=3)
+    parser.add_argument("--orders", type=int, default=50, help="matched orders per market")
+    parser.add_argument("--constrain-by-volume", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.markets, args.selections, args.levels, args.orders, args.constrain_by_volume, args.seed), indent=2))
@@ -0,0 +1,201 @@
+"""
+Per-stage timings and peak memory of the dashboard refresh pipeline, on seeded synthetic markets and orders (benchmarks.synthetic)
+served by the fake exchange.
+
+Every scenario of --levels x --orders runs the stages of a refresh one by one: get_current_orders, get_selection_stats, get_markets,
+normalize_book, get_pnl_outcomes (all markets), Cashout._get_neutralizer_orders (the first --cashout-markets markets with matched orders)
+and compute_snapshot, the whole refresh. Each stage is reported with the seconds of its first (cold) call, the best seconds of --repeat calls,
+the seconds per order or per market, and the peak bytes allocated during one more call (tracemalloc).
+
+The report also records the commit, the versions and the seconds of a fixed calibration workload. With --baseline, it is compared
+with a report of another commit: a stage regresses when its best seconds, scaled by the ratio of the calibration seconds of both machines,
+exceed the baseline by more than --threshold and by more than --min-seconds. The regressions are listed in the report and
+the exit status is 1 when there is any.
+
+Run from the repository root:
+    python -m benchmarks.bench_refresh_pipeline --orders 100 10000 100000 1000000 --output refresh.json  # a few minutes per 1M orders scenario
+    python -m benchmarks.bench_refresh_pipeline --baseline refresh.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import make_fake_exchange, RUNNERS_RANGE
+from src.utils import get_pnl_outcomes, split_matched_and_open
+from src.utils_cashout import Cashout
+from src.website_refresher import compute_snapshot
+from src.website_utils import get_selection_stats, CASHOUT_MODE, CASHOUT_MAX_STD_ALLOWED, CASHOUT_CONSTRAIN_BY_VOLUME
+
+STAGES = ("get_current_orders", "get_selection_stats", "get_markets", "normalize_book", "get_pnl_outcomes", "get_neutralizer_orders", "compute_snapshot")
+DEFAULT_THRESHOLD = 0.25  # Relative slowdown over the baseline counted as a regression
+DEFAULT_MIN_SECONDS = 0.002  # Absolute slowdown below which a stage is never counted as a regression (timer noise)
+
+
+def calibrate(repeat : int = 5) -> float:
+    """
+    Best seconds of a fixed workload mixing Python loops and numpy, to compare timings taken on different machines
+    """
+    rng = np.random.default_rng(0)
+    values = rng.random(200_000)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sum(value * 2 for value in values[:50_000].tolist())
+        np.sort(values)
+        {i: str(i) for i in range(50_000)}
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure(function, repeat : int, units : int) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        function()
+        cold = time.perf_counter() - start
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"cold_seconds": cold, "seconds": best, "units": units, "seconds_per_unit": best / units if units else None, "peak_bytes": peak}
+
+
+def solve_neutralizer_orders(books : list, matched_orders : dict, open_orders : dict, engine : str) -> int:
+    """
+    Solves the cashout of each book and returns the number of markets for which the solver failed
+    """
+    failures = 0
+    for book in books:
+        cashout = Cashout(book, matched_orders[book.market_id], open_orders.get(book.market_id, {}), CASHOUT_MODE,
+                          constrain_by_volume=CASHOUT_CONSTRAIN_BY_VOLUME, max_std_allowed=CASHOUT_MAX_STD_ALLOWED, engine=engine)
+        try:
+            cashout._get_neutralizer_orders(max_std_allowed=CASHOUT_MAX_STD_ALLOWED)
+        except Exception:
+            failures += 1
+    return failures
+
+
+def run_scenario(markets_qty : int, orders_qty : int, levels : int, runners_range : tuple, repeat : int, cashout_markets : int,
+                 engine : str, seed : int) -> dict:
+    trading = make_fake_exchange(markets_qty, orders_qty, runners_range=runners_range, levels=levels, seed=seed)
+    market_ids = list(trading.trading.betting.catalogue)
+    stages = {}
+
+    stages["get_current_orders"] = measure(trading.get_current_orders, repeat, orders_qty)
+    orders = trading.get_current_orders()
+    orders_df = orders.to_dataframe()
+    matched_orders, open_orders = split_matched_and_open(orders)
+
+    stages["get_selection_stats"] = measure(lambda: get_selection_stats(orders_df), repeat, orders_qty)
+
+    get_markets = lambda: trading.get_markets(event_type_ids=None, market_type_codes=None, min_volume=0, market_ids=market_ids)
+    stages["get_markets"] = measure(get_markets, repeat, markets_qty)
+    markets = get_markets()
+
+    stages["normalize_book"] = measure(lambda: [trading.normalize_book(market, orderbook_levels=levels) for market in markets], repeat, markets_qty)
+    books = [trading.normalize_book(market, orderbook_levels=levels) for market in markets]
+
+    stages["get_pnl_outcomes"] = measure(lambda: [get_pnl_outcomes(Cashout.fill_missing_selections(matched_orders.get(book.market_id, {}), book.selection_ids),
+                                                                    book.selection_ids) for book in books], repeat, markets_qty)
+
+    cashout_books = [book for book in books if book.market_id in matched_orders][:cashout_markets]
+    stages["get_neutralizer_orders"] = measure(lambda: solve_neutralizer_orders(cashout_books, matched_orders, open_orders, engine), repeat, len(cashout_books))
+    with contextlib.redirect_stdout(io.StringIO()):
+        stages["get_neutralizer_orders"]["failures"] = solve_neutralizer_orders(cashout_books, matched_orders, open_orders, engine)
+
+    stages["compute_snapshot"] = measure(lambda: compute_snapshot(trading), repeat, markets_qty)
+    return {
+        "name": f"markets={markets_qty},runners={runners_range[0]}-{runners_range[1]},levels={levels},orders={orders_qty}",
+        "markets": markets_qty,
+        "runners_range": list(runners_range),
+        "levels": levels,
+        "orders": orders_qty,
+        "stages": stages,
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report : dict, baseline : dict, threshold : float = DEFAULT_THRESHOLD, min_seconds : float = DEFAULT_MIN_SECONDS) -> list:
+    """
+    The compare function returns the stages of report slower than the same stages of baseline, after scaling the baseline
+    by the calibration seconds of both reports
+    """
+    scale = report["calibration_seconds"] / baseline["calibration_seconds"]
+    baseline_stages = {(scenario["name"], stage): result["seconds"]
+                       for scenario in baseline["scenarios"] for stage, result in scenario["stages"].items()}
+    regressions = []
+    for scenario in report["scenarios"]:
+        for stage, result in scenario["stages"].items():
+            baseline_seconds = baseline_stages.get((scenario["name"], stage))
+            if baseline_seconds is None:
+                continue
+            expected = baseline_seconds * scale
+            if result["seconds"] > expected * (1 + threshold) and result["seconds"] - expected > min_seconds:
+                regressions.append({"scenario": scenario["name"], "stage": stage, "seconds": result["seconds"],
+                                    "baseline_seconds": expected, "ratio": result["seconds"] / expected})
+    return regressions
+
+
+def run(markets_qty : int, orders : list, levels : list, runners_range : tuple = RUNNERS_RANGE, repeat : int = 3, cashout_markets : int = 50,
+        engine : str = "numpy", seed : int = 0) -> dict:
+    scenarios = [run_scenario(markets_qty, orders_qty, levels_qty, runners_range, repeat, cashout_markets, engine, seed)
+                 for levels_qty in levels for orders_qty in orders]
+    return {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "seed": seed,
+        "engine": engine,
+        "repeat": repeat,
+        "calibration_seconds": calibrate(),
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "scenarios": scenarios,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--markets", type=int, default=100)
+    parser.add_argument("--runners", type=int, nargs=2, default=list(RUNNERS_RANGE), metavar=("MIN", "MAX"), help="runners per market")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 3, 10], help="book levels per side")
+    parser.add_argument("--orders", type=int, nargs="+", default=[100, 10_000, 100_000], help="current orders of the account")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cashout-markets", type=int, default=50, help="markets solved by the get_neutralizer_orders stage")
+    parser.add_argument("--engine", choices=["numpy", "cvxpy"], default="numpy")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--baseline", help="report of another commit to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--min-seconds", type=float, default=DEFAULT_MIN_SECONDS)
+    args = parser.parse_args()
+
+    report = run(args.markets, args.orders, args.levels, tuple(args.runners), args.repeat, args.cashout_markets, args.engine, args.seed)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.threshold, args.min_seconds)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if report.get("regressions"):
+        sys.exit(1)
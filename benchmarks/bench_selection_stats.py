@@ -0,0 +1,92 @@
+"""
+Benchmark of website_utils.get_selection_stats on a synthetic frame of current orders,
+against the previous groupby.apply + pivot_table implementation.
+
+Run from the repository root:
+    python -m benchmarks.bench_selection_stats --orders 100000 --markets 2000
+"""
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from src.website_utils import get_selection_stats
+
+
+def make_orders_df(rng : np.random.Generator, orders_qty : int, markets_qty : int, selections_qty : int) -> pd.DataFrame:
+    size_matched = np.round(rng.uniform(1, 50, orders_qty), 2)
+    size_matched[rng.random(orders_qty) < 0.3] = 0
+    return pd.DataFrame({
+        "market_id": np.array([f"1.{i}" for i in range(markets_qty)], dtype=object)[rng.integers(markets_qty, size=orders_qty)],
+        "runner_id": rng.integers(1000, 1000 + selections_qty, size=orders_qty),
+        "price": np.round(rng.uniform(1.01, 20, orders_qty), 2),
+        "size_remaining": np.round(rng.uniform(0, 10, orders_qty), 2),
+        "size_matched": size_matched,
+        "side": np.where(rng.random(orders_qty) < 0.5, "BACK", "LAY").astype(object),
+        "bet_id": np.arange(orders_qty).astype(str).astype(object),
+    })
+
+
+def get_selection_stats_reference(orders_df) -> pd.DataFrame:
+    """
+    Previous implementation, followed by the MultiIndex unpacking that app.py used to do
+    """
+    matched_orders_df = orders_df[orders_df["size_matched"] != 0]
+    size_matched = matched_orders_df.groupby(["market_id", "runner_id", "side"])["size_matched"].sum().rename("size_matched").to_frame()
+    size_matched = size_matched.reset_index(level = 2)
+    size_matched = size_matched.pivot_table(index = size_matched.index, columns = "side", values = "size_matched")
+    size_matched.columns = size_matched.columns + "_SIZE_MATCHED"
+
+    avg_matched_price = matched_orders_df.groupby(["market_id", "runner_id", "side"]).apply(lambda g: np.average(g['price'], weights=g['size_matched']))
+    avg_matched_price = avg_matched_price.rename("avg_price").to_frame()
+    avg_matched_price = avg_matched_price.reset_index(level = 2)
+    avg_matched_price = avg_matched_price.pivot_table(index = avg_matched_price.index, columns = "side", values = "avg_price")
+    avg_matched_price.columns = avg_matched_price.columns + "_AVG_PRICE"
+    selection_stats = pd.concat([avg_matched_price, size_matched], axis = 1)
+
+    market_id = pd.Series(selection_stats.index).apply(lambda x: x[0])
+    selection_id = pd.Series(selection_stats.index).apply(lambda x: x[1])
+    selection_stats.reset_index(inplace= True, drop = True)
+    selection_stats['market_id'] = market_id
+    selection_stats['selection_id'] = selection_id
+    return selection_stats
+
+
+def best_of(function, orders_df, repeat : int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(orders_df)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(orders_qty : int, markets_qty : int, selections_qty : int, repeat : int, seed : int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    orders_df = make_orders_df(rng, orders_qty, markets_qty, selections_qty)
+
+    selection_stats = get_selection_stats(orders_df)
+    reference = get_selection_stats_reference(orders_df)
+    max_abs_diff = float(np.nanmax(np.abs(selection_stats[reference.columns[:-2]].to_numpy(dtype=float) -
+                                          reference[reference.columns[:-2]].to_numpy(dtype=float))))
+
+    return {
+        "orders": orders_qty,
+        "markets": markets_qty,
+        "selections": selections_qty,
+        "rows": len(selection_stats),
+        "seconds_vectorized": best_of(get_selection_stats, orders_df, repeat),
+        "seconds_reference": best_of(get_selection_stats_reference, orders_df, repeat),
+        "max_abs_diff": max_abs_diff,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--markets", type=int, default=2000)
+    parser.add_argument("--selections", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.orders, args.markets, args.selections, args.repeat, args.seed), indent=2))
@@ -0,0 +1,159 @@
+"""
+Load test of the betting calls and of the cashout loop against the in-process simulated exchange (exchanges.simulated).
+
+The first stage places limit orders through Betfair.execute at increasing target rates, each for --duration seconds, and cancels
+the ones of the previous batch that are still open. It reports the orders placed and the instructions sent per second, the request latencies
+and the error codes of each rate, and the first rate that could not be sustained (below 90% of the target, or requests rejected).
+The second stage runs --cashout-rounds rounds of the cashout loop (current orders, books, Cashout.solve_many, reconcile, execute)
+and reports the seconds of each step.
+
+Run from the repository root:
+    python -m benchmarks.bench_simulated_exchange --rates 500 1000 2000 5000 --latency 0.01
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+import numpy as np
+from src.exchanges.fake import FAKE_EVENT_TYPE_ID, FAKE_MARKET_TYPES
+from src.exchanges.simulated import SimulatedBetfair
+from src.exchanges.ticks import TICK_PRICES, TICKS_QTY, price_to_tick
+from src.utils import Order, split_matched_and_open
+from src.utils_cashout import Cashout
+from src.website_utils import CASHOUT_MODE, CASHOUT_MAX_STD_ALLOWED
+
+BATCH_INTERVAL = 0.05  # Seconds between two batches of orders
+
+
+def make_orders(rng : np.random.Generator, books : list, orders_qty : int) -> list:
+    """
+    Orders of 2 on random runners, from 2 ticks through the best price (matched right away) to 5 ticks away from it (resting)
+    """
+    orders = []
+    for book_number in rng.integers(len(books), size=orders_qty):
+        book = books[book_number]
+        selection_number = int(rng.integers(book.selections_qty))
+        side = "BACK" if rng.random() < 0.5 else "LAY"
+        best_price = book.back_prices[0][selection_number] if side == "BACK" else book.lay_prices[0][selection_number]
+        if np.isnan(best_price):
+            continue
+        offset = int(rng.integers(-2, 6))
+        tick = int(np.clip(price_to_tick(best_price) + (offset if side == "BACK" else -offset), 0, TICKS_QTY - 1))
+        orders.append(Order(market_id=book.market_id, runner_id=book.selection_ids[selection_number], price=float(TICK_PRICES[tick]),
+                            size_remaining=2, side=side))
+    return orders
+
+
+def run_rate(trading : SimulatedBetfair, rng : np.random.Generator, books : list, rate : float, duration : float) -> dict:
+    placed, sent, latencies, statuses, error_codes = 0, 0, [], {}, {}
+    previous_open = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        batch_start = time.perf_counter()
+        orders_to_place = make_orders(rng, books, max(1, int(rate * BATCH_INTERVAL)))
+        reports = trading.execute(previous_open, [], orders_to_place)
+        previous_open = []
+        for report in reports:
+            statuses[report.status] = statuses.get(report.status, 0) + 1
+            if report.error_code is not None:
+                error_codes[report.error_code] = error_codes.get(report.error_code, 0) + 1
+            if report.latency is not None:
+                latencies.append(report.latency)
+            if report.action == "PLACE" and report.status == "SUCCESS" and report.size_matched < report.order.size_remaining:
+                report.order.bet_id = report.bet_id
+                previous_open.append(report.order)
+        placed += len(orders_to_place)
+        sent += len(reports)
+        time.sleep(max(0.0, BATCH_INTERVAL - (time.perf_counter() - batch_start)))
+    elapsed = time.perf_counter() - start
+    return {
+        "target_orders_per_second": rate,
+        "orders_per_second": placed / elapsed,
+        "instructions_per_second": sent / elapsed,
+        "latency_p50": float(np.percentile(latencies, 50)) if latencies else None,
+        "latency_p99": float(np.percentile(latencies, 99)) if latencies else None,
+        "statuses": statuses,
+        "error_codes": error_codes,
+    }
+
+
+def run_cashout_loop(trading : SimulatedBetfair, rounds : int) -> list:
+    results = []
+    for _ in range(rounds):
+        timings = {}
+        start = time.perf_counter()
+        orders = trading.get_current_orders(incremental=True)
+        matched_orders, open_orders = split_matched_and_open(orders)
+        timings["get_current_orders"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        markets = trading.get_markets(event_type_ids=None, market_type_codes=FAKE_MARKET_TYPES, min_volume=0, market_ids=list(matched_orders))
+        books = [trading.normalize_book(market, orderbook_levels=1) for market in markets]
+        timings["get_markets"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cashout_outputs = Cashout.solve_many(books, matched_orders, open_orders, mode=CASHOUT_MODE, constrain_by_volume=False,
+                                                 max_std_allowed=CASHOUT_MAX_STD_ALLOWED, engine="numpy")
+        timings["solve"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        orders_to_cancel, orders_to_replace, orders_to_place = [], [], []
+        for book in books:
+            cashout_output = cashout_outputs[book.market_id]
+            if cashout_output is None or not cashout_output.orders:
+                continue
+            cashout = Cashout(book, matched_orders.get(book.market_id, {}), open_orders.get(book.market_id, {}), CASHOUT_MODE, False,
+                              CASHOUT_MAX_STD_ALLOWED)
+            for orders_list, instructions in zip((orders_to_cancel, orders_to_replace, orders_to_place), cashout.reconcile(cashout_output.orders)):
+                orders_list.extend(instructions)
+        timings["reconcile"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reports = trading.execute(orders_to_cancel, orders_to_replace, orders_to_place)
+        timings["execute"] = time.perf_counter() - start
+        results.append({"markets": len(books), "instructions": len(reports),
+                        "failed_instructions": sum(report.status != "SUCCESS" for report in reports), "seconds": timings})
+    return results
+
+
+def run(markets_qty : int, orders_qty : int, rates : list, duration : float, latency : float, instructions_per_second : float,
+        cashout_rounds : int, seed : int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    trading = SimulatedBetfair(markets_qty=markets_qty, orders_qty=orders_qty, seed=seed, latency=latency,
+                               instructions_per_second=instructions_per_second)
+    trading.login()
+    markets = trading.get_markets([FAKE_EVENT_TYPE_ID], FAKE_MARKET_TYPES, min_volume=0)
+    books = [trading.normalize_book(market, orderbook_levels=1) for market in markets]
+
+    rate_results = [run_rate(trading, rng, books, rate, duration) for rate in rates]
+    saturation = next((result["target_orders_per_second"] for result in rate_results
+                       if result["orders_per_second"] < 0.9 * result["target_orders_per_second"]
+                       or result["error_codes"].keys() - {"BET_TAKEN_OR_LAPSED"}), None)
+    return {
+        "markets": markets_qty,
+        "initial_orders": orders_qty,
+        "latency": latency,
+        "instructions_per_second_limit": instructions_per_second,
+        "rates": rate_results,
+        "saturation_rate": saturation,
+        "cashout_loop": run_cashout_loop(trading, cashout_rounds),
+        "requests": trading.trading.betting.requests,
+        "throttled_requests": trading.trading.betting.throttled,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--markets", type=int, default=50)
+    parser.add_argument("--orders", type=int, default=500, help="initial orders of the account")
+    parser.add_argument("--rates", type=float, nargs="+", default=[500, 1000, 2000, 5000], help="target orders placed per second")
+    parser.add_argument("--duration", type=float, default=2, help="seconds per rate")
+    parser.add_argument("--latency", type=float, default=0, help="seconds per request of the simulated exchange")
+    parser.add_argument("--instructions-per-second", type=float, default=None, help="instruction rate limit of the simulated exchange")
+    parser.add_argument("--cashout-rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.markets, args.orders, args.rates, args.duration, args.latency, args.instructions_per_second,
+                         args.cashout_rounds, args.seed), indent=2))
@@ -0,0 +1,67 @@
+"""
+Seeded synthetic markets and current orders for the benchmarks, served by the fake exchange (exchanges.fake),
+so that the whole refresh pipeline runs on them: the same seed always gives the same markets, prices and orders.
+"""
+import numpy as np
+from typing import Dict, List, Tuple
+from src.exchanges.fake import FakeBetfair, FAKE_EVENT_TYPE_ID, FAKE_MARKET_TYPES, _iso
+from src.exchanges.ticks import TICK_PRICES, price_to_tick
+
+RUNNERS_RANGE = (2, 30)
+LEVELS_RANGE = (1, 10)
+
+
+def make_catalogue(rng : np.random.Generator, markets_qty : int, runners_range : Tuple[int, int] = RUNNERS_RANGE,
+                   start_time : float = 0.0) -> Tuple[Dict[str, dict], Dict[str, np.ndarray]]:
+    """
+    The make_catalogue function returns the catalogue entries (listMarketCatalogue format) of markets_qty markets,
+    and the fair probabilities of their runners, with between runners_range[0] and runners_range[1] runners each
+    """
+    catalogue, fair_probs = {}, {}
+    runners_qty = rng.integers(runners_range[0], runners_range[1] + 1, size=markets_qty)
+    for i in range(markets_qty):
+        market_id = f"1.{300000000 + i}"
+        catalogue[market_id] = {"marketId": market_id, "marketType": FAKE_MARKET_TYPES[i % len(FAKE_MARKET_TYPES)], "eventTypeId": FAKE_EVENT_TYPE_ID,
+                                "marketStartTime": _iso(start_time + 3600 * (1 + i % 48)), "totalMatched": float(np.round(rng.uniform(0, 1e5), 2))}
+        fair_probs[market_id] = rng.dirichlet(np.ones(runners_qty[i]) * 2)
+    return catalogue, fair_probs
+
+
+def make_current_orders(rng : np.random.Generator, fair_probs : Dict[str, np.ndarray], orders_qty : int, placed_at : float = 0.0) -> List[dict]:
+    """
+    The make_current_orders function returns orders_qty orders (listCurrentOrders lightweight format) on random runners of the markets,
+    at prices within 10% of their fair odds: 20% unmatched, 20% half matched and 60% fully matched, like the fake exchange
+    """
+    market_ids = list(fair_probs)
+    market_numbers = rng.integers(len(market_ids), size=orders_qty)
+    runners_qty = np.array([len(fair_probs[market_id]) for market_id in market_ids])
+    selection_numbers = (rng.random(orders_qty) * runners_qty[market_numbers]).astype(np.int64)
+    probs = np.array([fair_probs[market_ids[market_number]][selection_number]
+                      for market_number, selection_number in zip(market_numbers.tolist(), selection_numbers.tolist())])
+    prices = TICK_PRICES[price_to_tick(np.clip(1 / probs * rng.uniform(0.9, 1.1, orders_qty), 1.01, 1000))]
+    sizes = np.round(rng.uniform(2, 50, orders_qty), 2)
+    sizes_matched = np.round(sizes * rng.choice([0, 0.5, 1], p=[0.2, 0.2, 0.6], size=orders_qty), 2)
+    sides = np.where(rng.random(orders_qty) < 0.5, "BACK", "LAY")
+    placed_date = _iso(placed_at)
+    return [{"betId": str(10 ** 11 + bet_id), "marketId": market_ids[market_number], "selectionId": 100 + selection_number,
+             "priceSize": {"price": price, "size": size}, "side": side, "sizeMatched": size_matched, "sizeRemaining": round(size - size_matched, 2),
+             "placedDate": placed_date, "matchedDate": placed_date if size_matched > 0 else None}
+            for bet_id, (market_number, selection_number, price, size, size_matched, side) in
+            enumerate(zip(market_numbers.tolist(), selection_numbers.tolist(), prices.tolist(), sizes.tolist(), sizes_matched.tolist(), sides.tolist()))]
+
+
+def make_fake_exchange(markets_qty : int, orders_qty : int, runners_range : Tuple[int, int] = RUNNERS_RANGE, levels : int = 3,
+                       seed : int = 0, placed_at : float = 0.0) -> FakeBetfair:
+    """
+    The make_fake_exchange function returns a logged-in FakeBetfair serving the synthetic markets and orders of seed,
+    whose books have `levels` levels per side
+    """
+    rng = np.random.default_rng(seed)
+    catalogue, fair_probs = make_catalogue(rng, markets_qty, runners_range, start_time=placed_at)
+    trading = FakeBetfair(markets_qty=0, orders_qty=0, seed=seed)
+    trading.login()
+    betting = trading.trading.betting
+    betting.catalogue, betting.fair_probs = catalogue, fair_probs
+    betting.orders = make_current_orders(rng, fair_probs, orders_qty, placed_at=placed_at)
+    trading.book_depth = levels
+    return trading
@@ -12,63 +12,84 @@ parent = os.path.dirname(current)
 sys.path.append(parent)
 
 import streamlit as st
+from functools import partial
 from src.exchanges.betfair import Betfair
-from src.utils import split_matched_and_open
-from src.website_utils import get_selection_stats, get_market_stats
+from src.exchanges.catalogue_cache import MarketCatalogueCache
+from src.exchanges.recording import RecordingExchange, ReplayExchange
+from src.stats_store import StatsStore, StoreReader
+from src.website_refresher import StatsRefresher, compute_snapshot
+from src.website_utils import MarketStatsCache
 import pandas as pd
 import time
 from datetime import datetime
+from typing import Union
 
 
 st.set_page_config(page_title="CRBMNC - BETTING HEDGE FUND", page_icon="₿", layout="wide")
 st.title("CRBMNC - BETTING HEDGE FUND")
 
-trading = Betfair()
-trading.login()
 
-# @st.cache(ttl=60*5)
-def update_stats():
-    f"Last time refreshed : {datetime.utcnow()}"
-    data_load_state = st.text("Loading data from exchange...")
-    account_funds = trading.trading.account.get_account_funds()
-    available_to_bet_balance = account_funds.available_to_bet_balance
-
-    orders = trading.get_current_orders()
-    orders_df = pd.DataFrame([order.__dict__ for order in orders])
-    matched_orders, open_orders = split_matched_and_open(orders)
-
-    selection_stats = get_selection_stats(orders_df)
-    market_id = pd.Series(selection_stats.index).apply(lambda x: x[0])
-    selection_id = pd.Series(selection_stats.index).apply(lambda x: x[1])
-    selection_stats.reset_index(inplace= True, drop = True)
-    selection_stats['market_id'] = market_id
-    selection_stats['selection_id'] = selection_id
-
-    market_ids_matched = list(selection_stats["market_id"].unique())
-
-    market_stats = get_market_stats(trading=trading, market_ids=market_ids_matched, matched_orders=matched_orders,
-                                    open_orders=open_orders)
-    market_stats.index.name = "market_id"
-    market_stats.reset_index(inplace=True,drop=False)
-
-    expected_pnl_before = market_stats.expected_pnl_before
-    expected_pnl_after = market_stats.expected_pnl_after
-    data_load_state.text(f"Finished loading data from the exchange!")
-
-    return orders_df, selection_stats, market_stats,  available_to_bet_balance, expected_pnl_before, expected_pnl_after
-
-
-orders_df, selection_stats, market_stats,  available_to_bet_balance, expected_pnl_before, expected_pnl_after = update_stats()
-
-account_stats = {
-    "Available to bet" : round(available_to_bet_balance, 2),
-    "Total matched LAY" :  round(selection_stats.LAY_SIZE_MATCHED.sum(),2),
-    "Total BACK matched" : round(selection_stats.BACK_SIZE_MATCHED.sum(),2),
-    "Expected pnl before cashout" : round(expected_pnl_before.sum(),2),
-    "Expected pnl after cashout" : round(expected_pnl_after.sum(),2),
-    "Hit ratio (before cashout) %" : 100*round((expected_pnl_before > 0).mean(),3),
-    "Hit ratio (after cashout) %" : 100*round((expected_pnl_after > 0).mean(),3)
-}
+@st.experimental_singleton
+def get_refresher() -> Union[StatsRefresher, StoreReader]:
+    """
+    With STATS_STORE_PATH, the app only reads the store written by the stats workers (see stats_worker).
+    Otherwise, one logged-in exchange session and one background refresher for the whole process, shared by all the browser sessions
+    """
+    if "STATS_STORE_PATH" in os.environ:
+        max_age = float(os.environ["STATS_STORE_MAX_AGE"]) if "STATS_STORE_MAX_AGE" in os.environ else None
+        return StoreReader(StatsStore(os.environ["STATS_STORE_PATH"]), max_age=max_age)
+
+    market_stats_workers = int(os.environ.get("MARKET_STATS_WORKERS", 1))
+    market_stats_timeout = float(os.environ["MARKET_STATS_TIMEOUT"]) if "MARKET_STATS_TIMEOUT" in os.environ else None
+    if "BETFAIR_REPLAY_PATH" in os.environ:
+        # Offline, from a recording of BETFAIR_RECORD_PATH (see exchanges.recording). An empty speed serves the recorded calls one by one
+        replay_speed = os.environ.get("BETFAIR_REPLAY_SPEED", "1")
+        trading = ReplayExchange(os.environ["BETFAIR_REPLAY_PATH"], speed=float(replay_speed) if replay_speed else None)
+    else:
+        trading = Betfair()
+        trading.data_weight_per_second = float(os.environ.get("BETFAIR_DATA_WEIGHT_PER_SECOND", trading.data_weight_per_second))
+        trading.data_weight_burst = float(os.environ.get("BETFAIR_DATA_WEIGHT_BURST", trading.data_weight_burst))
+        trading.login()
+        # Catalogue entries are kept between refreshes, and across restarts in a SQLite snapshot
+        trading.catalogue_cache = MarketCatalogueCache(path=os.environ.get("CATALOGUE_CACHE_PATH", "catalogue_cache.sqlite"))
+        if os.environ.get("BETFAIR_STREAMING", "0") == "1":
+            # Orders and books are then served from the stream caches instead of being pulled on every refresh
+            trading.start_streaming()
+        if "BETFAIR_RECORD_PATH" in os.environ:
+            trading = RecordingExchange(trading, path=os.environ["BETFAIR_RECORD_PATH"])
+
+    # Markets whose prices moved by less than this relative tolerance, with the same position, reuse their previous cashout
+    stats_cache = MarketStatsCache(price_tolerance=float(os.environ.get("MARKET_STATS_PRICE_TOLERANCE", 0)))
+
+    refresher = StatsRefresher(compute=partial(compute_snapshot, trading, market_stats_workers, market_stats_timeout, stats_cache),
+                               interval=float(os.environ.get("DASHBOARD_REFRESH_INTERVAL", 60)),
+                               keep_alive=trading.trading.keep_alive)
+    return refresher.start()
+
+
+refresher = get_refresher()
+
+if st.button("Force refresh"):
+    with st.spinner("Refreshing data from the exchange..."):
+        refresher.force_refresh(timeout=300)
+
+snapshot = refresher.snapshot
+if snapshot is None:
+    with st.spinner("Loading data from exchange..."):
+        while snapshot is None and refresher.last_error is None:
+            snapshot = refresher.wait_for_snapshot(timeout=1)
+    if snapshot is None:
+        st.error(f"Could not load data from the exchange : {refresher.last_error}")
+        st.stop()
+
+f"Last time refreshed : {datetime.utcfromtimestamp(snapshot.created_at)} ({round(snapshot.age)}s ago, took {round(snapshot.refresh_seconds, 1)}s)"
+if snapshot.market_stats_cache:
+    f"Market stats cache : {snapshot.market_stats_cache['hits']} hits, {snapshot.market_stats_cache['tolerance_hits']} within tolerance, {snapshot.market_stats_cache['misses']} misses"
+if refresher.last_error is not None:
+    st.warning(f"Last refresh failed, showing the previous snapshot : {refresher.last_error}")
+
+orders_df, selection_stats, market_stats = snapshot.orders_df, snapshot.selection_stats, snapshot.market_stats
+account_stats = dict(snapshot.account_stats)
 
 f"Account Stats"
 st.write("Stats", account_stats)
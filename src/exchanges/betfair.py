@@ -1,23 +1,96 @@
 import os
+import threading
+import time
 import pandas as pd
+import requests
 import betfairlightweight
-from betfairlightweight.filters import market_filter
-from src.utils import Order, Market, Runner, split_matched_and_open, get_login_details
-from src.exchanges.exchange import Exchange, BookNormalized
+from concurrent.futures import ThreadPoolExecutor
+from betfairlightweight.filters import market_filter, time_range, streaming_market_filter, streaming_market_data_filter, streaming_order_filter
+from betfairlightweight.streaming import StreamListener, HistoricalStream
+from betfairlightweight.exceptions import APIError
+from betfairlightweight.utils import check_status_code
+from src.utils import Order, InstructionReport, split_matched_and_open, get_login_details
+from src.utils_orders import OrderTable
+from src.exchanges.exchange import Exchange, BookNormalized, BACK_PRICES, BACK_SIZES, LAY_PRICES, LAY_SIZES
+from src.exchanges.rate_limiter import TokenBucket
+from src.exchanges.catalogue_cache import MarketCatalogueCache
+from src.exchanges.book_decoder import MarketBookArrays, DecodedMarket, loads
 import numpy as np
 # from tenacity import retry, wait_fixed, stop_after_attempt
 from betfairlightweight.resources.bettingresources import MarketBook
-from typing import Union, List
+from typing import Union, List, Dict, Tuple
 
+# https://docs.developer.betfair.com/display/1smk3cen4v3lu3yomq5qye0ni/Market+Data+Request+Limits
+MAX_REQUEST_WEIGHT = 200
+MARKET_BOOK_WEIGHT = 5  # EX_BEST_OFFERS, per market, for up to MARKET_BOOK_DEPTH levels
+MARKET_BOOK_DEPTH = 3  # Levels per side returned by EX_BEST_OFFERS without exBestOffersOverrides
+MARKET_BOOK_ALL_OFFERS_WEIGHT = 17  # EX_ALL_OFFERS, per market: the full ladder of each runner
+CATALOGUE_REQUEST_WEIGHT = 1  # MARKET_START_TIME weighs 0 per market, each request still takes a token
+CATALOGUE_MAX_RESULTS = 1000
+FETCH_WORKERS = 8
+# Self-imposed throttle of the concurrent fetches, in data weight points: Betfair only documents the MAX_REQUEST_WEIGHT of one request,
+# not a rate. These defaults only smooth out bursts of large refreshes, and can be set per instance (data_weight_per_second, data_weight_burst)
+DATA_WEIGHT_PER_SECOND = 5000
+DATA_WEIGHT_BURST = 2000
+
+CURRENT_ORDERS_PAGE_SIZE = 1000
+ORDERS_FULL_SYNC_SECONDS = 600
+ORDERS_CHECK_SECONDS = 60
+ORDERS_WATERMARK_OVERLAP_SECONDS = 5
+
+# https://docs.developer.betfair.com/display/1smk3cen4v3lu3yomq5qye0ni/Betting+API (instructions per request)
+PLACE_INSTRUCTIONS_MAX = 200
+CANCEL_INSTRUCTIONS_MAX = 60
+REPLACE_INSTRUCTIONS_MAX = 60
+
+STREAM_MARKET_FIELDS = ["EX_BEST_OFFERS", "EX_MARKET_DEF", "EX_TRADED_VOL"]
+STREAM_MARKET_ALL_OFFERS_FIELDS = ["EX_ALL_OFFERS", "EX_MARKET_DEF", "EX_TRADED_VOL"]
+STREAM_LADDER_LEVELS = 3
+STREAM_SUBSCRIBE_TIMEOUT = 10
 
 class Betfair(Exchange):
 
+    # Streaming mode (see start_streaming and start_replay). When a listener is set, the orders or the market books
+    # are served from its cache, which betfairlightweight keeps up to date with the deltas of the stream
+    market_listener : StreamListener = None
+    order_listener : StreamListener = None
+    _market_stream = None
+    _order_stream = None
+    _streamed_market_ids = frozenset()
+    _stream_conflate_ms = None
+    _stream_ladder_levels = STREAM_LADDER_LEVELS
+
+    # Concurrent fetching of the catalogue and the books, shared by all the requests of the instance
+    fetch_workers = FETCH_WORKERS
+    data_weight_per_second = DATA_WEIGHT_PER_SECOND
+    data_weight_burst = DATA_WEIGHT_BURST
+    _fetch_pool : ThreadPoolExecutor = None
+    _rate_limiter : TokenBucket = None
+
+    # Incremental sync of the current orders (see get_current_orders): local orders by bet_id, in the lightweight API format
+    _orders_by_bet_id : Dict[str, dict] = None
+    _orders_watermark : pd.Timestamp = None
+    _orders_last_full_sync : float = None
+    _orders_last_check : float = None
+    order_sync_stats : Dict[str, int] = None
+
+    # Optional catalogue cache: when set, only the missing or stale market ids of an explicit market_ids list are requested
+    catalogue_cache : MarketCatalogueCache = None
+
+    # Levels per side of the books of get_markets. None requests the full ladders (EX_ALL_OFFERS), which weigh more than 3 times as much
+    book_depth : Union[int, None] = MARKET_BOOK_DEPTH
+
     def login(self):
         certs_path_betfair = os.getcwd() + "/src/credentials/betfair"
         username, password, app_key = get_login_details(os.getcwd() + "/src/credentials/betfair/credentials.txt")
         # certs_path_betfair = os.getcwd() + "/credentials/betfair"
         # username, password, app_key = get_login_details(os.getcwd() + "/credentials/betfair/credentials.txt")
-        self.trading = betfairlightweight.APIClient(username=username, password=password, app_key=app_key, certs=certs_path_betfair)
+        # One pooled session for all the requests, with a connection per fetch worker
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.fetch_workers, pool_maxsize=self.fetch_workers)
+        session.mount("https://", adapter)
+        self.trading = betfairlightweight.APIClient(username=username, password=password, app_key=app_key, certs=certs_path_betfair,
+                                                    session=session)
         self.trading.login.connect_timeout = self.trading.login.read_timeout = 30
         self.trading.login()
 
@@ -26,102 +99,332 @@ class Betfair(Exchange):
         return Order(order.market_id, order.selection_id, order.price_size.price, order.size_remaining, order.size_matched, order.side, order.bet_id)
 
     @staticmethod
-    def normalize_book(book : MarketBook, orderbook_levels : int, selection_ids : Union[List[int], None] = None) -> BookNormalized:
+    def normalize_book(book : MarketBook, orderbook_levels : Union[int, None], selection_ids : Union[List[int], None] = None) -> BookNormalized:
         """
-        The parse_book function takes a MarketBook object and returns four lists of numpy arrays.
+        The parse_book function takes a MarketBook object and returns a BookNormalized with four (levels, selections) arrays.
         Each one of these list contains orderbook_levels numpy arrays corresponding to each level of the book.
         Each numpy array contains len(selection_ids) elements, corresponding to each selection (price or size) in that level
         The first array corresponds to the level 0 , and the last element to the level orderbook_levels
 
         :param book:MarketBook
         :param selection_ids:List[int]: Select which runners to include in the orderbook
-        :param orderbook_levels:int=3: Specify the number of levels to return
-        :return: The following:
-        Four lists of numpy arrays
-        The first list is the back prices for each runner in the book
-        the second list is the back sizes for each runner in the book,
-        the third list is the lay prices for each runner in the book, and
-        the fourth list is teh lay sizes for each runner in teh book.
+        :param orderbook_levels:int=3: Specify the number of levels to return. None returns the depth of the deepest ladder of the book
+        :return: A BookNormalized backed by a single (4, orderbook_levels, len(selection_ids)) array:
+        The first (levels, selections) array is the back prices for each runner in the book
+        the second one is the back sizes for each runner in the book,
+        the third one is the lay prices for each runner in the book, and
+        the fourth one is the lay sizes for each runner in the book.
 
         """
+        if isinstance(book, DecodedMarket):
+            # Sliced straight from the decoded array, without building the runners
+            return book.normalize(orderbook_levels=orderbook_levels, selection_ids=selection_ids)
         if selection_ids is None:
             selection_ids = [runner.runner_id for runner in book.runners]
+        if orderbook_levels is None:
+            orderbook_levels = max((len(ladder or []) for runner in book.runners for ladder in (runner.available_to_back, runner.available_to_lay)),
+                                   default=0)
 
-        # TODO: Add specific exceptions
-        book_back_prices = []
-        book_back_sizes = []
-        book_lay_prices = []
-        book_lay_sizes = []
-
-        book_selections = {}
-        for runner in book.runners:
-            selection_id = runner.runner_id
-            book_selections[selection_id] = runner
-
-        for level in range(orderbook_levels):
-            book_back_prices_level = []
-            book_back_sizes_level = []
-            book_lay_prices_level = []
-            book_lay_sizes_level = []
-            for selection_id in selection_ids:
-                try:
-                    runner = book_selections[selection_id]
-                except KeyError:
-                    runner = None
-                try:
-                    available_to_back = runner.available_to_back[level]
-                    price_back = available_to_back["price"]
-                    size_back = available_to_back["size"]
-                except:
-                    price_back = 1.01
-                    size_back = 0
-
-                try:
-                    available_to_lay = runner.available_to_lay[level]
-                    price_lay = available_to_lay["price"]
-                    size_lay = available_to_lay["size"]
-                except:
-                    price_lay = 1000
-                    size_lay = 0
-
-                book_back_prices_level.append(price_back)
-                book_back_sizes_level.append(size_back)
-                book_lay_prices_level.append(price_lay)
-                book_lay_sizes_level.append(size_lay)
-
-            book_back_prices.append(np.array(book_back_prices_level))
-            book_back_sizes.append(np.array(book_back_sizes_level))
-            book_lay_prices.append(np.array(book_lay_prices_level))
-            book_lay_sizes.append(np.array(book_lay_sizes_level))
-
-        return BookNormalized(market_id=book.market_id, back_prices=book_back_prices, back_sizes=book_back_sizes,
-                              lay_prices=book_lay_prices, lay_sizes=book_lay_sizes, selection_ids=selection_ids)
+        # Missing levels have a NaN price and no size, see BookNormalized.back_mask
+        data = np.empty((4, orderbook_levels, len(selection_ids)), dtype=np.float64)
+        data[[BACK_PRICES, LAY_PRICES]] = np.nan
+        data[[BACK_SIZES, LAY_SIZES]] = 0
 
-    #@retry(wait=wait_fixed(5), stop=stop_after_attempt(5))
+        book_selections = {runner.runner_id: runner for runner in book.runners}
+        for selection_number, selection_id in enumerate(selection_ids):
+            runner = book_selections.get(selection_id)
+            if runner is None:
+                continue
+            for price_idx, size_idx, ladder in ((BACK_PRICES, BACK_SIZES, runner.available_to_back), (LAY_PRICES, LAY_SIZES, runner.available_to_lay)):
+                ladder = (ladder or [])[:orderbook_levels]
+                if ladder:
+                    data[price_idx, :len(ladder), selection_number] = [level["price"] for level in ladder]
+                    data[size_idx, :len(ladder), selection_number] = [level["size"] for level in ladder]
+
+        return BookNormalized.from_array(market_id=book.market_id, data=data, selection_ids=selection_ids)
+
+    def start_streaming(self, market_ids : Union[List[str], None] = None, conflate_ms : Union[int, None] = None,
+                        ladder_levels : Union[int, None] = STREAM_LADDER_LEVELS):
+        """
+        The start_streaming function subscribes to the order stream of the account and to the market stream of market_ids,
+        each one read by a daemon thread. From then on, get_current_orders, get_market_books and get_markets are served
+        from the caches of the streams, without a request to the API. Markets that are not subscribed yet are added to
+        the market subscription the first time they are requested.
+
+        :param market_ids:List[str]: Markets to subscribe to right away
+        :param conflate_ms:int: Conflation rate of the streams, None for the Betfair default
+        :param ladder_levels:int: Levels of the best offers kept in the market cache (1 to 10), None for the full ladders (EX_ALL_OFFERS)
+        """
+        self._stream_conflate_ms = conflate_ms
+        self._stream_ladder_levels = ladder_levels
+
+        self.order_listener = StreamListener(max_latency=None, lightweight=True)
+        self._order_stream = self.trading.streaming.create_stream(listener=self.order_listener)
+        self._order_stream.subscribe_to_orders(order_filter=streaming_order_filter(), conflate_ms=conflate_ms)
+        threading.Thread(target=self._order_stream.start, name="betfair-order-stream", daemon=True).start()
+
+        self.market_listener = StreamListener(max_latency=None, lightweight=True)
+        self._market_stream = self.trading.streaming.create_stream(listener=self.market_listener)
+        self._streamed_market_ids = frozenset()
+        if market_ids:
+            self._subscribe_markets(market_ids)
+
+        self._wait_for(lambda: self.order_listener.initial_clk is not None)
+
+    def start_replay(self, market_file : Union[str, None] = None, order_file : Union[str, None] = None):
+        """
+        The start_replay function is the offline stand-in of start_streaming: it fills the caches from files of stream messages
+        (one mcm or ocm JSON message per line, as in the Betfair historical data) instead of a connection.
+        The files are read synchronously, so the caches hold the state at the end of the files when the function returns.
+
+        :param market_file:str: Path of the market stream messages
+        :param order_file:str: Path of the order stream messages
+        """
+        if market_file is not None:
+            self.market_listener = StreamListener(max_latency=None, lightweight=True)
+            HistoricalStream(market_file, self.market_listener, operation="marketSubscription", unique_id=0).start()
+        if order_file is not None:
+            self.order_listener = StreamListener(max_latency=None, lightweight=True)
+            HistoricalStream(order_file, self.order_listener, operation="orderSubscription", unique_id=0).start()
+
+    def stop_streaming(self):
+        for stream in (self._market_stream, self._order_stream):
+            if stream is not None:
+                stream.stop()
+        self.market_listener = self.order_listener = self._market_stream = self._order_stream = None
+        self._streamed_market_ids = frozenset()
+
+    def _subscribe_markets(self, market_ids : List[str]):
+        """
+        Extends the market subscription to market_ids and waits for their images.
+        A new subscription replaces the previous one, so all the markets streamed so far are requested again.
+        The listener also replaces its stream, and its cache with it: the books of the previous cache are carried over,
+        so that they are still served until the new images replace them.
+        """
+        if self._market_stream is None or self._streamed_market_ids.issuperset(market_ids):
+            return
+        previous_caches = dict(self.market_listener.stream._caches) if self.market_listener.stream is not None else {}
+        start_thread = not self._streamed_market_ids
+        self._streamed_market_ids = self._streamed_market_ids.union(market_ids)
+        if self._stream_ladder_levels is None:
+            market_data_filter = streaming_market_data_filter(fields=STREAM_MARKET_ALL_OFFERS_FIELDS)
+        else:
+            market_data_filter = streaming_market_data_filter(fields=STREAM_MARKET_FIELDS, ladder_levels=self._stream_ladder_levels)
+        self._market_stream.subscribe_to_markets(
+            market_filter=streaming_market_filter(market_ids=sorted(self._streamed_market_ids)),
+            market_data_filter=market_data_filter,
+            conflate_ms=self._stream_conflate_ms,
+        )
+        caches = self.market_listener.stream._caches
+        for market_id, cache in previous_caches.items():
+            # setdefault: an image of the new subscription already received by the stream thread wins
+            caches.setdefault(market_id, cache)
+        if start_thread:
+            threading.Thread(target=self._market_stream.start, name="betfair-market-stream", daemon=True).start()
+        self._wait_for(lambda: len(self.market_listener.snap(list(market_ids))) == len(set(market_ids)))
 
-    def get_current_orders(self):
+    @staticmethod
+    def _wait_for(condition, timeout : float = STREAM_SUBSCRIBE_TIMEOUT):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                print(f"Stream images not received after {timeout}s")
+                return
+            time.sleep(0.05)
+
+    @staticmethod
+    def _extend_orders(current_orders : OrderTable, orders_batch : List[dict]):
+        """
+        Writes lightweight current orders (list_current_orders or order stream format) straight into the columns of current_orders
+        """
+        current_orders.extend(market_id=[order["marketId"] for order in orders_batch],
+                              runner_id=[order["selectionId"] for order in orders_batch],
+                              price=[order["priceSize"]["price"] for order in orders_batch],
+                              size_remaining=[order["sizeRemaining"] for order in orders_batch],
+                              size_matched=[order["sizeMatched"] for order in orders_batch],
+                              side=[order["side"] for order in orders_batch],
+                              bet_id=[order["betId"] for order in orders_batch])
+
+    def _list_current_orders(self, **filters) -> List[dict]:
+        """
+        All the pages of list_current_orders for filters, in lightweight format
+        """
         count = 0
-        current_orders = []
+        orders = []
         while True:
-            current_orders_batch = self.trading.betting.list_current_orders(from_record=count * 1000, record_count=1000).orders
-            current_orders.extend(current_orders_batch)
-            if len(current_orders_batch) < 1000:
+            current_orders_batch = self.trading.betting.list_current_orders(from_record=count * CURRENT_ORDERS_PAGE_SIZE,
+                                                                            record_count=CURRENT_ORDERS_PAGE_SIZE, lightweight=True, **filters)
+            orders_batch = current_orders_batch["currentOrders"]
+            orders.extend(orders_batch)
+            if not current_orders_batch.get("moreAvailable", len(orders_batch) == CURRENT_ORDERS_PAGE_SIZE):
                 break
             count += 1
-        current_orders = [self.normalize_order(order) for order in current_orders]
+        return orders
+
+    def _update_orders_watermark(self, orders : List[dict]):
+        dates = [order[field] for order in orders for field in ("placedDate", "matchedDate") if order.get(field)]
+        if dates:
+            latest = max(pd.to_datetime(dates, utc=True))
+            if self._orders_watermark is None or latest > self._orders_watermark:
+                self._orders_watermark = latest
+
+    def _sync_current_orders_full(self):
+        orders = self._list_current_orders()
+        self._orders_by_bet_id = {order["betId"]: order for order in orders}
+        self._orders_watermark = None
+        self._update_orders_watermark(orders)
+        self._orders_last_full_sync = self._orders_last_check = time.time()
+        self.order_sync_stats["full_syncs"] += 1
+        self.order_sync_stats["fetched"] += len(orders)
+
+    def _sync_current_orders_incremental(self):
+        """
+        Requests the orders matched since the watermark, in one listCurrentOrders call (more only past a page of matches),
+        and updates the local orders with them.
+        """
+        date_range = time_range(from_=(self._orders_watermark - pd.Timedelta(seconds=ORDERS_WATERMARK_OVERLAP_SECONDS)).strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+        fetched = {order["betId"]: order for order in self._list_current_orders(order_by="BY_MATCH_TIME", date_range=date_range)}
+        reused = sum(1 for bet_id in self._orders_by_bet_id if bet_id not in fetched)
+        self._orders_by_bet_id.update(fetched)
+        self._update_orders_watermark(list(fetched.values()))
+        self.order_sync_stats["incremental_syncs"] += 1
+        self.order_sync_stats["fetched"] += len(fetched)
+        self.order_sync_stats["reused"] += reused
+
+    def _check_executable_orders(self) -> bool:
+        """
+        Orders placed without being matched, cancelled or lapsed have no match time, so the incremental sync does not see them.
+        The check_executable_orders function requests the executable orders and returns True if they are the executable local orders,
+        with the same remaining sizes
+        """
+        executable = {order["betId"]: order["sizeRemaining"] for order in self._list_current_orders(order_projection="EXECUTABLE")}
+        self._orders_last_check = time.time()
+        self.order_sync_stats["checks"] += 1
+        return executable == {bet_id: order["sizeRemaining"] for bet_id, order in self._orders_by_bet_id.items() if order["sizeRemaining"] > 0}
+
+    #@retry(wait=wait_fixed(5), stop=stop_after_attempt(5))
+
+    def get_current_orders(self, incremental : bool = False) -> OrderTable:
+        """
+        The get_current_orders function returns the current orders of the account as an OrderTable.
+        The orders are requested in lightweight mode and their fields are written straight into the columns of the table,
+        without building a resource object or an Order per order. In streaming mode they are read from the order cache.
+
+        :param incremental:bool: If True, keep the orders by bet_id between calls and only request the ones matched since
+        the last sync (see _sync_current_orders_incremental). Every ORDERS_CHECK_SECONDS, the executable orders are also compared
+        with the local ones (see _check_executable_orders), and a full sync is done if they differ, if there is no watermark yet,
+        and every ORDERS_FULL_SYNC_SECONDS, which also drops the orders of settled markets.
+        The orders fetched and reused are counted in order_sync_stats
+        :return: The OrderTable
+        """
+        current_orders = OrderTable()
+        if self.order_listener is not None:
+            for order_book in self.order_listener.snap():
+                self._extend_orders(current_orders, order_book["currentOrders"])
+            return current_orders
+
+        if self.order_sync_stats is None:
+            self.order_sync_stats = {"fetched": 0, "reused": 0, "full_syncs": 0, "incremental_syncs": 0, "checks": 0}
+        if not incremental or self._orders_by_bet_id is None or self._orders_watermark is None \
+                or time.time() - self._orders_last_full_sync > ORDERS_FULL_SYNC_SECONDS:
+            self._sync_current_orders_full()
+        else:
+            self._sync_current_orders_incremental()
+            if time.time() - self._orders_last_check > ORDERS_CHECK_SECONDS and not self._check_executable_orders():
+                self._sync_current_orders_full()
+        self._extend_orders(current_orders, list(self._orders_by_bet_id.values()))
         return current_orders
+
     def get_matched_and_open_orders(self):
         current_orders = self.get_current_orders()
         return split_matched_and_open(current_orders)
 
+    def _get_fetch_pool(self) -> ThreadPoolExecutor:
+        if self._fetch_pool is None:
+            self._fetch_pool = ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="betfair-fetch")
+        return self._fetch_pool
+
+    def _fetch_concurrently(self, fetch, chunks : List, weights : List[float]) -> List:
+        """
+        The _fetch_concurrently function runs fetch(chunk) for each chunk in the fetch thread pool, each one after taking
+        its data weight from the rate limiter, and returns the results in the order of chunks.
+        The wall-clock time is then that of the slowest chunk, as long as the limiter does not throttle.
+        """
+        fetch_pool = self._get_fetch_pool()
+        if self._rate_limiter is None:
+            self._rate_limiter = TokenBucket(rate=self.data_weight_per_second, capacity=self.data_weight_burst)
+
+        def fetch_chunk(chunk, weight):
+            self._rate_limiter.acquire(weight)
+            return fetch(chunk)
+
+        if len(chunks) == 1:
+            return [fetch_chunk(chunks[0], weights[0])]
+        futures = [fetch_pool.submit(fetch_chunk, chunk, weight) for chunk, weight in zip(chunks, weights)]
+        return [future.result() for future in futures]
+
+    def _list_market_book_raw(self, market_ids : List[str], price_projection : Dict) -> bytes:
+        """
+        The _list_market_book_raw function sends listMarketBook through the session of the client and returns the response body undecoded,
+        so that it is parsed once, straight into arrays (see _list_market_book_arrays)
+        """
+        betting = self.trading.betting
+        request = betting.create_req("SportsAPING/v1.0/listMarketBook", {"marketIds": market_ids, "priceProjection": price_projection})
+        response = self.trading.session.post(betting.url, data=request, headers=self.trading.request_headers,
+                                             timeout=(betting.connect_timeout, betting.read_timeout))
+        check_status_code(response)
+        return response.content
+
+    def _list_market_book_arrays(self, market_ids : List[str], price_projection : Dict, depth : Union[int, None]) -> MarketBookArrays:
+        params = {"marketIds": market_ids, "priceProjection": price_projection}
+        body = loads(self._list_market_book_raw(market_ids, price_projection))
+        if body.get("error"):
+            raise APIError(body, "SportsAPING/v1.0/listMarketBook", params)
+        return MarketBookArrays.from_market_books(body["result"], levels=depth)
+
+    @staticmethod
+    def get_price_projection(depth : Union[int, None]) -> Tuple[Dict, float]:
+        """
+        The get_price_projection function returns the listMarketBook price projection for depth levels per side
+        (None for the full ladder, with EX_ALL_OFFERS) and its data weight per market
+        """
+        if depth is None:
+            return betfairlightweight.filters.price_projection(price_data=['EX_ALL_OFFERS']), MARKET_BOOK_ALL_OFFERS_WEIGHT
+        # Deeper best offers weigh proportionally more, see the request limits above
+        overrides = {"bestPricesDepth": depth} if depth != MARKET_BOOK_DEPTH else None
+        return betfairlightweight.filters.price_projection(price_data=['EX_BEST_OFFERS'], ex_best_offers_overrides=overrides, virtualise=True), \
+            MARKET_BOOK_WEIGHT * max(1, depth / MARKET_BOOK_DEPTH)
+
+    def get_market_book_arrays(self, market_ids : List[str], depth : Union[int, None] = MARKET_BOOK_DEPTH) -> MarketBookArrays:
+        """
+        The get_market_book_arrays function returns the books of market_ids decoded into a MarketBookArrays of depth levels per side,
+        or of their full ladders if depth is None.
+        Each chunk is decoded in its fetch thread as soon as it arrives, and its response is dropped right after,
+        so no Python object per level outlives its chunk.
+        """
+        if self.market_listener is not None:
+            return MarketBookArrays.from_market_books(self.get_market_books(market_ids), levels=depth)
+
+        price_projection, market_book_weight = self.get_price_projection(depth)
+        max_count = max(1, int(MAX_REQUEST_WEIGHT // market_book_weight))
+        chunks = [market_ids[i: i+max_count] for i in range(0, len(market_ids), max_count)]
+        book_arrays = self._fetch_concurrently(lambda chunk: self._list_market_book_arrays(chunk, price_projection, depth),
+                                               chunks, [market_book_weight * len(chunk) for chunk in chunks])
+        return MarketBookArrays.concatenate(book_arrays)
+
     #@retry(wait=wait_fixed(5), stop=stop_after_attempt(5))
     def get_market_books(self, market_ids):
-        max_count = 40  # https://docs.developer.betfair.com/display/1smk3cen4v3lu3yomq5qye0ni/Market+Data+Request+Limits
+        if self.market_listener is not None:
+            self._subscribe_markets(market_ids)
+            return self.market_listener.snap(market_ids=list(market_ids))
+
+        max_count = MAX_REQUEST_WEIGHT // MARKET_BOOK_WEIGHT
         filter = betfairlightweight.filters.price_projection(price_data=['EX_BEST_OFFERS'], virtualise=True)
-        markets = []
-        for i in range(0, len(market_ids), max_count):
-            markets.extend(self.trading.betting.list_market_book(market_ids=market_ids[i: i+max_count], price_projection=filter, lightweight=True))
-        return markets
+        chunks = [market_ids[i: i+max_count] for i in range(0, len(market_ids), max_count)]
+        books = self._fetch_concurrently(
+            lambda chunk: self.trading.betting.list_market_book(market_ids=chunk, price_projection=filter, lightweight=True),
+            chunks, [MARKET_BOOK_WEIGHT * len(chunk) for chunk in chunks])
+        return [market for chunk_books in books for market in chunk_books]
 
     #@retry(wait=wait_fixed(5), stop=stop_after_attempt(5))
     def _get_market_catalogue(self, event_type_id, market_type_code, min_volume, market_ids):
@@ -129,35 +432,98 @@ class Betfair(Exchange):
             filter = market_filter(event_type_ids=[event_type_id], market_type_codes=[market_type_code])
         else:
             filter = market_filter(market_ids=market_ids)
-        market_catalogue = self.trading.betting.list_market_catalogue(filter, lightweight=True, max_results=1000, market_projection=['MARKET_START_TIME'])
+        market_catalogue = self.trading.betting.list_market_catalogue(filter, lightweight=True, max_results=CATALOGUE_MAX_RESULTS, market_projection=['MARKET_START_TIME'])
         return {x['marketId']: x for x in market_catalogue if x['totalMatched'] > min_volume}
 
-    def get_market_catalogue(self, event_type_ids, market_type_codes, min_volume, market_ids):
+    def _get_market_catalogue_streaming(self, event_type_ids, market_type_codes, min_volume, market_ids):
+        """
+        Catalogue entries (marketId, marketStartTime, totalMatched) built from the market definitions of the market cache.
+        Without market_ids, only the markets already in the cache can be returned.
+        """
+        if market_ids is not None:
+            self._subscribe_markets(market_ids)
         market_catalogue = {}
+        for market_book in self.market_listener.snap(market_ids=list(market_ids) if market_ids is not None else None):
+            market_definition = market_book.get("marketDefinition") or {}
+            if market_ids is None:
+                if str(market_definition.get("eventTypeId")) not in [str(x) for x in event_type_ids] or \
+                        market_definition.get("marketType") not in market_type_codes:
+                    continue
+                if (market_book["totalMatched"] or 0) <= min_volume:
+                    continue
+            market_catalogue[market_book["marketId"]] = {"marketId": market_book["marketId"],
+                                                         "marketStartTime": market_definition.get("marketTime"),
+                                                         "totalMatched": market_book["totalMatched"] or 0}
+        return market_catalogue
+
+    def get_market_catalogue(self, event_type_ids, market_type_codes, min_volume, market_ids):
+        """
+        The get_market_catalogue function requests the catalogue concurrently: one request per chunk of CATALOGUE_MAX_RESULTS market_ids,
+        so that a long list is not truncated by max_results, or one request per (event_type_id, market_type_code) pair.
+        """
+        if self.market_listener is not None:
+            return self._get_market_catalogue_streaming(event_type_ids, market_type_codes, min_volume, market_ids)
         if market_ids is not None:
-            market_catalogue.update(self._get_market_catalogue(event_type_id = None, market_type_code = None, min_volume = 0, market_ids = market_ids))
-            return market_catalogue
+            if self.catalogue_cache is not None:
+                return self._get_market_catalogue_cached(market_ids)
+            chunks = [market_ids[i: i+CATALOGUE_MAX_RESULTS] for i in range(0, len(market_ids), CATALOGUE_MAX_RESULTS)]
+            catalogues = self._fetch_concurrently(
+                lambda chunk: self._get_market_catalogue(event_type_id=None, market_type_code=None, min_volume=0, market_ids=chunk),
+                chunks, [CATALOGUE_REQUEST_WEIGHT] * len(chunks))
         else:
-            for event_type_id in event_type_ids:
-                for market_type_code in market_type_codes:
-                    market_catalogue.update(self._get_market_catalogue(event_type_id, market_type_code, min_volume))
-            return {k: v for k, v in market_catalogue.items() if v['totalMatched'] > min_volume}
+            pairs = [(event_type_id, market_type_code) for event_type_id in event_type_ids for market_type_code in market_type_codes]
+            catalogues = self._fetch_concurrently(
+                lambda pair: self._get_market_catalogue(event_type_id=pair[0], market_type_code=pair[1], min_volume=min_volume, market_ids=None),
+                pairs, [CATALOGUE_REQUEST_WEIGHT] * len(pairs))
+        market_catalogue = {}
+        for catalogue in catalogues:
+            market_catalogue.update(catalogue)
+        if self.catalogue_cache is not None:
+            self.catalogue_cache.update(market_catalogue)
+        return market_catalogue
+
+    def _get_market_catalogue_cached(self, market_ids):
+        """
+        Requests the catalogue of the market ids that are missing or stale in catalogue_cache only, and serves the others from it.
+        The entries are requested without volume filter so that markets with no volume are cached too, and filtered afterwards.
+        Their books are not requested, so their totalMatched is only refreshed by the catalogue, after the longer zero_volume_ttl of the cache.
+        """
+        stale_market_ids = self.catalogue_cache.get_stale(market_ids)
+        if stale_market_ids:
+            chunks = [stale_market_ids[i: i+CATALOGUE_MAX_RESULTS] for i in range(0, len(stale_market_ids), CATALOGUE_MAX_RESULTS)]
+            for catalogue in self._fetch_concurrently(
+                    lambda chunk: self._get_market_catalogue(event_type_id=None, market_type_code=None, min_volume=float("-inf"), market_ids=chunk),
+                    chunks, [CATALOGUE_REQUEST_WEIGHT] * len(chunks)):
+                self.catalogue_cache.update(catalogue)
+        return {k: v for k, v in self.catalogue_cache.get(market_ids).items() if v['totalMatched'] > 0}
 
     def get_markets(self, event_type_ids, market_type_codes, min_volume=1000, market_ids = None):
         market_catalogue = self.get_market_catalogue(event_type_ids, market_type_codes, min_volume, market_ids)
-        market_books = self.get_market_books(list(market_catalogue.keys()))
+        book_arrays = self.get_market_book_arrays(list(market_catalogue.keys()), depth=self.book_depth)
+        if self.catalogue_cache is not None and self.market_listener is None:
+            # The books carry a fresher totalMatched than the catalogue, and the cached entries carry the parsed start_time
+            self.catalogue_cache.update_volumes({market_id: None if np.isnan(volume) else volume
+                                                 for market_id, volume in zip(book_arrays.market_ids, book_arrays.total_matched.tolist())})
+            market_catalogue = self.catalogue_cache.get(list(market_catalogue.keys()))
+            self.catalogue_cache.save()
+        return self.build_markets(market_catalogue, book_arrays)
+
+    @staticmethod
+    def build_markets(market_catalogue : Dict[str, dict], market_books : Union[List[dict], MarketBookArrays]) -> List[DecodedMarket]:
+        """
+        The build_markets function joins market books (lightweight dicts or already decoded) with their catalogue entries
+        into DecodedMarket objects, sorted by start time. Markets without runners are skipped.
+        """
+        if not isinstance(market_books, MarketBookArrays):
+            market_books = MarketBookArrays.from_market_books(market_books)
         markets = []
-        for market in market_books[:]:
-            runners = []
-            for runner in market['runners']:
-                runner_id = runner['selectionId']
-                available_to_back = runner['ex']['availableToBack']
-                available_to_lay = runner['ex']['availableToLay']
-                runners.append(Runner(runner_id, available_to_back, available_to_lay))
-            if len(runners) > 0:
-                start_time = pd.to_datetime(market_catalogue[market['marketId']]['marketStartTime']).timestamp()
-                volume_matched = market_catalogue[market['marketId']]['totalMatched']
-                markets.append(Market(market['marketId'], start_time, volume_matched, runners))
+        runners_qty = np.diff(market_books.runner_offsets)
+        for market_number, market_id in enumerate(market_books.market_ids):
+            if runners_qty[market_number] > 0:
+                catalogue_entry = market_catalogue[market_id]
+                start_time = catalogue_entry['start_time'] if 'start_time' in catalogue_entry else pd.to_datetime(catalogue_entry['marketStartTime']).timestamp()
+                volume_matched = catalogue_entry['totalMatched']
+                markets.append(DecodedMarket(market_id, start_time, volume_matched, market_books, market_number))
 
         return sorted(markets, key=lambda x: x.start_time)
 
@@ -177,26 +543,92 @@ class Betfair(Exchange):
         response = self.trading.betting.place_orders(market_id=market_id, instructions=[place_instructions], customer_strategy_ref=customer_strategy_ref, lightweight=True)
         return response
 
-    def execute(self, orders_to_cancel, orders_to_replace, orders_to_place):
-
-        for order in orders_to_cancel:
+    @staticmethod
+    def _send_instructions(send, action : str, orders : List[Order], instructions : List[dict], max_instructions : int) -> List[InstructionReport]:
+        """
+        Sends the instructions of one market in requests of at most max_instructions, and matches the instruction reports of each response
+        to its orders, which the exchange returns in the order of the instructions.
+        """
+        reports = []
+        for i in range(0, len(instructions), max_instructions):
+            chunk_orders = orders[i: i+max_instructions]
+            start = time.perf_counter()
             try:
-                resp = self.cancel_limit_order(order.market_id, order.bet_id)
-                print(resp)
+                response = send(instructions[i: i+max_instructions])
             except Exception as e:
-                print(e)
+                latency = time.perf_counter() - start
+                reports.extend(InstructionReport(action, order, "ERROR", bet_id=order.bet_id, error_code=str(e), latency=latency) for order in chunk_orders)
+                continue
+            latency = time.perf_counter() - start
+            instruction_reports = response.get("instructionReports") or []
+            for idx, order in enumerate(chunk_orders):
+                if idx >= len(instruction_reports):
+                    reports.append(InstructionReport(action, order, response.get("status", "ERROR"), error_code=response.get("errorCode"), latency=latency))
+                    continue
+                instruction_report = instruction_reports[idx]
+                # The new bet of a replace is in its place report
+                bet_report = instruction_report.get("placeInstructionReport", instruction_report) if action == "REPLACE" else instruction_report
+                bet_id = bet_report.get("betId", order.bet_id) if action != "CANCEL" else order.bet_id
+                reports.append(InstructionReport(action, order, instruction_report.get("status"), bet_id=bet_id,
+                                                 error_code=instruction_report.get("errorCode"), latency=latency,
+                                                 size_matched=bet_report.get("sizeMatched")))
+        return reports
 
-        for order in orders_to_replace:
-            try:
-                resp = self.replace_limit_order(order.market_id, order.bet_id, order.price)
-                print(resp)
-            except Exception as e:
-                print(e)
+    def _execute_market(self, market_id : str, orders_to_cancel : List[Order], orders_to_replace : List[Order],
+                        orders_to_place : List[Order]) -> List[InstructionReport]:
+        """
+        Cancels, then replaces, then places the orders of one market, batching each kind of instruction
+        """
+        betting = self.trading.betting
+        reports = self._send_instructions(
+            lambda instructions: betting.cancel_orders(market_id=market_id, instructions=instructions, lightweight=True),
+            "CANCEL", orders_to_cancel,
+            [betfairlightweight.filters.cancel_instruction(bet_id=order.bet_id, size_reduction=getattr(order, "size_reduction", None))
+             for order in orders_to_cancel],
+            CANCEL_INSTRUCTIONS_MAX)
+        reports += self._send_instructions(
+            lambda instructions: betting.replace_orders(market_id=market_id, instructions=instructions, lightweight=True),
+            "REPLACE", orders_to_replace,
+            [betfairlightweight.filters.replace_instruction(bet_id=order.bet_id, new_price=order.price) for order in orders_to_replace],
+            REPLACE_INSTRUCTIONS_MAX)
+        reports += self._send_instructions(
+            lambda instructions: betting.place_orders(market_id=market_id, instructions=instructions, lightweight=True),
+            "PLACE", orders_to_place,
+            [betfairlightweight.filters.place_instruction(selection_id=order.runner_id, order_type="LIMIT", side=order.side,
+                                                          limit_order=betfairlightweight.filters.limit_order(size=round(order.size_remaining, 1), price=order.price, persistence_type='LAPSE'))
+             for order in orders_to_place],
+            PLACE_INSTRUCTIONS_MAX)
+        return reports
 
-        for order in orders_to_place:
-            try:
-                resp = self.place_limit_order(order.market_id, order.runner_id, order.side, round(order.size_remaining, 1), order.price)
-                print(resp)
-            except Exception as e:
-                print(e)
+    def execute(self, orders_to_cancel, orders_to_replace, orders_to_place) -> List[InstructionReport]:
+        """
+        The execute function cancels, replaces and places orders. The instructions of each market are grouped into
+        cancel_orders, replace_orders and place_orders requests (within the instruction limits of a request, and in that order),
+        and the markets are sent concurrently.
+
+        :return: One InstructionReport per order, cancels first, then replaces, then places, each in the given order
+        """
+        # Position of each order in the returned reports, so that the same Order sent twice gets one report per instruction.
+        # The reports of _execute_market come in the order of its cancels, replaces and places, like the positions of each market
+        orders_by_market, positions_by_market = {}, {}
+        position = 0
+        for idx, orders in enumerate((orders_to_cancel, orders_to_replace, orders_to_place)):
+            for order in orders:
+                orders_by_market.setdefault(order.market_id, ([], [], []))[idx].append(order)
+                positions_by_market.setdefault(order.market_id, []).append(position)
+                position += 1
+
+        market_reports = {}
+        if len(orders_by_market) == 1:
+            market_id, orders = next(iter(orders_by_market.items()))
+            market_reports[market_id] = self._execute_market(market_id, *orders)
+        else:
+            fetch_pool = self._get_fetch_pool()
+            futures = {market_id: fetch_pool.submit(self._execute_market, market_id, *orders) for market_id, orders in orders_by_market.items()}
+            market_reports = {market_id: future.result() for market_id, future in futures.items()}
 
+        reports = [None] * position
+        for market_id, positions in positions_by_market.items():
+            for position, report in zip(positions, market_reports[market_id]):
+                reports[position] = report
+        return reports
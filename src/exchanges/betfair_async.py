@@ -0,0 +1,172 @@
+import asyncio
+import glob
+import os
+import ssl
+import aiohttp
+from typing import Union, List, Dict
+from src.utils import Market, get_login_details
+from src.utils_orders import OrderTable
+from src.exchanges.exchange import Exchange
+from src.exchanges.betfair import Betfair, MAX_REQUEST_WEIGHT, MARKET_BOOK_WEIGHT, MARKET_BOOK_DEPTH, CATALOGUE_REQUEST_WEIGHT, \
+    CATALOGUE_MAX_RESULTS, CURRENT_ORDERS_PAGE_SIZE, DATA_WEIGHT_PER_SECOND, DATA_WEIGHT_BURST
+from src.exchanges.book_decoder import MarketBookArrays, loads
+from src.exchanges.rate_limiter import TokenBucket
+
+LOGIN_URL = "https://identitysso-cert.betfair.com/api/certlogin"
+BETTING_URL = "https://api.betfair.com/exchange/betting/json-rpc/v1"
+ACCOUNT_URL = "https://api.betfair.com/exchange/account/json-rpc/v1"
+CONNECTIONS_LIMIT = 16
+KEEPALIVE_SECONDS = 60
+REQUEST_TIMEOUT = 30
+
+
+class BetfairRPCError(Exception):
+    pass
+
+
+class AsyncBetfair(Exchange):
+    """
+    asyncio client of the Betfair JSON-RPC API, with the same normalize_book/normalize_order as Betfair.
+    All the requests share one aiohttp session, whose connector keeps up to CONNECTIONS_LIMIT keep-alive connections,
+    so independent calls can be awaited together:
+
+        async with AsyncBetfair() as trading:
+            funds, orders = await asyncio.gather(trading.get_account_funds(), trading.get_current_orders())
+    """
+    normalize_order = staticmethod(Betfair.normalize_order)
+    normalize_book = staticmethod(Betfair.normalize_book)
+    book_depth = Betfair.book_depth
+
+    def __init__(self, betting_url : str = BETTING_URL, account_url : str = ACCOUNT_URL, login_url : str = LOGIN_URL,
+                 connections_limit : int = CONNECTIONS_LIMIT, session_token : Union[str, None] = None, app_key : Union[str, None] = None,
+                 data_weight_per_second : float = DATA_WEIGHT_PER_SECOND, data_weight_burst : float = DATA_WEIGHT_BURST):
+        """
+        :param betting_url:str, account_url:str, login_url:str: Endpoints, e.g. the ones of a MockBetfairServer in tests
+        :param connections_limit:int: Maximum simultaneous connections of the session
+        :param session_token:str, app_key:str: Skip login with an existing session
+        :param data_weight_per_second:float, data_weight_burst:float: Self-imposed throttle of the data weight of the requests,
+        see Betfair.data_weight_per_second
+        """
+        self.betting_url = betting_url
+        self.account_url = account_url
+        self.login_url = login_url
+        self.connections_limit = connections_limit
+        self.session_token = session_token
+        self.app_key = app_key
+        self._session : Union[aiohttp.ClientSession, None] = None
+        self._rate_limiter = TokenBucket(rate=data_weight_per_second, capacity=data_weight_burst)
+        self._request_id = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections_limit, keepalive_timeout=KEEPALIVE_SECONDS)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self) -> "AsyncBetfair":
+        if self.session_token is None:
+            await self.login()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def login(self):
+        certs_path_betfair = os.getcwd() + "/src/credentials/betfair"
+        username, password, app_key = get_login_details(os.getcwd() + "/src/credentials/betfair/credentials.txt")
+        ssl_context = None
+        if self.login_url.startswith("https"):
+            ssl_context = ssl.create_default_context()
+            ssl_context.load_cert_chain(glob.glob(certs_path_betfair + "/*.crt")[0], glob.glob(certs_path_betfair + "/*.key")[0])
+        async with self._get_session().post(self.login_url, data={"username": username, "password": password}, ssl=ssl_context,
+                                            headers={"X-Application": app_key, "Content-Type": "application/x-www-form-urlencoded"}) as response:
+            login = await response.json(content_type=None)
+        if login.get("loginStatus") != "SUCCESS":
+            raise BetfairRPCError(f"Login failed: {login.get('loginStatus')}")
+        self.session_token = login["sessionToken"]
+        self.app_key = app_key
+
+    async def _call(self, url : str, method : str, params : Dict, weight : float = 0):
+        """
+        Sends one JSON-RPC request and returns its result, after taking its data weight from the rate limiter
+        """
+        if weight:
+            await self._rate_limiter.acquire_async(weight)
+        self._request_id += 1
+        payload = {"jsonrpc": "2.0", "method": method, "params": params, "id": self._request_id}
+        headers = {"X-Application": self.app_key or "", "X-Authentication": self.session_token or "", "Content-Type": "application/json"}
+        async with self._get_session().post(url, json=payload, headers=headers) as response:
+            response.raise_for_status()
+            body = loads(await response.read())
+        if "error" in body:
+            raise BetfairRPCError(f"{method}: {body['error']}")
+        return body["result"]
+
+    async def get_account_funds(self) -> Dict:
+        return await self._call(self.account_url, "AccountAPING/v1.0/getAccountFunds", {})
+
+    async def get_current_orders(self) -> OrderTable:
+        current_orders = OrderTable()
+        count = 0
+        while True:
+            current_orders_batch = await self._call(self.betting_url, "SportsAPING/v1.0/listCurrentOrders",
+                                                    {"fromRecord": count * CURRENT_ORDERS_PAGE_SIZE, "recordCount": CURRENT_ORDERS_PAGE_SIZE})
+            orders_batch = current_orders_batch["currentOrders"]
+            Betfair._extend_orders(current_orders, orders_batch)
+            if not current_orders_batch.get("moreAvailable", len(orders_batch) == CURRENT_ORDERS_PAGE_SIZE):
+                break
+            count += 1
+        return current_orders
+
+    async def get_market_books(self, market_ids : List[str]) -> List[dict]:
+        max_count = MAX_REQUEST_WEIGHT // MARKET_BOOK_WEIGHT
+        chunks = [market_ids[i: i+max_count] for i in range(0, len(market_ids), max_count)]
+        books = await asyncio.gather(*[
+            self._call(self.betting_url, "SportsAPING/v1.0/listMarketBook",
+                       {"marketIds": chunk, "priceProjection": {"priceData": ["EX_BEST_OFFERS"], "virtualise": True}},
+                       weight=MARKET_BOOK_WEIGHT * len(chunk))
+            for chunk in chunks])
+        return [market for chunk_books in books for market in chunk_books]
+
+    async def _get_market_book_arrays(self, market_ids : List[str], price_projection : Dict, depth : Union[int, None], weight : float) -> MarketBookArrays:
+        market_books = await self._call(self.betting_url, "SportsAPING/v1.0/listMarketBook",
+                                        {"marketIds": market_ids, "priceProjection": price_projection}, weight=weight)
+        return MarketBookArrays.from_market_books(market_books, levels=depth)
+
+    async def get_market_book_arrays(self, market_ids : List[str], depth : Union[int, None] = MARKET_BOOK_DEPTH) -> MarketBookArrays:
+        """
+        Same as Betfair.get_market_book_arrays: each chunk is decoded as soon as it arrives
+        """
+        price_projection, market_book_weight = Betfair.get_price_projection(depth)
+        max_count = max(1, int(MAX_REQUEST_WEIGHT // market_book_weight))
+        chunks = [market_ids[i: i+max_count] for i in range(0, len(market_ids), max_count)]
+        book_arrays = await asyncio.gather(*[self._get_market_book_arrays(chunk, price_projection, depth, market_book_weight * len(chunk))
+                                             for chunk in chunks])
+        return MarketBookArrays.concatenate(list(book_arrays))
+
+    async def _get_market_catalogue(self, market_filter : Dict, min_volume : float) -> Dict[str, dict]:
+        market_catalogue = await self._call(self.betting_url, "SportsAPING/v1.0/listMarketCatalogue",
+                                            {"filter": market_filter, "maxResults": CATALOGUE_MAX_RESULTS, "marketProjection": ["MARKET_START_TIME"]},
+                                            weight=CATALOGUE_REQUEST_WEIGHT)
+        return {x['marketId']: x for x in market_catalogue if x['totalMatched'] > min_volume}
+
+    async def get_market_catalogue(self, event_type_ids, market_type_codes, min_volume, market_ids) -> Dict[str, dict]:
+        if market_ids is not None:
+            filters = [({"marketIds": market_ids[i: i+CATALOGUE_MAX_RESULTS]}, 0) for i in range(0, len(market_ids), CATALOGUE_MAX_RESULTS)]
+        else:
+            filters = [({"eventTypeIds": [event_type_id], "marketTypeCodes": [market_type_code]}, min_volume)
+                       for event_type_id in event_type_ids for market_type_code in market_type_codes]
+        market_catalogue = {}
+        for catalogue in await asyncio.gather(*[self._get_market_catalogue(market_filter, volume) for market_filter, volume in filters]):
+            market_catalogue.update(catalogue)
+        return market_catalogue
+
+    async def get_markets(self, event_type_ids, market_type_codes, min_volume=1000, market_ids=None) -> List[Market]:
+        market_catalogue = await self.get_market_catalogue(event_type_ids, market_type_codes, min_volume, market_ids)
+        book_arrays = await self.get_market_book_arrays(list(market_catalogue.keys()), depth=self.book_depth)
+        return Betfair.build_markets(market_catalogue, book_arrays)
@@ -0,0 +1,188 @@
+import numpy as np
+from typing import List, Union
+from src.utils import Market, Runner
+from src.exchanges.exchange import BookNormalized, BACK_PRICES, BACK_SIZES, LAY_PRICES, LAY_SIZES
+from src.exchanges.ticks import price_to_tick, PRICES_BY_TICK, MISSING_TICK
+
+# orjson parses the API responses several times faster than json, and straight from bytes. It is optional
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    loads = json.loads
+
+
+class MarketBookArrays:
+    """
+    Market books (listMarketBook format) of many markets decoded into compact ladder arrays: for each side (BACK, LAY),
+    the int16 Betfair tick of each level (see ticks) and its size, as two (2, levels, runners) arrays
+    where the runners of market number m are the columns runner_offsets[m]:runner_offsets[m + 1].
+    Levels are sorted from the best price, and the missing ones hold MISSING_TICK and a size of 0, so ticks >= 0 is the mask of the levels.
+    Books and Runner objects of one market are only built on request (see get_book and get_runners).
+    """
+    def __init__(self, market_ids : List[str], total_matched : np.ndarray, runner_offsets : np.ndarray, selection_ids : np.ndarray,
+                 ticks : np.ndarray, sizes : np.ndarray):
+        self.market_ids = market_ids
+        self.total_matched = total_matched
+        self.runner_offsets = runner_offsets
+        self.selection_ids = selection_ids
+        self.ticks = ticks
+        self.sizes = sizes
+        self._market_numbers = None
+
+    @classmethod
+    def from_market_books(cls, market_books : List[dict], levels : Union[int, None] = None) -> "MarketBookArrays":
+        """
+        The from_market_books function decodes parsed market books in one pass over their ladders.
+
+        :param levels:int: Levels kept per side, e.g. the depth requested. None keeps the deepest ladder of market_books
+        """
+        if levels is None:
+            levels = max((len((runner_book.get("ex") or {}).get(side) or ()) for market in market_books for runner_book in market["runners"]
+                          for side in ("availableToBack", "availableToLay")), default=0)
+        runners_qty = sum(len(market["runners"]) for market in market_books)
+        market_ids, total_matched, runner_offsets, selection_ids = [], [], [0], []
+        # Flat positions (side * levels * runners_qty + level * runners_qty + runner) and values of all the levels, written into the arrays at once
+        positions, prices, sizes = [], [], []
+        lay_offset = levels * runners_qty
+        runner = 0
+        for market in market_books:
+            market_ids.append(market["marketId"])
+            total_matched.append(market.get("totalMatched"))
+            for runner_book in market["runners"]:
+                selection_ids.append(runner_book["selectionId"])
+                ex = runner_book.get("ex") or {}
+                for ladder, offset in ((ex.get("availableToBack"), runner), (ex.get("availableToLay"), lay_offset + runner)):
+                    ladder = (ladder or [])[:levels]
+                    positions.extend(range(offset, offset + len(ladder) * runners_qty, runners_qty))
+                    prices.extend([entry["price"] for entry in ladder])
+                    sizes.extend([entry["size"] for entry in ladder])
+                runner += 1
+            runner_offsets.append(runner)
+
+        positions = np.array(positions, dtype=np.int64)
+        ladder_ticks = np.full((2, levels, runners_qty), MISSING_TICK, dtype=np.int16)
+        ladder_sizes = np.zeros((2, levels, runners_qty), dtype=np.float64)
+        ladder_ticks.reshape(-1)[positions] = price_to_tick(prices)
+        ladder_sizes.reshape(-1)[positions] = sizes
+        return cls(market_ids=market_ids, total_matched=np.array(total_matched, dtype=np.float64),
+                   runner_offsets=np.array(runner_offsets, dtype=np.int64), selection_ids=np.array(selection_ids, dtype=np.int64),
+                   ticks=ladder_ticks, sizes=ladder_sizes)
+
+    @classmethod
+    def concatenate(cls, chunks : List["MarketBookArrays"]) -> "MarketBookArrays":
+        """
+        The concatenate function joins the arrays of several chunks of markets, padding the shallower ones with missing levels
+        """
+        if len(chunks) == 1:
+            return chunks[0]
+        levels = max((chunk.levels_qty for chunk in chunks), default=0)
+        runners_qty = sum(len(chunk.selection_ids) for chunk in chunks)
+        ticks = np.full((2, levels, runners_qty), MISSING_TICK, dtype=np.int16)
+        sizes = np.zeros((2, levels, runners_qty), dtype=np.float64)
+        runner_offsets, start = [np.zeros(1, dtype=np.int64)], 0
+        for chunk in chunks:
+            ticks[:, :chunk.levels_qty, start:start + len(chunk.selection_ids)] = chunk.ticks
+            sizes[:, :chunk.levels_qty, start:start + len(chunk.selection_ids)] = chunk.sizes
+            runner_offsets.append(chunk.runner_offsets[1:] + start)
+            start += len(chunk.selection_ids)
+        return cls(market_ids=[market_id for chunk in chunks for market_id in chunk.market_ids],
+                   total_matched=np.concatenate([chunk.total_matched for chunk in chunks]) if chunks else np.empty(0),
+                   runner_offsets=np.concatenate(runner_offsets), ticks=ticks, sizes=sizes,
+                   selection_ids=np.concatenate([chunk.selection_ids for chunk in chunks]) if chunks else np.empty(0, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.market_ids)
+
+    @property
+    def levels_qty(self) -> int:
+        return self.ticks.shape[1]
+
+    @property
+    def ladder_depths(self) -> np.ndarray:
+        """
+        (2, runners) number of levels of each runner on the back and lay sides
+        """
+        return (self.ticks != MISSING_TICK).sum(axis=1)
+
+    def get_market_number(self, market_id : str) -> int:
+        if self._market_numbers is None:
+            self._market_numbers = {market_id: market_number for market_number, market_id in enumerate(self.market_ids)}
+        return self._market_numbers[market_id]
+
+    def get_selection_ids(self, market_number : int) -> List[int]:
+        return self.selection_ids[self.runner_offsets[market_number]:self.runner_offsets[market_number + 1]].tolist()
+
+    def get_book(self, market_number : int, orderbook_levels : Union[int, None] = None,
+                 selection_ids : Union[List[int], None] = None) -> BookNormalized:
+        """
+        The get_book function returns the BookNormalized of one market, with NaN prices (and a size of 0) for the missing levels,
+        the levels beyond the decoded ones and the selection_ids that are not in the book. Without orderbook_levels, the book has
+        the depth of the deepest ladder of the market.
+        """
+        start, end = self.runner_offsets[market_number], self.runner_offsets[market_number + 1]
+        book_selection_ids = self.get_selection_ids(market_number)
+        ticks, sizes = self.ticks[:, :, start:end], self.sizes[:, :, start:end]
+        if orderbook_levels is None:
+            orderbook_levels = int((ticks != MISSING_TICK).sum(axis=1).max(initial=0))
+        decoded_levels = min(orderbook_levels, self.levels_qty)
+
+        selection_ids = book_selection_ids if selection_ids is None else list(selection_ids)
+        data = np.empty((4, orderbook_levels, len(selection_ids)), dtype=np.float64)
+        if selection_ids == book_selection_ids and decoded_levels == orderbook_levels:
+            # Every level is decoded: no fill, one lookup for the prices of both sides
+            prices = PRICES_BY_TICK.take(ticks[:, :orderbook_levels])
+            data[BACK_PRICES], data[BACK_SIZES] = prices[0], sizes[0, :orderbook_levels]
+            data[LAY_PRICES], data[LAY_SIZES] = prices[1], sizes[1, :orderbook_levels]
+            return BookNormalized.from_array(market_id=self.market_ids[market_number], data=data, selection_ids=selection_ids)
+
+        data[[BACK_PRICES, LAY_PRICES]] = np.nan
+        data[[BACK_SIZES, LAY_SIZES]] = 0
+        if selection_ids == book_selection_ids:
+            selection_numbers, runners = slice(None), slice(None)
+        else:
+            positions = {selection_id: idx for idx, selection_id in enumerate(book_selection_ids)}
+            columns = [(selection_number, positions[selection_id]) for selection_number, selection_id in enumerate(selection_ids) if selection_id in positions]
+            selection_numbers, runners = ([column[0] for column in columns], [column[1] for column in columns])
+        for side, (price_idx, size_idx) in enumerate(((BACK_PRICES, BACK_SIZES), (LAY_PRICES, LAY_SIZES))):
+            data[price_idx][:decoded_levels, selection_numbers] = PRICES_BY_TICK[ticks[side][:decoded_levels, runners]]
+            data[size_idx][:decoded_levels, selection_numbers] = sizes[side][:decoded_levels, runners]
+        return BookNormalized.from_array(market_id=self.market_ids[market_number], data=data, selection_ids=selection_ids)
+
+    def get_runners(self, market_number : int) -> List[Runner]:
+        """
+        The get_runners function rebuilds the Runner objects of one market, with ladders in the listMarketBook format
+        """
+        runners = []
+        for runner in range(self.runner_offsets[market_number], self.runner_offsets[market_number + 1]):
+            ladders = []
+            for side in range(2):
+                depth = int((self.ticks[side, :, runner] != MISSING_TICK).sum())
+                ladders.append([{"price": price, "size": size} for price, size in
+                                zip(PRICES_BY_TICK[self.ticks[side, :depth, runner]].tolist(), self.sizes[side, :depth, runner].tolist())])
+            runners.append(Runner(int(self.selection_ids[runner]), ladders[0], ladders[1]))
+        return runners
+
+
+class DecodedMarket(Market):
+    """
+    Market backed by a MarketBookArrays: normalize reads its book from the decoded array,
+    and the Runner objects are only built the first time runners is read.
+    """
+    def __init__(self, market_id : str, start_time : float, volume_matched : float, book_arrays : MarketBookArrays, market_number : int):
+        self.market_id = market_id
+        self.start_time = start_time
+        self.volume_matched = volume_matched
+        self.book_arrays = book_arrays
+        self.market_number = market_number
+        self._runners = None
+
+    @property
+    def runners(self) -> List[Runner]:
+        if self._runners is None:
+            self._runners = self.book_arrays.get_runners(self.market_number)
+        return self._runners
+
+    def normalize(self, orderbook_levels : Union[int, None] = None, selection_ids : Union[List[int], None] = None) -> BookNormalized:
+        return self.book_arrays.get_book(self.market_number, orderbook_levels=orderbook_levels, selection_ids=selection_ids)
@@ -0,0 +1,139 @@
+import sqlite3
+import time
+import pandas as pd
+from collections import OrderedDict
+from typing import List, Dict, Union
+
+CATALOGUE_CACHE_SIZE = 20000
+STATIC_TTL = 6 * 3600  # marketStartTime
+VOLUME_TTL = 60  # totalMatched
+ZERO_VOLUME_TTL = 15 * 60  # totalMatched of the markets without volume, which are filtered out before their books are requested
+
+
+class MarketCatalogueCache:
+    """
+    LRU cache of the catalogue entries of the markets (marketStartTime and totalMatched), with one TTL per kind of field:
+    - static fields (marketStartTime, and start_time, its timestamp parsed once) expire after static_ttl
+    - totalMatched expires after volume_ttl. It is also refreshed for free from the market books (see update_volumes).
+      A totalMatched of 0 expires after zero_volume_ttl instead: those markets get no book request, so only the catalogue refreshes them
+    With a path, the entries are loaded from a SQLite snapshot on creation and written back by save,
+    so that a restart starts warm. TTLs are in wall-clock time, so they keep running across restarts.
+    save only writes the entries whose static fields changed and deletes the evicted ones: volume-only updates are not saved,
+    since totalMatched expires long before a restart is over.
+    """
+    def __init__(self, maxsize : int = CATALOGUE_CACHE_SIZE, static_ttl : float = STATIC_TTL, volume_ttl : float = VOLUME_TTL,
+                 path : Union[str, None] = None, zero_volume_ttl : float = ZERO_VOLUME_TTL):
+        self.maxsize = maxsize
+        self.static_ttl = static_ttl
+        self.volume_ttl = volume_ttl
+        self.zero_volume_ttl = zero_volume_ttl
+        self.path = path
+        self._entries = OrderedDict()  # market_id: [market_start_time, start_time, total_matched, static_updated, volume_updated]
+        self._changed = set()  # Market ids to write at the next save
+        self._removed = set()  # Market ids to delete at the next save
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, market_id : str) -> bool:
+        return market_id in self._entries
+
+    def get_stale(self, market_ids : List[str], now : Union[float, None] = None) -> List[str]:
+        """
+        The get_stale function returns the market ids that need a catalogue request: missing, or with an expired static field or totalMatched
+        """
+        now = time.time() if now is None else now
+        stale = []
+        for market_id in market_ids:
+            entry = self._entries.get(market_id)
+            if entry is None or now - entry[3] > self.static_ttl or now - entry[4] > (self.volume_ttl if entry[2] > 0 else self.zero_volume_ttl):
+                stale.append(market_id)
+        return stale
+
+    def get(self, market_ids : List[str]) -> Dict[str, dict]:
+        """
+        The get function returns the cached entries of market_ids in the list_market_catalogue format, plus start_time,
+        and marks them as recently used. Missing market ids are skipped, expiry is not checked (see get_stale).
+        """
+        catalogue = {}
+        for market_id in market_ids:
+            entry = self._entries.get(market_id)
+            if entry is not None:
+                self._entries.move_to_end(market_id)
+                catalogue[market_id] = {"marketId": market_id, "marketStartTime": entry[0], "start_time": entry[1], "totalMatched": entry[2]}
+        return catalogue
+
+    def update(self, market_catalogue : Dict[str, dict], now : Union[float, None] = None):
+        """
+        The update function stores fresh catalogue entries (marketId: {marketStartTime, totalMatched}).
+        """
+        now = time.time() if now is None else now
+        for market_id, market in market_catalogue.items():
+            entry = self._entries.get(market_id)
+            if entry is None or entry[0] != market["marketStartTime"]:
+                start_time = pd.to_datetime(market["marketStartTime"]).timestamp()
+            else:
+                start_time = entry[1]
+            self._entries[market_id] = [market["marketStartTime"], start_time, market["totalMatched"], now, now]
+            self._entries.move_to_end(market_id)
+            self._changed.add(market_id)
+            self._removed.discard(market_id)
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            market_id, _ = self._entries.popitem(last=False)
+            self._changed.discard(market_id)
+            self._removed.add(market_id)
+
+    def update_volumes(self, total_matched : Dict[str, float], now : Union[float, None] = None):
+        """
+        The update_volumes function refreshes totalMatched of cached markets, e.g. from the market books. It does not mark them for save
+        """
+        now = time.time() if now is None else now
+        for market_id, volume in total_matched.items():
+            entry = self._entries.get(market_id)
+            if entry is not None and volume is not None:
+                entry[2] = volume
+                entry[4] = now
+
+    def load(self):
+        with sqlite3.connect(self.path) as connection:
+            self._create_table(connection)
+            rows = connection.execute("SELECT market_id, market_start_time, start_time, total_matched, static_updated, volume_updated "
+                                      "FROM catalogue ORDER BY last_used").fetchall()
+        now = time.time()
+        for market_id, market_start_time, start_time, total_matched, static_updated, volume_updated in rows:
+            if now - static_updated <= self.static_ttl:
+                self._entries[market_id] = [market_start_time, start_time, total_matched, static_updated, volume_updated]
+            else:
+                self._removed.add(market_id)
+        self._evict()
+
+    def save(self):
+        """
+        The save function writes the entries updated since the last load or save to the SQLite snapshot, and deletes the evicted ones.
+        last_used is the time of the save, so that load restores the entries in the order they were last updated
+        """
+        if self.path is None or not (self._changed or self._removed):
+            return
+        last_used = time.time()
+        with sqlite3.connect(self.path) as connection:
+            self._create_table(connection)
+            connection.executemany("DELETE FROM catalogue WHERE market_id = ?", [(market_id,) for market_id in self._removed])
+            connection.executemany("INSERT OR REPLACE INTO catalogue VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   [(market_id, *self._entries[market_id], last_used) for market_id in self._entries if market_id in self._changed])
+        self._changed.clear()
+        self._removed.clear()
+
+    @staticmethod
+    def _create_table(connection : sqlite3.Connection):
+        connection.execute("CREATE TABLE IF NOT EXISTS catalogue (market_id TEXT PRIMARY KEY, market_start_time TEXT, start_time REAL, "
+                           "total_matched REAL, static_updated REAL, volume_updated REAL, last_used REAL)")
+
+    def clear(self):
+        self._removed.update(self._entries)
+        self._changed.clear()
+        self._entries.clear()
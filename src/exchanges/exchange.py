@@ -2,8 +2,11 @@
 from abc import ABC, abstractmethod
 from src.utils import Order
 from typing import List, Union
+import numpy as np
 from numpy import array, array_equal
 
+BACK_PRICES, BACK_SIZES, LAY_PRICES, LAY_SIZES = range(4)
+
 class BookNormalized:
     def __init__(self, market_id : str, back_prices : List[array], back_sizes : List[array], lay_prices : List[array], lay_sizes: List[array], selection_ids : List[int]):
         """
@@ -42,16 +45,67 @@ class BookNormalized:
                 [array([2982.1, 23428.33, 5420.45]), array([3362.47, 18059.1, 3651.42])]        <- lay sizes
             )
 
+        Internally, the four lists are stored as a single contiguous (4, levels, selections) float64 array (see from_array and data),
+        and back_prices, back_sizes, lay_prices and lay_sizes are read-only (levels, selections) views of it.
+        They can still be used as lists of arrays: book.back_prices[level], len(book.back_prices), iteration...
+
+        A missing level (a shallower ladder than the book, or a selection without offers) has a NaN price and a size of 0.
+        back_mask and lay_mask tell the levels that exist.
+
         :return: The object itself
         """
+        data = np.empty((4, len(back_prices), len(selection_ids)), dtype=np.float64)
+        for idx, levels in enumerate((back_prices, back_sizes, lay_prices, lay_sizes)):
+            if len(levels) > 0:
+                data[idx] = levels
+        self._init(market_id=market_id, data=data, selection_ids=selection_ids)
+
+    @classmethod
+    def from_array(cls, market_id : str, data : np.ndarray, selection_ids : List[int]) -> "BookNormalized":
+        """
+        The from_array function builds a BookNormalized directly from a (4, levels, selections) array
+        stacking back prices, back sizes, lay prices and lay sizes. The array is not copied if it is already a float64 array.
 
+        :param market_id: Uniquely identify the market
+        :param data:np.ndarray: (4, levels, selections) array
+        :param selection_ids:List[int]: Store the selection ids for each runner in the market
+        :return: The BookNormalized
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim != 3 or data.shape[0] != 4 or data.shape[2] != len(selection_ids):
+            raise Exception(f"data must have shape (4, levels, {len(selection_ids)}), got {data.shape}")
+        book = cls.__new__(cls)
+        book._init(market_id=market_id, data=data, selection_ids=selection_ids)
+        return book
+
+    def _init(self, market_id : str, data : np.ndarray, selection_ids : List[int]):
         self._market_id = market_id
         self._selection_ids = selection_ids
-        self._back_prices, self._back_sizes, self._lay_prices, self._lay_sizes = back_prices, back_sizes, lay_prices, lay_sizes
-        self._levels_qty = len(self._back_prices)
+        # Read-only view, so the caller's array keeps its flags but nothing can be edited through the book
+        self._data = data.view()
+        self._data.flags.writeable = False
+        self._levels_qty = data.shape[1]
         self._selections_qty = len(self._selection_ids)
 
-    #TODO : Find a way to protect all these attributes from being eddited
+    def slice(self, levels : Union[int, slice, None] = None, selection_ids : Union[List[int], None] = None) -> "BookNormalized":
+        """
+        The slice function returns a BookNormalized restricted to a subset of levels and/or selections.
+        The result shares memory with this book unless selection_ids are not contiguous in it.
+
+        :param levels:Union[int, slice]: Number of levels to keep from level 0, or a slice of levels
+        :param selection_ids:List[int]: Selection ids to keep, in the order they should appear
+        :return: The sliced BookNormalized
+        """
+        levels = slice(None) if levels is None else slice(levels) if isinstance(levels, int) else levels
+        if selection_ids is None:
+            selections = slice(None)
+            selection_ids = self._selection_ids
+        else:
+            positions = {selection_id: idx for idx, selection_id in enumerate(self._selection_ids)}
+            idx = [positions[selection_id] for selection_id in selection_ids]
+            contiguous = len(idx) > 0 and idx == list(range(idx[0], idx[0] + len(idx)))
+            selections = slice(idx[0], idx[0] + len(idx)) if contiguous else idx
+        return BookNormalized.from_array(market_id=self._market_id, data=self._data[:, levels, selections], selection_ids=list(selection_ids))
 
     @property
     def market_id(self) -> str:
@@ -62,19 +116,37 @@ class BookNormalized:
         return self._selection_ids
 
     @property
-    def back_prices(self) -> List[array]:
-        return self._back_prices
+    def data(self) -> np.ndarray:
+        return self._data
+
+    @property
+    def back_prices(self) -> np.ndarray:
+        return self._data[BACK_PRICES]
     @property
-    def back_sizes(self) -> List[array]:
-        return self._back_sizes
+    def back_sizes(self) -> np.ndarray:
+        return self._data[BACK_SIZES]
 
     @property
-    def lay_prices(self) -> List[array]:
-        return self._lay_prices
+    def lay_prices(self) -> np.ndarray:
+        return self._data[LAY_PRICES]
+
+    @property
+    def lay_sizes(self) -> np.ndarray:
+        return self._data[LAY_SIZES]
+    @property
+    def back_mask(self) -> np.ndarray:
+        """
+        (levels, selections) boolean array, True where the back level exists
+        """
+        return ~np.isnan(self._data[BACK_PRICES])
 
     @property
-    def lay_sizes(self) -> List[array]:
-        return self._lay_sizes
+    def lay_mask(self) -> np.ndarray:
+        """
+        (levels, selections) boolean array, True where the lay level exists
+        """
+        return ~np.isnan(self._data[LAY_PRICES])
+
     @property
     def levels_qty(self) -> int:
         return self._levels_qty
@@ -84,14 +156,8 @@ class BookNormalized:
         return self._selections_qty
 
     def __eq__(self, other : "BookNormalized"):
-        return len(self.back_prices) == len(other.back_prices) and \
-            len(self.back_sizes) == len(other.back_sizes) and \
-            len(self.lay_prices) == len(other.lay_prices) and \
-            len(self.lay_sizes) == len(other.lay_sizes) and \
-            all(array_equal(self.back_prices[i], other.back_prices[i]) for i in range(len(self.back_prices))) and \
-            all(array_equal(self.back_sizes[i], other.back_sizes[i]) for i in range(len(self.back_sizes))) and \
-            all(array_equal(self.lay_prices[i], other.lay_prices[i]) for i in range(len(self.lay_prices))) and \
-            all(array_equal(self.lay_sizes[i], other.lay_sizes[i]) for i in range(len(self.lay_sizes)))
+        # Missing levels are NaN, and equal in both books
+        return array_equal(self._data, other.data, equal_nan=True)
 
 class Exchange(ABC):
     @abstractmethod
@@ -0,0 +1,157 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+from typing import List, Dict, Union
+from src.exchanges.betfair import Betfair
+from src.exchanges.ticks import TICK_PRICES, TICKS_QTY, price_to_tick
+
+FAKE_EVENT_TYPE_ID = "1"
+FAKE_MARKET_TYPES = ["MATCH_ODDS", "BOTH_TEAMS_TO_SCORE", "OVER_UNDER_25"]
+FAKE_ALL_OFFERS_DEPTH = 30  # Levels per side of the ladders returned for EX_ALL_OFFERS
+
+
+def _iso(timestamp : float) -> str:
+    return pd.Timestamp(timestamp, unit="s", tz="UTC").strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class FakeBettingEndpoint:
+    """
+    In-memory stand-in of betfairlightweight's betting endpoint, answering in the lightweight format.
+    Each list_market_book call moves the prices of the requested markets by a small seeded random walk.
+    The ladders are on the Betfair ticks, one tick apart, with the depth of the price projection.
+    """
+    def __init__(self, markets_qty : int, orders_qty : int, seed : int, price_volatility : float):
+        self.rng = np.random.default_rng(seed)
+        self.price_volatility = price_volatility
+        now = time.time()
+        self.catalogue = {}
+        self.fair_probs = {}
+        for i in range(markets_qty):
+            market_id = f"1.{200000000 + i}"
+            market_type = FAKE_MARKET_TYPES[i % len(FAKE_MARKET_TYPES)]
+            selections_qty = 3 if market_type == "MATCH_ODDS" else 2
+            self.catalogue[market_id] = {"marketId": market_id, "marketType": market_type, "eventTypeId": FAKE_EVENT_TYPE_ID,
+                                         "marketStartTime": _iso(now + 3600 * (1 + i % 48)),
+                                         "totalMatched": float(np.round(self.rng.uniform(0, 1e5), 2))}
+            self.fair_probs[market_id] = self.rng.dirichlet(np.ones(selections_qty) * 2)
+
+        market_ids = list(self.catalogue)
+        self._current_orders_cache = (None, [])
+        self.orders = []
+        for bet_id in range(orders_qty):
+            market_id = market_ids[self.rng.integers(len(market_ids))]
+            selection_number = int(self.rng.integers(len(self.fair_probs[market_id])))
+            price = float(np.round(1 / self.fair_probs[market_id][selection_number] * self.rng.uniform(0.9, 1.1), 2))
+            size = float(np.round(self.rng.uniform(2, 50), 2))
+            size_matched = float(np.round(size * self.rng.choice([0, 0.5, 1], p=[0.2, 0.2, 0.6]), 2))
+            self.orders.append({"betId": str(10 ** 11 + bet_id), "marketId": market_id, "selectionId": 100 + selection_number,
+                                "priceSize": {"price": max(price, 1.01), "size": size}, "side": "BACK" if self.rng.random() < 0.5 else "LAY",
+                                "sizeMatched": size_matched, "sizeRemaining": float(np.round(size - size_matched, 2)),
+                                "placedDate": _iso(now - 60), "matchedDate": _iso(now - 60) if size_matched > 0 else None})
+
+    def list_market_catalogue(self, filter : Dict, lightweight : bool = True, max_results : int = 1000, market_projection : List[str] = None) -> List[dict]:
+        catalogue = list(self.catalogue.values())
+        if filter.get("marketIds") is not None:
+            catalogue = [self.catalogue[market_id] for market_id in filter["marketIds"] if market_id in self.catalogue]
+        if filter.get("eventTypeIds") is not None:
+            catalogue = [x for x in catalogue if x["eventTypeId"] in [str(y) for y in filter["eventTypeIds"]]]
+        if filter.get("marketTypeCodes") is not None:
+            catalogue = [x for x in catalogue if x["marketType"] in filter["marketTypeCodes"]]
+        return [dict(x) for x in catalogue[:max_results]]
+
+    def _move_prices(self, market_id : str) -> np.ndarray:
+        probs = self.fair_probs[market_id] * np.exp(self.rng.normal(0, self.price_volatility, len(self.fair_probs[market_id])))
+        probs = probs / probs.sum()
+        self.fair_probs[market_id] = probs
+        return probs
+
+    def list_market_book(self, market_ids : List[str], price_projection : Dict = None, lightweight : bool = True) -> List[dict]:
+        books = []
+        for market_id in market_ids:
+            if market_id not in self.catalogue:
+                continue
+            probs = self._move_prices(market_id)
+            if "EX_ALL_OFFERS" in (price_projection or {}).get("priceData", ()):
+                depth = FAKE_ALL_OFFERS_DEPTH
+            else:
+                depth = ((price_projection or {}).get("exBestOffersOverrides") or {}).get("bestPricesDepth", 3)
+            back_ticks = price_to_tick(np.maximum(1.01, 1 / (probs * 1.02))).astype(int)
+            lay_ticks = np.maximum(back_ticks + 1, price_to_tick(np.minimum(1000, 1 / (probs * 0.98))))
+            runners = []
+            for selection_number in range(len(probs)):
+                # Each deeper level is one tick further from the best price, down to the ends of the ladder
+                back_ladder = TICK_PRICES[back_ticks[selection_number] - np.arange(min(depth, back_ticks[selection_number] + 1))].tolist()
+                lay_ladder = TICK_PRICES[lay_ticks[selection_number] + np.arange(max(0, min(depth, TICKS_QTY - lay_ticks[selection_number])))].tolist()
+                back_sizes, lay_sizes = np.round(self.rng.uniform(10, 500, (2, depth)), 2).tolist()
+                runners.append({"selectionId": 100 + selection_number, "status": "ACTIVE",
+                                "ex": {"availableToBack": [{"price": price, "size": size} for price, size in zip(back_ladder, back_sizes)],
+                                       "availableToLay": [{"price": price, "size": size} for price, size in zip(lay_ladder, lay_sizes)]}})
+            books.append({"marketId": market_id, "status": "OPEN", "totalMatched": self.catalogue[market_id]["totalMatched"], "runners": runners})
+        return books
+
+    def _get_current_orders(self, bet_ids : Union[List[str], None], market_ids : Union[List[str], None], order_projection : Union[str, None],
+                            order_by : Union[str, None], date_range : Union[Dict, None]) -> List[dict]:
+        """
+        The orders matching the filters of listCurrentOrders, kept for the next pages of the same listing
+        """
+        date_from = (date_range or {}).get("from")
+        key = (id(self.orders), len(self.orders), tuple(bet_ids) if bet_ids is not None else None,
+               tuple(market_ids) if market_ids is not None else None, order_projection, order_by, date_from)
+        cached_key, orders = self._current_orders_cache
+        if cached_key == key:
+            return orders
+
+        orders = self.orders
+        if bet_ids is not None:
+            bet_ids = set(bet_ids)
+            orders = [x for x in orders if x["betId"] in bet_ids]
+        if market_ids is not None:
+            market_ids = set(market_ids)
+            orders = [x for x in orders if x["marketId"] in market_ids]
+        if order_projection == "EXECUTABLE":
+            orders = [x for x in orders if x["sizeRemaining"] > 0]
+        if date_from:
+            field = "matchedDate" if order_by == "BY_MATCH_TIME" else "placedDate"
+            orders = [x for x in orders if x[field] is not None and x[field] >= date_from]
+        self._current_orders_cache = (key, orders)
+        return orders
+
+    def list_current_orders(self, from_record : int = 0, record_count : int = 1000, lightweight : bool = True, bet_ids : List[str] = None,
+                            market_ids : List[str] = None, order_projection : str = None, order_by : str = None, date_range : Dict = None,
+                            **kwargs) -> Dict:
+        orders = self._get_current_orders(bet_ids, market_ids, order_projection, order_by, date_range)
+        return {"currentOrders": [dict(x) for x in orders[from_record: from_record + record_count]],
+                "moreAvailable": from_record + record_count < len(orders)}
+
+
+class FakeTrading:
+    """
+    Stand-in of betfairlightweight.APIClient with the endpoints used by Betfair and the dashboard
+    """
+    def __init__(self, markets_qty : int, orders_qty : int, seed : int, price_volatility : float, available_to_bet_balance : float):
+        self.betting = FakeBettingEndpoint(markets_qty, orders_qty, seed, price_volatility)
+        self.account = SimpleNamespace(get_account_funds=lambda: SimpleNamespace(available_to_bet_balance=available_to_bet_balance))
+
+    def keep_alive(self):
+        pass
+
+
+class FakeBetfair(Betfair):
+    """
+    Betfair adapter backed by seeded in-memory markets and orders instead of the API, to run the dashboard pipeline locally.
+    Two instances with the same seed see the same markets and orders.
+    """
+    def __init__(self, markets_qty : int = 50, orders_qty : int = 500, seed : int = 0, price_volatility : float = 0.01,
+                 available_to_bet_balance : float = 1000.0):
+        self.fake_config = dict(markets_qty=markets_qty, orders_qty=orders_qty, seed=seed, price_volatility=price_volatility,
+                                available_to_bet_balance=available_to_bet_balance)
+
+    def login(self):
+        self.trading = FakeTrading(**self.fake_config)
+
+    def _list_market_book_raw(self, market_ids : List[str], price_projection : Dict) -> bytes:
+        # Same JSON-RPC body as the API, so that the books go through the same decoding
+        books = self.trading.betting.list_market_book(market_ids=market_ids, price_projection=price_projection, lightweight=True)
+        return json.dumps({"jsonrpc": "2.0", "result": books, "id": 1}).encode()
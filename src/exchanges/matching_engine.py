@@ -0,0 +1,287 @@
+import itertools
+import threading
+import time
+from collections import deque
+from typing import List, Dict, Tuple, Union
+import numpy as np
+from src.exchanges.ticks import TICK_PRICES, TICKS_QTY, price_to_tick
+from src.utils_orders import MIN_STAKE
+
+SIDES = ("BACK", "LAY")
+BACK, LAY = range(2)
+PERSISTENCE_TYPES = ("LAPSE", "PERSIST")
+SIZE_EPSILON = 0.005  # Sizes are in pennies: anything below is a rounding residue
+
+
+def _iso(timestamp : float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + f".{int(timestamp * 1000) % 1000:03d}Z"
+
+
+class SimulatedOrder:
+    """
+    Limit order of the matching engine. Orders of the account are listed by listCurrentOrders,
+    the other ones (account=False) are the liquidity of the rest of the market.
+    """
+    __slots__ = ("bet_id", "market_id", "selection_id", "side", "tick", "size", "persistence_type", "account", "placed_at", "matched_at",
+                 "size_matched", "matched_value", "size_cancelled", "size_lapsed")
+
+    def __init__(self, bet_id : str, market_id : str, selection_id : int, side : str, tick : int, size : float, persistence_type : str,
+                 account : bool, placed_at : float):
+        self.bet_id = bet_id
+        self.market_id = market_id
+        self.selection_id = selection_id
+        self.side = side
+        self.tick = tick
+        self.size = size
+        self.persistence_type = persistence_type
+        self.account = account
+        self.placed_at = placed_at
+        self.matched_at = None
+        self.size_matched = 0.0
+        self.matched_value = 0.0
+        self.size_cancelled = 0.0
+        self.size_lapsed = 0.0
+
+    @property
+    def price(self) -> float:
+        return float(TICK_PRICES[self.tick])
+
+    @property
+    def size_remaining(self) -> float:
+        return round(self.size - self.size_matched - self.size_cancelled - self.size_lapsed, 2)
+
+    @property
+    def average_price_matched(self) -> float:
+        return round(self.matched_value / self.size_matched, 2) if self.size_matched > 0 else 0.0
+
+    def fill(self, size : float, price : float, matched_at : float):
+        self.size_matched = round(self.size_matched + size, 2)
+        self.matched_value += size * price
+        self.matched_at = matched_at
+
+    def to_current_order(self) -> dict:
+        """
+        The order in the lightweight listCurrentOrders format
+        """
+        size_remaining = self.size_remaining
+        return {"betId": self.bet_id, "marketId": self.market_id, "selectionId": self.selection_id, "handicap": 0.0,
+                "priceSize": {"price": self.price, "size": self.size}, "bspLiability": 0.0, "side": self.side,
+                "status": "EXECUTABLE" if size_remaining > 0 else "EXECUTION_COMPLETE", "persistenceType": self.persistence_type,
+                "orderType": "LIMIT", "placedDate": _iso(self.placed_at), "matchedDate": _iso(self.matched_at) if self.matched_at is not None else None,
+                "averagePriceMatched": self.average_price_matched, "sizeMatched": self.size_matched, "sizeRemaining": size_remaining,
+                "sizeLapsed": self.size_lapsed, "sizeCancelled": self.size_cancelled, "sizeVoided": 0.0, "regulatorCode": "SIMULATED"}
+
+
+class RunnerBook:
+    """
+    Resting orders of one runner: for each side, a FIFO queue of orders per tick, so orders match by price then time priority,
+    and the unmatched size resting at each tick, which is the ladder published by listMarketBook.
+    Resting LAY orders are the prices available to back, and resting BACK orders the prices available to lay.
+    """
+    def __init__(self):
+        self.queues = ({}, {})  # side: {tick: deque of SimulatedOrder}
+        self.sizes = np.zeros((2, TICKS_QTY), dtype=np.float64)
+
+    def get_matching_ticks(self, side : int, tick : int) -> np.ndarray:
+        """
+        The ticks of the resting orders an incoming order of side at tick matches, best price first:
+        a BACK matches the lays at its price or higher, a LAY the backs at its price or lower
+        """
+        if side == BACK:
+            return np.flatnonzero(self.sizes[LAY, tick:] > SIZE_EPSILON)[::-1] + tick
+        return np.flatnonzero(self.sizes[BACK, :tick + 1] > SIZE_EPSILON)
+
+    def match(self, order : SimulatedOrder, side : int, matched_at : float) -> List[Tuple[SimulatedOrder, float, float]]:
+        """
+        The match function fills order against the resting orders it crosses, at their price, and returns the (resting order, size, price)
+        of each fill. The resting orders that are filled leave the book.
+        """
+        fills = []
+        opposite = 1 - side
+        for tick in self.get_matching_ticks(side, order.tick):
+            queue = self.queues[opposite][tick]
+            price = float(TICK_PRICES[tick])
+            while queue and order.size_remaining > 0:
+                resting = queue[0]
+                size = min(resting.size_remaining, order.size_remaining)
+                resting.fill(size, price, matched_at)
+                order.fill(size, price, matched_at)
+                self.sizes[opposite, tick] -= size
+                fills.append((resting, size, price))
+                if resting.size_remaining <= 0:
+                    queue.popleft()
+            if not queue:
+                del self.queues[opposite][tick]
+                self.sizes[opposite, tick] = 0
+            if order.size_remaining <= 0:
+                break
+        return fills
+
+    def add(self, order : SimulatedOrder, side : int):
+        self.queues[side].setdefault(order.tick, deque()).append(order)
+        self.sizes[side, order.tick] += order.size_remaining
+
+    def reduce(self, order : SimulatedOrder, side : int, size : float):
+        """
+        Takes size off the resting order, which keeps its place in the queue unless nothing is left
+        """
+        self.sizes[side, order.tick] = max(0.0, self.sizes[side, order.tick] - size)
+        if order.size_remaining <= 0:
+            queue = self.queues[side][order.tick]
+            queue.remove(order)
+            if not queue:
+                del self.queues[side][order.tick]
+                self.sizes[side, order.tick] = 0
+
+    def get_ladder(self, side : int, depth : Union[int, None]) -> List[Dict[str, float]]:
+        """
+        The ladder of the resting orders of side, best price first, in the listMarketBook format
+        """
+        ticks = np.flatnonzero(self.sizes[side] > SIZE_EPSILON)
+        if side == LAY:
+            ticks = ticks[::-1]
+        ticks = ticks[:depth]
+        return [{"price": price, "size": size} for price, size in zip(TICK_PRICES[ticks].tolist(), np.round(self.sizes[side, ticks], 2).tolist())]
+
+
+class SimulatedMarket:
+    """
+    Runner books of one market, and its status. The lock serializes the instructions of the market,
+    while the other markets are matched concurrently.
+    """
+    def __init__(self, market_id : str, selection_ids : List[int], total_matched : float = 0.0):
+        self.market_id = market_id
+        self.runners = {selection_id: RunnerBook() for selection_id in selection_ids}
+        self.total_matched = total_matched
+        self.in_play = False
+        self.orders = {}  # bet_id: SimulatedOrder, resting or of the account
+        self.lock = threading.RLock()
+
+
+class MatchingEngine:
+    """
+    In-memory limit order books of many markets, matched with price-time priority per runner, as the Betfair exchange does
+    for limit orders: an order is matched at the price of the resting orders it crosses, best price first and then oldest first,
+    and its unmatched size rests in the book at its own price. Cross-matching between runners and Betfair SP are not simulated.
+
+    Unmatched LAPSE orders lapse when their market turns in play (see turn_in_play), PERSIST orders stay in the book.
+    The methods return the Betfair instruction error code of a failed instruction, as the API does.
+    """
+    def __init__(self):
+        self.markets : Dict[str, SimulatedMarket] = {}
+        self._bet_ids = itertools.count(10 ** 11)
+        self._version = itertools.count()
+        self.version = next(self._version)
+
+    def add_market(self, market_id : str, selection_ids : List[int], total_matched : float = 0.0) -> SimulatedMarket:
+        self.markets[market_id] = SimulatedMarket(market_id, selection_ids, total_matched=total_matched)
+        return self.markets[market_id]
+
+    def _touch(self):
+        # Bumped on each change of the orders, so that readers can cache what they built from them
+        self.version = next(self._version)
+
+    def place(self, market_id : str, selection_id : int, side : str, size : float, price : float, persistence_type : str = "LAPSE",
+              account : bool = True) -> Tuple[Union[SimulatedOrder, None], Union[str, None]]:
+        """
+        The place function matches a limit order against the book of its runner and rests its unmatched size.
+
+        :param account:bool: Whether the order is one of the account (listed by listCurrentOrders), or liquidity of the rest of the market
+        :return: (order, None), or (None, error code) if the instruction is rejected
+        """
+        market = self.markets.get(market_id)
+        if market is None:
+            return None, "INVALID_MARKET_ID"
+        runner = market.runners.get(selection_id)
+        if runner is None:
+            return None, "INVALID_RUNNER"
+        if side not in SIDES:
+            return None, "ERROR_IN_ORDER"
+        if persistence_type not in PERSISTENCE_TYPES:
+            return None, "INVALID_PERSISTENCE_TYPE"
+        if size is None or round(size, 2) != size or (account and size < MIN_STAKE) or size <= 0:
+            return None, "INVALID_BET_SIZE"
+        tick = int(price_to_tick(price)) if price is not None else None
+        if tick is None or abs(TICK_PRICES[tick] - price) > 1e-9:
+            return None, "INVALID_ODDS"
+
+        side_number = SIDES.index(side)
+        placed_at = time.time()
+        order = SimulatedOrder(str(next(self._bet_ids)), market_id, selection_id, side, tick, float(size), persistence_type, account, placed_at)
+        with market.lock:
+            fills = runner.match(order, side_number, placed_at)
+            for resting, size_filled, _ in fills:
+                if not resting.account and resting.size_remaining <= 0:
+                    del market.orders[resting.bet_id]
+            market.total_matched += sum(size_filled for _, size_filled, _ in fills)
+            if order.size_remaining > 0:
+                runner.add(order, side_number)
+            if account or order.size_remaining > 0:
+                market.orders[order.bet_id] = order
+            self._touch()
+        return order, None
+
+    def cancel(self, market_id : str, bet_id : str, size_reduction : Union[float, None] = None) -> Tuple[float, Union[str, None]]:
+        """
+        The cancel function cancels size_reduction of the unmatched size of an order, or all of it without size_reduction
+
+        :return: (size cancelled, None), or (0, error code) if the instruction is rejected
+        """
+        market = self.markets.get(market_id)
+        if market is None:
+            return 0.0, "INVALID_MARKET_ID"
+        with market.lock:
+            order = market.orders.get(bet_id)
+            if order is None:
+                return 0.0, "INVALID_BET_ID"
+            size_remaining = order.size_remaining
+            if size_remaining <= 0:
+                return 0.0, "BET_TAKEN_OR_LAPSED"
+            if size_reduction is not None and (size_reduction <= 0 or size_reduction > size_remaining):
+                return 0.0, "INVALID_BET_SIZE"
+            size_cancelled = size_remaining if size_reduction is None else round(size_reduction, 2)
+            order.size_cancelled = round(order.size_cancelled + size_cancelled, 2)
+            market.runners[order.selection_id].reduce(order, SIDES.index(order.side), size_cancelled)
+            if not order.account and order.size_remaining <= 0:
+                del market.orders[bet_id]
+            self._touch()
+        return size_cancelled, None
+
+    def get_order(self, market_id : str, bet_id : str) -> Union[SimulatedOrder, None]:
+        market = self.markets.get(market_id)
+        return market.orders.get(bet_id) if market is not None else None
+
+    def turn_in_play(self, market_id : str) -> int:
+        """
+        The turn_in_play function marks the market in play, and lapses the unmatched size of its LAPSE orders
+
+        :return: The number of orders lapsed
+        """
+        market = self.markets[market_id]
+        lapsed = 0
+        with market.lock:
+            market.in_play = True
+            for bet_id, order in list(market.orders.items()):
+                size_remaining = order.size_remaining
+                if order.persistence_type == "LAPSE" and size_remaining > 0:
+                    order.size_lapsed = round(order.size_lapsed + size_remaining, 2)
+                    market.runners[order.selection_id].reduce(order, SIDES.index(order.side), size_remaining)
+                    if not order.account:
+                        del market.orders[bet_id]
+                    lapsed += 1
+            self._touch()
+        return lapsed
+
+    def get_account_orders(self, market_ids : Union[List[str], None] = None) -> List[SimulatedOrder]:
+        """
+        The orders of the account in market_ids (all the markets if None), oldest first by market,
+        without the ones that were cancelled or lapsed before any match, which Betfair does not list either
+        """
+        orders = []
+        for market_id in (self.markets if market_ids is None else market_ids):
+            market = self.markets.get(market_id)
+            if market is None:
+                continue
+            with market.lock:
+                orders.extend(order for order in market.orders.values() if order.account and (order.size_matched > 0 or order.size_remaining > 0))
+        return orders
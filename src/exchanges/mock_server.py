@@ -0,0 +1,107 @@
+import asyncio
+from aiohttp import web
+from typing import List, Dict, Union
+
+
+class MockBetfairServer:
+    """
+    Local stand-in of the Betfair login and JSON-RPC endpoints, serving in-memory data, for tests of AsyncBetfair without network:
+
+        async with MockBetfairServer(market_catalogue=..., market_books=..., current_orders=...) as server:
+            async with AsyncBetfair(**server.urls, session_token="token", app_key="key") as trading:
+                markets = await trading.get_markets(None, None, 0, market_ids)
+
+    Supported methods: listMarketCatalogue (by marketIds or eventTypeIds x marketTypeCodes), listMarketBook, listCurrentOrders
+    (paginated) and getAccountFunds. Every response waits `latency` seconds, and the number of requests and the maximum of
+    simultaneous requests are recorded, so tests can check that calls overlap.
+    """
+    def __init__(self, market_catalogue : Union[List[dict], None] = None, market_books : Union[List[dict], None] = None,
+                 current_orders : Union[List[dict], None] = None, account_funds : Union[Dict, None] = None, latency : float = 0):
+        """
+        :param market_catalogue:List[dict]: Catalogue entries, with marketId, marketStartTime, totalMatched, and eventTypeId/marketType for filtering
+        :param market_books:List[dict]: Market books in the listMarketBook format
+        :param current_orders:List[dict]: Orders in the listCurrentOrders format
+        :param account_funds:Dict: getAccountFunds result
+        """
+        self.market_catalogue = market_catalogue or []
+        self.market_books = {book["marketId"]: book for book in market_books or []}
+        self.current_orders = current_orders or []
+        self.account_funds = account_funds or {"availableToBetBalance": 0.0, "exposure": 0.0}
+        self.latency = latency
+        self.requests = {}
+        self.max_concurrency = 0
+        self._concurrency = 0
+        self._runner = None
+        self.base_url = None
+
+    @property
+    def urls(self) -> Dict[str, str]:
+        return {"login_url": self.base_url + "/api/certlogin", "betting_url": self.base_url + "/exchange/betting/json-rpc/v1",
+                "account_url": self.base_url + "/exchange/account/json-rpc/v1"}
+
+    async def start(self, host : str = "127.0.0.1", port : int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/api/certlogin", self._login)
+        app.router.add_post("/exchange/betting/json-rpc/v1", self._rpc)
+        app.router.add_post("/exchange/account/json-rpc/v1", self._rpc)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "MockBetfairServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _login(self, request : web.Request) -> web.Response:
+        return web.json_response({"sessionToken": "mock-session-token", "loginStatus": "SUCCESS"})
+
+    async def _rpc(self, request : web.Request) -> web.Response:
+        body = await request.json()
+        method = body["method"].split("/")[-1]
+        self.requests[method] = self.requests.get(method, 0) + 1
+        self._concurrency += 1
+        self.max_concurrency = max(self.max_concurrency, self._concurrency)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            handler = getattr(self, "_" + method, None)
+            if handler is None:
+                return web.json_response({"jsonrpc": "2.0", "id": body.get("id"), "error": {"code": -32601, "message": f"Unknown method {method}"}})
+            return web.json_response({"jsonrpc": "2.0", "id": body.get("id"), "result": handler(body.get("params", {}))})
+        finally:
+            self._concurrency -= 1
+
+    def _listMarketCatalogue(self, params : Dict) -> List[dict]:
+        market_filter = params.get("filter", {})
+        catalogue = self.market_catalogue
+        if "marketIds" in market_filter:
+            catalogue = [x for x in catalogue if x["marketId"] in market_filter["marketIds"]]
+        if "eventTypeIds" in market_filter:
+            catalogue = [x for x in catalogue if str(x.get("eventTypeId")) in [str(y) for y in market_filter["eventTypeIds"]]]
+        if "marketTypeCodes" in market_filter:
+            catalogue = [x for x in catalogue if x.get("marketType") in market_filter["marketTypeCodes"]]
+        return catalogue[:params.get("maxResults", 1000)]
+
+    def _listMarketBook(self, params : Dict) -> List[dict]:
+        return [self.market_books[market_id] for market_id in params["marketIds"] if market_id in self.market_books]
+
+    def _listCurrentOrders(self, params : Dict) -> Dict:
+        from_record = params.get("fromRecord", 0)
+        record_count = params.get("recordCount", 1000)
+        return {"currentOrders": self.current_orders[from_record: from_record + record_count],
+                "moreAvailable": from_record + record_count < len(self.current_orders)}
+
+    def _getAccountFunds(self, params : Dict) -> Dict:
+        return self.account_funds
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: tokens are added continuously at `rate` per second, up to `capacity`,
+    and acquire blocks until the requested tokens are available.
+    Used to keep the concurrent requests to an exchange under its data-weight (or request) limits.
+    """
+    def __init__(self, rate : float, capacity : float):
+        """
+        :param rate:float: Tokens added per second
+        :param capacity:float: Maximum tokens in the bucket, i.e. the largest burst allowed. Also the largest acquire allowed
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens : float = 1) -> float:
+        """
+        The acquire function takes tokens from the bucket, waiting for them if needed.
+
+        :param tokens:float: Tokens to take, capped at the capacity of the bucket
+        :return: The seconds waited
+        """
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self, tokens : float = 1) -> bool:
+        """
+        The try_acquire function takes tokens from the bucket only if they are available right away, without waiting
+
+        :return: Whether the tokens were taken
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    async def acquire_async(self, tokens : float = 1) -> float:
+        """
+        Same as acquire, waiting with asyncio.sleep so that the event loop keeps running other requests
+        """
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+            waited += wait
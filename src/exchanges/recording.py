@@ -0,0 +1,347 @@
+"""
+Record and replay of the exchange inputs of the dashboard, to reproduce a refresh offline.
+
+RecordingExchange wraps a Betfair adapter and appends the result of each get_markets, get_current_orders and get_account_funds call
+to Arrow IPC stream files, one record batch per call. ReplayExchange memory-maps these files and serves them back with the interface
+of Betfair, so that compute_snapshot, get_market_stats or Cashout can be run and profiled on a recorded day:
+
+    trading = RecordingExchange(trading, path="recordings/2022-12-03")       # live, e.g. BETFAIR_RECORD_PATH in the app
+    trading = ReplayExchange("recordings/2022-12-03", speed=60)              # offline, 60 times faster than recorded
+
+pyarrow is optional: it is only needed to record or replay.
+"""
+import glob
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import List, Dict, Union
+import numpy as np
+from src.utils import Market, split_matched_and_open
+from src.utils_orders import OrderTable, ORDER_COLUMNS
+from src.exchanges.exchange import Exchange, BookNormalized
+from src.exchanges.betfair import Betfair
+from src.exchanges.book_decoder import MarketBookArrays, DecodedMarket
+from src.exchanges.ticks import MISSING_TICK
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+RECORD_KINDS = ("markets", "orders", "funds")
+RECORD_SUFFIX = ".arrows"
+
+
+def _check_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required to record or replay exchange data")
+
+
+def get_record_schemas() -> Dict[str, "pa.Schema"]:
+    """
+    The get_record_schemas function returns the schema of the record files of each kind. The markets files have one row per runner,
+    with its ladders as lists of ticks (see ticks) and sizes from the best level.
+    """
+    _check_pyarrow()
+    order_types = {np.int64: pa.int64(), np.float64: pa.float64(), object: pa.string()}
+    return {
+        "markets": pa.schema([
+            ("market_id", pa.string()), ("start_time", pa.float64()), ("volume_matched", pa.float64()), ("total_matched", pa.float64()),
+            ("selection_id", pa.int64()), ("back_ticks", pa.list_(pa.int16())), ("back_sizes", pa.list_(pa.float64())),
+            ("lay_ticks", pa.list_(pa.int16())), ("lay_sizes", pa.list_(pa.float64())),
+        ]),
+        "orders": pa.schema([(column, order_types[dtype]) for column, dtype in ORDER_COLUMNS.items()]),
+        "funds": pa.schema([("available_to_bet_balance", pa.float64())]),
+    }
+
+
+def _ladder_lists(ticks : np.ndarray, sizes : np.ndarray) -> tuple:
+    """
+    The ticks and sizes of (levels, runners) ladders of one side as two list arrays with one entry per runner, without the missing levels
+    """
+    present = (ticks != MISSING_TICK).T
+    offsets = pa.array(np.concatenate(([0], np.cumsum(present.sum(axis=1)))).astype(np.int32))
+    return pa.ListArray.from_arrays(offsets, pa.array(ticks.T[present], type=pa.int16())), \
+        pa.ListArray.from_arrays(offsets, pa.array(sizes.T[present], type=pa.float64()))
+
+
+def _ladder_arrays(ticks_list : "pa.ListArray", sizes_list : "pa.ListArray", levels_qty : int) -> tuple:
+    """
+    Inverse of _ladder_lists: the (levels, runners) ticks and sizes of list arrays with one entry per runner
+    """
+    offsets = ticks_list.offsets.to_numpy()
+    depths = np.diff(offsets)
+    runners = np.repeat(np.arange(len(depths)), depths)
+    levels = np.arange(len(runners)) - np.repeat(offsets[:-1] - offsets[0], depths)
+    ticks = np.full((levels_qty, len(depths)), MISSING_TICK, dtype=np.int16)
+    sizes = np.zeros((levels_qty, len(depths)), dtype=np.float64)
+    ticks[levels, runners] = ticks_list.flatten().to_numpy()
+    sizes[levels, runners] = sizes_list.flatten().to_numpy()
+    return ticks, sizes
+
+
+def markets_to_columns(markets : List[Market]) -> Dict[str, "pa.Array"]:
+    """
+    The markets_to_columns function returns the columns of the markets record of markets, as returned by Betfair.get_markets.
+    The ladders of DecodedMarket objects are read from their arrays, the ones of other markets from their runners.
+    """
+    ticks, sizes, columns = [], [], {"market_id": [], "start_time": [], "volume_matched": [], "total_matched": [], "selection_id": []}
+    for market in markets:
+        if isinstance(market, DecodedMarket):
+            book_arrays, market_number = market.book_arrays, market.market_number
+        else:
+            book_arrays, market_number = MarketBookArrays.from_market_books([{
+                "marketId": market.market_id, "totalMatched": market.volume_matched,
+                "runners": [{"selectionId": runner.runner_id, "ex": {"availableToBack": runner.available_to_back, "availableToLay": runner.available_to_lay}}
+                            for runner in market.runners]}]), 0
+        start, end = book_arrays.runner_offsets[market_number], book_arrays.runner_offsets[market_number + 1]
+        ticks.append(book_arrays.ticks[:, :, start:end])
+        sizes.append(book_arrays.sizes[:, :, start:end])
+        columns["market_id"].extend([market.market_id] * (end - start))
+        columns["start_time"].extend([market.start_time] * (end - start))
+        columns["volume_matched"].extend([market.volume_matched] * (end - start))
+        columns["total_matched"].extend([book_arrays.total_matched[market_number]] * (end - start))
+        columns["selection_id"].extend(book_arrays.selection_ids[start:end].tolist())
+
+    levels_qty = max((market_ticks.shape[1] for market_ticks in ticks), default=0)
+    runners_qty = len(columns["selection_id"])
+    all_ticks = np.full((2, levels_qty, runners_qty), MISSING_TICK, dtype=np.int16)
+    all_sizes = np.zeros((2, levels_qty, runners_qty), dtype=np.float64)
+    start = 0
+    for market_ticks, market_sizes in zip(ticks, sizes):
+        all_ticks[:, :market_ticks.shape[1], start:start + market_ticks.shape[2]] = market_ticks
+        all_sizes[:, :market_sizes.shape[1], start:start + market_sizes.shape[2]] = market_sizes
+        start += market_ticks.shape[2]
+    columns["back_ticks"], columns["back_sizes"] = _ladder_lists(all_ticks[0], all_sizes[0])
+    columns["lay_ticks"], columns["lay_sizes"] = _ladder_lists(all_ticks[1], all_sizes[1])
+    return columns
+
+
+def columns_to_markets(batch : "pa.RecordBatch") -> List[DecodedMarket]:
+    """
+    Inverse of markets_to_columns: the DecodedMarket objects of a markets record, backed by one MarketBookArrays
+    """
+    market_id_column = np.asarray(batch.column("market_id").to_numpy(zero_copy_only=False), dtype=object)
+    # The runners of a market are contiguous rows
+    first_rows = np.flatnonzero(np.concatenate(([True], market_id_column[1:] != market_id_column[:-1]))) if len(market_id_column) else np.empty(0, dtype=np.int64)
+    depths = [np.diff(batch.column(column).offsets.to_numpy()) for column in ("back_ticks", "lay_ticks")]
+    levels_qty = int(max((depth.max(initial=0) for depth in depths), default=0))
+    back_ticks, back_sizes = _ladder_arrays(batch.column("back_ticks"), batch.column("back_sizes"), levels_qty)
+    lay_ticks, lay_sizes = _ladder_arrays(batch.column("lay_ticks"), batch.column("lay_sizes"), levels_qty)
+    book_arrays = MarketBookArrays(market_ids=market_id_column[first_rows].tolist(), total_matched=batch.column("total_matched").to_numpy()[first_rows],
+                                   runner_offsets=np.append(first_rows, len(market_id_column)).astype(np.int64),
+                                   selection_ids=batch.column("selection_id").to_numpy(), ticks=np.stack((back_ticks, lay_ticks)),
+                                   sizes=np.stack((back_sizes, lay_sizes)))
+    start_times, volumes = batch.column("start_time").to_numpy()[first_rows], batch.column("volume_matched").to_numpy()[first_rows]
+    market_catalogue = {market_id: {"start_time": start_time, "totalMatched": volume}
+                        for market_id, start_time, volume in zip(book_arrays.market_ids, start_times.tolist(), volumes.tolist())}
+    return Betfair.build_markets(market_catalogue, book_arrays)
+
+
+class RecordWriter:
+    """
+    Appends one record batch per call to an Arrow IPC stream file, with the time of the call (recorded_at) and how long it took (latency)
+    in the metadata of the batch, so that calls which returned nothing are recorded as well. The file is flushed after each batch,
+    so a recording cut short (e.g. the process was killed) can still be read up to its last complete call.
+    """
+    def __init__(self, path : str, schema : "pa.Schema"):
+        _check_pyarrow()
+        self.path = path
+        self.schema = schema
+        self._sink = pa.OSFile(path, "wb")
+        self._writer = pa.ipc.new_stream(self._sink, schema)
+        self._lock = threading.Lock()
+
+    def write(self, recorded_at : float, latency : float, columns : Dict[str, Union["pa.Array", np.ndarray, list]]):
+        arrays = [columns[field.name].cast(field.type) if isinstance(columns[field.name], pa.Array) else pa.array(columns[field.name], type=field.type)
+                  for field in self.schema]
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        with self._lock:
+            self._writer.write_batch(batch, custom_metadata={"recorded_at": repr(recorded_at), "latency": repr(latency)})
+            self._sink.flush()
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            self._sink.close()
+
+
+class _Proxy:
+    """
+    Attribute access to obj, except for the overridden attributes
+    """
+    def __init__(self, obj, **overrides):
+        self._obj = obj
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+
+class RecordingExchange(Exchange):
+    """
+    Wrapper of a Betfair adapter that records the result of each get_markets, get_current_orders and trading.account.get_account_funds call
+    in path (see ReplayExchange), and returns it unchanged. Every other attribute is the one of the wrapped exchange,
+    so it should be configured (catalogue_cache, start_streaming...) before being wrapped.
+    Each recorder writes its own files, named after the kind of call and its start time, so sessions can be recorded in the same directory.
+    """
+    def __init__(self, exchange : Betfair, path : str):
+        _check_pyarrow()
+        self.exchange = exchange
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        session = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        schemas = get_record_schemas()
+        self.writers = {kind: RecordWriter(os.path.join(path, f"{kind}-{session}{RECORD_SUFFIX}"), schemas[kind]) for kind in RECORD_KINDS}
+
+    def __getattr__(self, name):
+        return getattr(self.exchange, name)
+
+    def normalize_order(self, *args, **kwargs):
+        return self.exchange.normalize_order(*args, **kwargs)
+
+    def normalize_book(self, *args, **kwargs) -> BookNormalized:
+        return self.exchange.normalize_book(*args, **kwargs)
+
+    @property
+    def trading(self):
+        client = self.exchange.trading
+        return _Proxy(client, account=_Proxy(client.account, get_account_funds=self.get_account_funds))
+
+    def get_account_funds(self):
+        recorded_at = time.time()
+        account_funds = self.exchange.trading.account.get_account_funds()
+        self.writers["funds"].write(recorded_at, time.time() - recorded_at,
+                                    {"available_to_bet_balance": [account_funds.available_to_bet_balance]})
+        return account_funds
+
+    def get_markets(self, event_type_ids, market_type_codes, min_volume=1000, market_ids=None) -> List[Market]:
+        recorded_at = time.time()
+        markets = self.exchange.get_markets(event_type_ids, market_type_codes, min_volume=min_volume, market_ids=market_ids)
+        self.writers["markets"].write(recorded_at, time.time() - recorded_at, markets_to_columns(markets))
+        return markets
+
+    def get_current_orders(self, *args, **kwargs) -> OrderTable:
+        recorded_at = time.time()
+        current_orders = self.exchange.get_current_orders(*args, **kwargs)
+        self.writers["orders"].write(recorded_at, time.time() - recorded_at,
+                                     {column: current_orders.column(column) for column in ORDER_COLUMNS})
+        return current_orders
+
+    def get_matched_and_open_orders(self):
+        return split_matched_and_open(self.get_current_orders())
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def read_record_batches(path : str, kind : str) -> List[tuple]:
+    """
+    The read_record_batches function memory-maps the record files of kind in path, in the order they were recorded,
+    and returns (batch, recorded_at, latency) for each call. The batches are views of the mapped files, nothing is copied.
+    An incomplete last batch (the recording was cut short) is ignored.
+    """
+    _check_pyarrow()
+    records = []
+    for file_path in sorted(glob.glob(os.path.join(path, f"{kind}-*{RECORD_SUFFIX}"))):
+        reader = pa.ipc.open_stream(pa.memory_map(file_path, "r"))
+        while True:
+            try:
+                batch, metadata = reader.read_next_batch_with_custom_metadata()
+            except (StopIteration, pa.ArrowInvalid, OSError):
+                break
+            records.append((batch, float(metadata[b"recorded_at"]), float(metadata[b"latency"])))
+    return records
+
+
+class ReplayExchange(Exchange):
+    """
+    Exchange serving a recording of RecordingExchange instead of the API, with the interface used by the dashboard
+    (get_markets, get_current_orders, trading.account.get_account_funds, normalize_book).
+
+    With a speed, the recording is played on a clock started by the first call: speed seconds of the recording per second,
+    and each call returns the last record of its kind at the clock time and takes its recorded latency divided by speed.
+    Past the end of the recording, the last records are returned. Without speed, each call returns the next record of its kind,
+    without waiting, so that a run replays the recorded calls one by one whatever its pace.
+    """
+    normalize_order = staticmethod(Betfair.normalize_order)
+    normalize_book = staticmethod(Betfair.normalize_book)
+
+    def __init__(self, path : str, speed : Union[float, None] = 1.0):
+        _check_pyarrow()
+        self.path = path
+        self.speed = speed
+        self.records = {kind: read_record_batches(path, kind) for kind in RECORD_KINDS}
+        self.times = {kind: np.array([recorded_at for _, recorded_at, _ in records]) for kind, records in self.records.items()}
+        first_times = [times[0] for times in self.times.values() if len(times)]
+        self.recording_start = min(first_times) if first_times else 0.0
+        self.trading = SimpleNamespace(account=SimpleNamespace(get_account_funds=self.get_account_funds), keep_alive=lambda: None)
+        self._started_at = None
+        self._next_numbers = {kind: 0 for kind in RECORD_KINDS}
+        self._lock = threading.Lock()
+
+    def login(self):
+        pass
+
+    @property
+    def clock(self) -> float:
+        """
+        The time of the recording being replayed
+        """
+        if self._started_at is None:
+            self._started_at = time.time()
+        return self.recording_start + (time.time() - self._started_at) * self.speed
+
+    def _get_batch(self, kind : str) -> Union["pa.RecordBatch", None]:
+        records = self.records[kind]
+        if not records:
+            return None
+        with self._lock:
+            if self.speed is None:
+                record_number = min(self._next_numbers[kind], len(records) - 1)
+                self._next_numbers[kind] += 1
+            else:
+                record_number = max(0, int(np.searchsorted(self.times[kind], self.clock, side="right")) - 1)
+        batch, _, latency = records[record_number]
+        if self.speed is not None:
+            time.sleep(latency / self.speed)
+        return batch
+
+    @property
+    def finished(self) -> bool:
+        """
+        Whether every record was served (without speed) or the clock is past the last record (with a speed)
+        """
+        if self.speed is None:
+            return all(self._next_numbers[kind] >= len(records) for kind, records in self.records.items())
+        return all(len(times) == 0 or self.clock >= times[-1] for times in self.times.values())
+
+    def get_account_funds(self):
+        batch = self._get_batch("funds")
+        return SimpleNamespace(available_to_bet_balance=batch.column("available_to_bet_balance")[0].as_py() if batch is not None else 0.0)
+
+    def get_markets(self, event_type_ids, market_type_codes, min_volume=1000, market_ids=None) -> List[DecodedMarket]:
+        """
+        The get_markets function returns the recorded markets of market_ids, or the ones above min_volume without market_ids.
+        event_type_ids and market_type_codes are not recorded, so they are ignored.
+        """
+        batch = self._get_batch("markets")
+        if batch is None:
+            return []
+        if market_ids is not None:
+            batch = batch.filter(pc.is_in(batch.column("market_id"), value_set=pa.array(list(market_ids), type=pa.string())))
+        else:
+            batch = batch.filter(pc.greater(batch.column("volume_matched"), min_volume))
+        return columns_to_markets(batch)
+
+    def get_current_orders(self, incremental : bool = False) -> OrderTable:
+        batch = self._get_batch("orders")
+        if batch is None:
+            return OrderTable()
+        return OrderTable.from_columns(**{column: batch.column(column).to_numpy(zero_copy_only=False) for column in ORDER_COLUMNS})
+
+    def get_matched_and_open_orders(self):
+        return split_matched_and_open(self.get_current_orders())
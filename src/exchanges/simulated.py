@@ -0,0 +1,339 @@
+"""
+In-process simulated Betfair exchange, to run the betting calls (Betfair.execute, place_limit_order, cancel_limit_order...)
+and the cashout loop without money on the live exchange, e.g. to load-test them (see benchmarks/bench_simulated_exchange.py):
+
+    trading = SimulatedBetfair(markets_qty=50, orders_qty=500, latency=0.02, instructions_per_second=1000)
+    trading.login()
+    reports = trading.execute(orders_to_cancel, orders_to_replace, orders_to_place)
+
+SimulatedBetfair is the Betfair adapter itself, with the API client replaced by an in-memory one: every call goes through the same
+code as in production, down to the lightweight responses. The markets, their fair prices and the initial orders of the account are the
+ones of the seeded fake exchange (see fake), but the orders are matched by a MatchingEngine against ladders of liquidity quoted around
+the fair prices, which move and are quoted again on each listMarketBook.
+"""
+import threading
+import time
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+from typing import List, Dict, Union
+from betfairlightweight.exceptions import APIError
+from src.exchanges.betfair import MAX_REQUEST_WEIGHT, MARKET_BOOK_WEIGHT, MARKET_BOOK_DEPTH, MARKET_BOOK_ALL_OFFERS_WEIGHT, \
+    PLACE_INSTRUCTIONS_MAX, CANCEL_INSTRUCTIONS_MAX, REPLACE_INSTRUCTIONS_MAX
+from src.exchanges.fake import FakeBettingEndpoint, FakeBetfair
+from src.exchanges.matching_engine import MatchingEngine, SimulatedOrder, BACK, LAY, _iso
+from src.exchanges.rate_limiter import TokenBucket
+from src.exchanges.ticks import TICK_PRICES, TICKS_QTY, price_to_tick
+
+SIMULATED_LIQUIDITY_DEPTH = 10  # Ticks of liquidity quoted on each side of each runner
+SIMULATED_LIQUIDITY_SIZES = (10, 500)  # Range of the size quoted at each tick
+
+
+class SimulatedBettingEndpoint(FakeBettingEndpoint):
+    """
+    Betting endpoint of the simulated exchange, answering in the lightweight format of betfairlightweight:
+    listMarketCatalogue, listMarketBook, listCurrentOrders, placeOrders, cancelOrders and replaceOrders.
+
+    Each request waits `latency` seconds, outside of the locks of the markets so that concurrent requests overlap.
+    With requests_per_second or instructions_per_second, a request over the limit is rejected with a TOO_MANY_REQUESTS APIError,
+    as the API does, instead of being delayed: the throttled requests are counted in `throttled`, and all of them in `requests`.
+    Requests over the instruction limits of one request, or a listMarketBook over the data weight limit, are rejected as well.
+    Markets turn in play at their start time, which lapses the unmatched size of their LAPSE orders (see MatchingEngine.turn_in_play).
+    """
+    def __init__(self, markets_qty : int, orders_qty : int, seed : int, price_volatility : float, latency : float = 0,
+                 requests_per_second : Union[float, None] = None, instructions_per_second : Union[float, None] = None,
+                 liquidity_depth : int = SIMULATED_LIQUIDITY_DEPTH):
+        super().__init__(markets_qty, orders_qty, seed, price_volatility)
+        self.latency = latency
+        self.liquidity_depth = liquidity_depth
+        self._request_limiter = TokenBucket(rate=requests_per_second, capacity=max(1, requests_per_second)) \
+            if requests_per_second else None
+        self._instruction_limiter = TokenBucket(rate=instructions_per_second, capacity=max(PLACE_INSTRUCTIONS_MAX, instructions_per_second)) \
+            if instructions_per_second else None
+        self.requests = {}
+        self.throttled = {}
+        self._lock = threading.Lock()
+        self._current_orders_cache = (None, [])
+
+        self.engine = MatchingEngine()
+        self._liquidity = {}  # market_id: bet ids of the liquidity orders
+        for market_id, probs in self.fair_probs.items():
+            self.engine.add_market(market_id, [100 + selection_number for selection_number in range(len(probs))],
+                                   total_matched=self.catalogue[market_id]["totalMatched"])
+            self._quote(market_id)
+        self._start_times = sorted((pd.to_datetime(entry["marketStartTime"]).timestamp(), market_id) for market_id, entry in self.catalogue.items())
+
+        # The orders of the fake exchange are the initial orders of the account: they match against the liquidity or rest in the book
+        initial_orders, self.orders = self.orders, None
+        for order in initial_orders:
+            price = float(TICK_PRICES[price_to_tick(order["priceSize"]["price"])])
+            self.engine.place(order["marketId"], order["selectionId"], order["side"], order["priceSize"]["size"], price)
+
+    def _quote(self, market_id : str):
+        """
+        Replaces the liquidity of the market by ladders of liquidity_depth ticks around its fair prices: lays from the best back price down,
+        backs from the best lay price up. Liquidity orders persist in play.
+        """
+        probs = self.fair_probs[market_id]
+        back_ticks = price_to_tick(np.maximum(1.01, 1 / (probs * 1.02))).astype(int)
+        lay_ticks = np.maximum(back_ticks + 1, price_to_tick(np.minimum(1000, 1 / (probs * 0.98))))
+        sizes = np.round(self.rng.uniform(*SIMULATED_LIQUIDITY_SIZES, (2, len(probs), self.liquidity_depth)), 2).tolist()
+        bet_ids = []
+        # The market lock is reentrant: the instructions of the account wait until the new ladders are complete
+        with self.engine.markets[market_id].lock:
+            for bet_id in self._liquidity.get(market_id, ()):
+                self.engine.cancel(market_id, bet_id)
+            for selection_number in range(len(probs)):
+                for level in range(self.liquidity_depth):
+                    for side, tick, size in (("LAY", back_ticks[selection_number] - level, sizes[0][selection_number][level]),
+                                             ("BACK", lay_ticks[selection_number] + level, sizes[1][selection_number][level])):
+                        if 0 <= tick < TICKS_QTY:
+                            order, _ = self.engine.place(market_id, 100 + selection_number, side, size, float(TICK_PRICES[tick]),
+                                                         persistence_type="PERSIST", account=False)
+                            bet_ids.append(order.bet_id)
+            self._liquidity[market_id] = bet_ids
+
+    def _start_due_markets(self):
+        now = time.time()
+        while self._start_times and self._start_times[0][0] <= now:
+            _, market_id = self._start_times.pop(0)
+            self.engine.turn_in_play(market_id)
+
+    def _request(self, method : str, instructions_qty : int = 0):
+        """
+        Counts the request, rejects it if it is over the rate limits, turns the markets that started in play, then waits the latency
+        """
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            throttled = (self._request_limiter is not None and not self._request_limiter.try_acquire()) or \
+                (instructions_qty and self._instruction_limiter is not None and not self._instruction_limiter.try_acquire(instructions_qty))
+            if throttled:
+                self.throttled[method] = self.throttled.get(method, 0) + 1
+            self._start_due_markets()
+        if throttled:
+            raise APIError(None, f"SportsAPING/v1.0/{method}", None, "TOO_MANY_REQUESTS")
+        if self.latency:
+            time.sleep(self.latency)
+
+    def list_market_catalogue(self, filter : Dict, lightweight : bool = True, max_results : int = 1000, market_projection : List[str] = None) -> List[dict]:
+        self._request("listMarketCatalogue")
+        catalogue = super().list_market_catalogue(filter, lightweight=lightweight, max_results=max_results, market_projection=market_projection)
+        for entry in catalogue:
+            entry["totalMatched"] = round(self.engine.markets[entry["marketId"]].total_matched, 2)
+        return catalogue
+
+    def list_market_book(self, market_ids : List[str], price_projection : Dict = None, lightweight : bool = True) -> List[dict]:
+        self._request("listMarketBook")
+        if "EX_ALL_OFFERS" in (price_projection or {}).get("priceData", ()):
+            depth, weight = None, MARKET_BOOK_ALL_OFFERS_WEIGHT
+        else:
+            depth = ((price_projection or {}).get("exBestOffersOverrides") or {}).get("bestPricesDepth", MARKET_BOOK_DEPTH)
+            weight = MARKET_BOOK_WEIGHT * max(1, depth / MARKET_BOOK_DEPTH)
+        if weight * len(market_ids) > MAX_REQUEST_WEIGHT:
+            raise APIError(None, "SportsAPING/v1.0/listMarketBook", None, "TOO_MUCH_DATA")
+
+        books = []
+        for market_id in market_ids:
+            market = self.engine.markets.get(market_id)
+            if market is None:
+                continue
+            self._move_prices(market_id)
+            self._quote(market_id)
+            with market.lock:
+                runners = [{"selectionId": selection_id, "status": "ACTIVE",
+                            "ex": {"availableToBack": runner.get_ladder(LAY, depth), "availableToLay": runner.get_ladder(BACK, depth)}}
+                           for selection_id, runner in market.runners.items()]
+                books.append({"marketId": market_id, "status": "OPEN", "inplay": market.in_play, "totalMatched": round(market.total_matched, 2),
+                              "runners": runners})
+        return books
+
+    def _get_current_orders(self, bet_ids : Union[List[str], None], market_ids : Union[List[str], None], order_projection : Union[str, None],
+                            order_by : Union[str, None], date_range : Union[Dict, None]) -> List[SimulatedOrder]:
+        """
+        The orders of the account matching the filters of listCurrentOrders. They are kept until the next change of the orders,
+        so that the pages of one listing do not filter all the orders again.
+        """
+        date_from = (date_range or {}).get("from")
+        key = (self.engine.version, tuple(bet_ids) if bet_ids is not None else None, tuple(market_ids) if market_ids is not None else None,
+               order_projection, order_by, date_from)
+        cached_key, orders = self._current_orders_cache
+        if cached_key == key:
+            return orders
+
+        orders = self.engine.get_account_orders(market_ids)
+        if bet_ids is not None:
+            bet_ids = set(bet_ids)
+            orders = [order for order in orders if order.bet_id in bet_ids]
+        if order_projection == "EXECUTABLE":
+            orders = [order for order in orders if order.size_remaining > 0]
+        elif order_projection == "EXECUTION_COMPLETE":
+            orders = [order for order in orders if order.size_remaining <= 0]
+        if order_by == "BY_MATCH_TIME":
+            orders = sorted((order for order in orders if order.matched_at is not None), key=lambda order: order.matched_at)
+        if date_from:
+            timestamp = pd.Timestamp(date_from).timestamp()
+            orders = [order for order in orders if (order.matched_at if order_by == "BY_MATCH_TIME" else order.placed_at) >= timestamp]
+        self._current_orders_cache = (key, orders)
+        return orders
+
+    def list_current_orders(self, from_record : int = 0, record_count : int = 1000, lightweight : bool = True, bet_ids : List[str] = None,
+                            market_ids : List[str] = None, order_projection : str = None, order_by : str = None, date_range : Dict = None,
+                            **kwargs) -> Dict:
+        self._request("listCurrentOrders")
+        orders = self._get_current_orders(bet_ids, market_ids, order_projection, order_by, date_range)
+        return {"currentOrders": [order.to_current_order() for order in orders[from_record: from_record + record_count]],
+                "moreAvailable": from_record + record_count < len(orders)}
+
+    @staticmethod
+    def _execution_report(market_id : str, instruction_reports : List[dict], error_code : Union[str, None] = None) -> Dict:
+        if error_code is None and any(report["status"] != "SUCCESS" for report in instruction_reports):
+            error_code = "BET_ACTION_ERROR"
+        report = {"status": "SUCCESS" if error_code is None else "FAILURE", "marketId": market_id, "instructionReports": instruction_reports}
+        if error_code is not None:
+            report["errorCode"] = error_code
+        return report
+
+    @staticmethod
+    def _place_report(instruction : Dict, order : Union[SimulatedOrder, None], error_code : Union[str, None]) -> Dict:
+        if order is None:
+            return {"status": "FAILURE", "errorCode": error_code, "instruction": instruction}
+        return {"status": "SUCCESS", "instruction": instruction, "betId": order.bet_id, "placedDate": _iso(order.placed_at),
+                "averagePriceMatched": order.average_price_matched, "sizeMatched": order.size_matched,
+                "orderStatus": "EXECUTABLE" if order.size_remaining > 0 else "EXECUTION_COMPLETE"}
+
+    def place_orders(self, market_id : str, instructions : List[Dict], customer_ref : str = None, market_version : Dict = None,
+                     customer_strategy_ref : str = None, async_ : bool = None, lightweight : bool = True, **kwargs) -> Dict:
+        self._request("placeOrders", len(instructions))
+        if len(instructions) > PLACE_INSTRUCTIONS_MAX:
+            return self._execution_report(market_id, [], error_code="TOO_MANY_INSTRUCTIONS")
+        reports = []
+        for instruction in instructions:
+            limit_order = instruction.get("limitOrder") or {}
+            if instruction.get("orderType") != "LIMIT":
+                order, error_code = None, "INVALID_ORDER_TYPE"
+            else:
+                order, error_code = self.engine.place(market_id, instruction.get("selectionId"), instruction.get("side"), limit_order.get("size"),
+                                                      limit_order.get("price"), persistence_type=limit_order.get("persistenceType", "LAPSE"))
+            reports.append(self._place_report(instruction, order, error_code))
+        return self._execution_report(market_id, reports)
+
+    def _cancel(self, market_id : str, instruction : Dict) -> Dict:
+        order = self.engine.get_order(market_id, instruction.get("betId"))
+        if order is None or not order.account:
+            return {"status": "FAILURE", "errorCode": "INVALID_BET_ID", "instruction": instruction}
+        size_cancelled, error_code = self.engine.cancel(market_id, order.bet_id, size_reduction=instruction.get("sizeReduction"))
+        if error_code is not None:
+            return {"status": "FAILURE", "errorCode": error_code, "instruction": instruction}
+        return {"status": "SUCCESS", "instruction": instruction, "sizeCancelled": size_cancelled, "cancelledDate": _iso(time.time())}
+
+    def cancel_orders(self, market_id : str = None, instructions : List[Dict] = None, customer_ref : str = None, lightweight : bool = True,
+                      **kwargs) -> Dict:
+        """
+        Without instructions, cancels all the unmatched orders of the account in the market, or in every market without market_id
+        """
+        self._request("cancelOrders", len(instructions or ()))
+        if instructions is None:
+            return {"status": "SUCCESS", "marketId": market_id, "instructionReports": [
+                self._cancel(order.market_id, {"betId": order.bet_id}) for order in self.engine.get_account_orders([market_id] if market_id else None)
+                if order.size_remaining > 0]}
+        if len(instructions) > CANCEL_INSTRUCTIONS_MAX:
+            return self._execution_report(market_id, [], error_code="TOO_MANY_INSTRUCTIONS")
+        return self._execution_report(market_id, [self._cancel(market_id, instruction) for instruction in instructions])
+
+    def replace_orders(self, market_id : str, instructions : List[Dict], customer_ref : str = None, market_version : Dict = None,
+                       async_ : bool = None, lightweight : bool = True, **kwargs) -> Dict:
+        """
+        Each replace cancels the unmatched size of the order and places it at the new price, with the same side and persistence
+        """
+        self._request("replaceOrders", len(instructions))
+        if len(instructions) > REPLACE_INSTRUCTIONS_MAX:
+            return self._execution_report(market_id, [], error_code="TOO_MANY_INSTRUCTIONS")
+        reports = []
+        for instruction in instructions:
+            order = self.engine.get_order(market_id, instruction.get("betId"))
+            cancel_report = self._cancel(market_id, {"betId": instruction.get("betId")})
+            if cancel_report["status"] != "SUCCESS":
+                reports.append({"status": "FAILURE", "errorCode": cancel_report["errorCode"], "cancelInstructionReport": cancel_report,
+                                "placeInstructionReport": {"status": "FAILURE", "errorCode": "RELATED_ACTION_FAILED"}})
+                continue
+            new_order, error_code = self.engine.place(market_id, order.selection_id, order.side, cancel_report["sizeCancelled"],
+                                                      instruction.get("newPrice"), persistence_type=order.persistence_type)
+            place_report = self._place_report({"orderType": "LIMIT", "selectionId": order.selection_id, "side": order.side,
+                                               "limitOrder": {"size": cancel_report["sizeCancelled"], "price": instruction.get("newPrice"),
+                                                              "persistenceType": order.persistence_type}}, new_order, error_code)
+            report = {"status": place_report["status"], "cancelInstructionReport": cancel_report, "placeInstructionReport": place_report}
+            if error_code is not None:
+                report["errorCode"] = error_code
+            reports.append(report)
+        return self._execution_report(market_id, reports)
+
+    def get_exposure(self) -> float:
+        """
+        The exposure of the account: over the markets, the loss of the worst outcome of the matched orders,
+        plus the liability of the unmatched orders as if they were all matched on their losing outcome
+        """
+        exposure = 0.0
+        for market in self.engine.markets.values():
+            selection_numbers = {selection_id: selection_number for selection_number, selection_id in enumerate(market.runners)}
+            pnl_outcomes = np.zeros(len(selection_numbers))
+            unmatched_liability = 0.0
+            with market.lock:
+                for order in market.orders.values():
+                    if not order.account:
+                        continue
+                    sign = 1 if order.side == "BACK" else -1
+                    pnl_outcomes -= sign * order.size_matched
+                    pnl_outcomes[selection_numbers[order.selection_id]] += sign * order.matched_value
+                    unmatched_liability += order.size_remaining * (1 if order.side == "BACK" else order.price - 1)
+            exposure += max(0.0, -pnl_outcomes.min(initial=0)) + unmatched_liability
+        return exposure
+
+
+class SimulatedTrading:
+    """
+    Stand-in of betfairlightweight.APIClient backed by a SimulatedBettingEndpoint.
+    The funds available to bet are the balance minus the exposure of the orders (see SimulatedBettingEndpoint.get_exposure).
+    """
+    def __init__(self, betting : SimulatedBettingEndpoint, available_to_bet_balance : float):
+        self.betting = betting
+        self.balance = available_to_bet_balance
+        self.account = SimpleNamespace(get_account_funds=self.get_account_funds)
+
+    def get_account_funds(self):
+        exposure = self.betting.get_exposure()
+        return SimpleNamespace(available_to_bet_balance=round(float(self.balance - exposure), 2), exposure=round(float(-exposure), 2))
+
+    def keep_alive(self):
+        pass
+
+
+class SimulatedBetfair(FakeBetfair):
+    """
+    Betfair adapter backed by the in-process simulated exchange. Two instances with the same seed start from the same markets and orders.
+
+    :param latency:float: Seconds taken by each request
+    :param requests_per_second:float: Requests accepted per second, the ones above are rejected (None for no limit)
+    :param instructions_per_second:float: Betting instructions accepted per second, over all the markets (None for no limit)
+    """
+    def __init__(self, markets_qty : int = 50, orders_qty : int = 500, seed : int = 0, price_volatility : float = 0.01,
+                 available_to_bet_balance : float = 1000.0, latency : float = 0, requests_per_second : Union[float, None] = None,
+                 instructions_per_second : Union[float, None] = None, liquidity_depth : int = SIMULATED_LIQUIDITY_DEPTH):
+        super().__init__(markets_qty=markets_qty, orders_qty=orders_qty, seed=seed, price_volatility=price_volatility,
+                         available_to_bet_balance=available_to_bet_balance)
+        self.simulation_config = dict(latency=latency, requests_per_second=requests_per_second, instructions_per_second=instructions_per_second,
+                                      liquidity_depth=liquidity_depth)
+
+    def login(self):
+        fake_config = dict(self.fake_config)
+        available_to_bet_balance = fake_config.pop("available_to_bet_balance")
+        self.trading = SimulatedTrading(SimulatedBettingEndpoint(**fake_config, **self.simulation_config), available_to_bet_balance)
+
+    @property
+    def engine(self) -> MatchingEngine:
+        return self.trading.betting.engine
+
+    def turn_in_play(self, market_id : str) -> int:
+        """
+        The turn_in_play function turns the market in play before its start time, which lapses its unmatched LAPSE orders
+        """
+        return self.engine.turn_in_play(market_id)
@@ -0,0 +1,33 @@
+import numpy as np
+from typing import Union
+
+# https://docs.developer.betfair.com/display/1smk3cen4v3lu3yomq5qye0ni/Betfair+Price+Increments
+# (price from, price to, increment) of each band of the Betfair price ladder
+TICK_BANDS = ((1.01, 2, 0.01), (2, 3, 0.02), (3, 4, 0.05), (4, 6, 0.1), (6, 10, 0.2), (10, 20, 0.5), (20, 30, 1), (30, 50, 2),
+              (50, 100, 5), (100, 1000, 10))
+TICK_PRICES = np.unique(np.round(np.concatenate([np.arange(start, stop + increment / 2, increment) for start, stop, increment in TICK_BANDS]), 2))
+TICKS_QTY = len(TICK_PRICES)  # 350
+MISSING_TICK = -1
+# Indexing with MISSING_TICK reads the trailing NaN, so a ladder of ticks converts to prices with missing levels in one lookup
+PRICES_BY_TICK = np.append(TICK_PRICES, np.nan)
+
+
+def price_to_tick(prices : Union[np.ndarray, list, float]) -> np.ndarray:
+    """
+    The price_to_tick function returns the int16 tick number of each price on the Betfair ladder (0 for 1.01, 349 for 1000),
+    and MISSING_TICK for NaN. Exchange prices are always on the ladder: anything else is rounded to the nearest tick.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    missing = np.isnan(prices)
+    prices = np.where(missing, TICK_PRICES[0], prices)
+    upper = np.clip(np.searchsorted(TICK_PRICES, prices), 1, TICKS_QTY - 1)
+    lower = upper - 1
+    ticks = np.where(prices - TICK_PRICES[lower] <= TICK_PRICES[upper] - prices, lower, upper)
+    return np.where(missing, MISSING_TICK, ticks).astype(np.int16)
+
+
+def tick_to_price(ticks : Union[np.ndarray, list, int]) -> np.ndarray:
+    """
+    The tick_to_price function returns the price of each tick number, and NaN for MISSING_TICK
+    """
+    return PRICES_BY_TICK[np.asarray(ticks, dtype=np.int64)]
@@ -0,0 +1,179 @@
+import sqlite3
+import time
+from typing import List, Union
+import numpy as np
+import pandas as pd
+from src.website_refresher import DashboardSnapshot, get_account_stats
+
+STORE_TABLES = ("orders", "selection_stats", "market_stats")
+# Columns identifying a row of each table, over all the shards
+STORE_TABLE_KEYS = {"orders": ["market_id", "bet_id"], "selection_stats": ["market_id", "selection_id"], "market_stats": ["market_id"]}
+STORE_TIMEOUT = 30
+POLL_INTERVAL = 1
+
+
+class StatsStore:
+    """
+    SQLite store of the dashboard data written by the stats workers (see stats_worker) and read by the app.
+    Each worker owns a shard of the markets and replaces all its rows in one transaction, so a reader never sees half a refresh.
+    The shards table keeps one row per shard: the number of shards it was computed for, when, and the account funds
+    (NULL for the shards that do not fetch them, see stats_worker).
+    The database is in WAL mode so that the app keeps reading while a worker writes.
+    """
+    def __init__(self, path : str, timeout : float = STORE_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS shards (shard TEXT PRIMARY KEY, shards_qty INTEGER, created_at REAL, "
+                               "refresh_seconds REAL, available_to_bet_balance REAL, hits INTEGER, tolerance_hits INTEGER, misses INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS refresh_requests (requested_at REAL)")
+            for table in STORE_TABLES:
+                connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (shard TEXT)")
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    @staticmethod
+    def _insert_frame(connection : sqlite3.Connection, table : str, shard : str, frame : pd.DataFrame):
+        existing_columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+        for column in frame.columns:
+            if column not in existing_columns:
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN "{column}"')
+        if frame.empty:
+            return
+        # Plain Python values, with None for the missing ones, so that sqlite3 can bind them
+        values = [np.where(frame[column].isna(), None, frame[column].to_numpy(dtype=object)).tolist() for column in frame.columns]
+        columns = ", ".join(f'"{column}"' for column in frame.columns)
+        placeholders = ", ".join("?" for _ in range(len(frame.columns) + 1))
+        connection.executemany(f"INSERT INTO {table} (shard, {columns}) VALUES ({placeholders})",
+                               [(shard, *row) for row in zip(*values)])
+
+    def write_shard(self, shard : str, shards_qty : int, snapshot : DashboardSnapshot):
+        """
+        The write_shard function replaces the rows of shard by the orders, selection stats and market stats of snapshot.
+
+        :param shards_qty:int: Number of shards the markets were split into when computing snapshot. A reader only keeps
+        the shards computed for the latest number of shards, so that rows left by a previous layout are ignored
+        """
+        cache_stats = snapshot.market_stats_cache
+        with self._connect() as connection:
+            for table, frame in zip(STORE_TABLES, (snapshot.orders_df, snapshot.selection_stats, snapshot.market_stats)):
+                connection.execute(f"DELETE FROM {table} WHERE shard = ?", (shard,))
+                self._insert_frame(connection, table, shard, frame)
+            connection.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (shard, shards_qty, snapshot.created_at, snapshot.refresh_seconds, snapshot.account_stats["Available to bet"],
+                                cache_stats.get("hits"), cache_stats.get("tolerance_hits"), cache_stats.get("misses")))
+        connection.close()
+
+    def get_shards(self, max_age : Union[float, None] = None) -> pd.DataFrame:
+        """
+        The get_shards function returns the rows of the shards table computed for the latest number of shards,
+        and at most max_age seconds ago if given
+        """
+        with self._connect() as connection:
+            shards = pd.read_sql("SELECT * FROM shards ORDER BY created_at", connection)
+        connection.close()
+        if shards.empty:
+            return shards
+        shards = shards[shards.shards_qty == shards.shards_qty.iloc[-1]]
+        if max_age is not None:
+            shards = shards[shards.created_at >= time.time() - max_age]
+        return shards.reset_index(drop=True)
+
+    def read_table(self, table : str, shards : List[str]) -> pd.DataFrame:
+        placeholders = ", ".join("?" for _ in shards)
+        with self._connect() as connection:
+            frame = pd.read_sql(f"SELECT * FROM {table} WHERE shard IN ({placeholders})", connection, params=list(shards))
+        connection.close()
+        return frame
+
+    @staticmethod
+    def _drop_duplicates(frame : pd.DataFrame, keys : List[str], shard_created_at : dict) -> pd.DataFrame:
+        """
+        Keeps one row per keys, the one of the most recently written shard, and drops the shard column
+        """
+        if not set(keys).issubset(frame.columns):
+            return frame.drop(columns="shard")
+        frame = frame.iloc[np.argsort(frame.shard.map(shard_created_at).to_numpy(), kind="stable")]
+        return frame.drop_duplicates(keys, keep="last").sort_index().reset_index(drop=True).drop(columns="shard")
+
+    def read_snapshot(self, max_age : Union[float, None] = None) -> Union[DashboardSnapshot, None]:
+        """
+        The read_snapshot function merges the shards of the store into one DashboardSnapshot, or returns None if no shard was written yet.
+        Its created_at is the one of the oldest shard, since the snapshot is at least that old.
+        """
+        shards = self.get_shards(max_age=max_age)
+        if shards.empty:
+            return None
+        # Workers with different rings (e.g. a host still running an older configuration) could both write a market:
+        # keep the rows of the most recently written shard
+        shard_created_at = dict(zip(shards.shard, shards.created_at))
+        orders_df, selection_stats, market_stats = (self._drop_duplicates(self.read_table(table, shards.shard), STORE_TABLE_KEYS[table], shard_created_at)
+                                                     for table in STORE_TABLES)
+        balances = shards.available_to_bet_balance.dropna()
+        available_to_bet_balance = float(balances.iloc[-1]) if not balances.empty else None
+        account_stats = get_account_stats(available_to_bet_balance, selection_stats, market_stats)
+        cache_stats = shards[["hits", "tolerance_hits", "misses"]].dropna()
+        market_stats_cache = {column: int(cache_stats[column].sum()) for column in cache_stats.columns} if not cache_stats.empty else None
+        return DashboardSnapshot(orders_df, selection_stats, market_stats, account_stats, created_at=shards.created_at.min(),
+                                 refresh_seconds=shards.refresh_seconds.max(), market_stats_cache=market_stats_cache)
+
+    def request_refresh(self) -> float:
+        """
+        The request_refresh function asks the workers to refresh now instead of at the end of their interval, and returns the request time
+        """
+        requested_at = time.time()
+        with self._connect() as connection:
+            connection.execute("DELETE FROM refresh_requests")
+            connection.execute("INSERT INTO refresh_requests VALUES (?)", (requested_at,))
+        connection.close()
+        return requested_at
+
+    def get_refresh_request(self) -> float:
+        with self._connect() as connection:
+            row = connection.execute("SELECT MAX(requested_at) FROM refresh_requests").fetchone()
+        connection.close()
+        return row[0] or 0
+
+
+class StoreReader:
+    """
+    Read side of the StatsStore for the app, with the interface of website_refresher.StatsRefresher:
+    the app then only reads the store, and the exchange is only called by the stats workers.
+    """
+    def __init__(self, store : StatsStore, max_age : Union[float, None] = None):
+        """
+        :param max_age:float: Ignore the shards that were not written for max_age seconds, e.g. whose worker stopped
+        """
+        self.store = store
+        self.max_age = max_age
+        self.last_error = None
+
+    @property
+    def snapshot(self) -> Union[DashboardSnapshot, None]:
+        try:
+            snapshot = self.store.read_snapshot(max_age=self.max_age)
+            self.last_error = None
+            return snapshot
+        except Exception as e:
+            self.last_error = e
+            return None
+
+    def wait_for_snapshot(self, timeout : Union[float, None] = None, newer_than : float = 0) -> Union[DashboardSnapshot, None]:
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.created_at > newer_than:
+                return snapshot
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL if deadline is None else max(0, min(POLL_INTERVAL, deadline - time.time())))
+
+    def force_refresh(self, timeout : Union[float, None] = None) -> Union[DashboardSnapshot, None]:
+        """
+        The force_refresh function asks the workers for a refresh and waits up to timeout seconds until every shard was written after the request
+        """
+        requested_at = self.store.request_refresh()
+        return self.wait_for_snapshot(timeout=timeout, newer_than=requested_at)
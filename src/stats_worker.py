@@ -0,0 +1,139 @@
+"""
+Headless stats worker: runs the dashboard pipeline (current orders -> selection stats -> market stats) in a loop
+and writes the results to a StatsStore, which the app reads.
+
+The markets are split into --shards shards with consistent hashing of their market id. A worker process computes one shard,
+so the shards can run as processes of one host or be spread over several hosts writing to the same store:
+    python -m src.stats_worker --store stats.sqlite --shards 4                                   # the 4 shards on this host
+    python -m src.stats_worker --store stats.sqlite --shards 4 --shard-index 0 --shard-index 1   # host A
+    python -m src.stats_worker --store stats.sqlite --shards 4 --shard-index 2 --shard-index 3   # host B
+Then start the app with STATS_STORE_PATH=stats.sqlite.
+
+Each shard lists the current orders (incrementally, see Betfair.get_current_orders) to find the markets it owns, and only writes
+the orders of those markets. The account funds are fetched by the shard ACCOUNT_SHARD_INDEX only, whichever host runs it.
+
+With --fake, the workers use seeded in-memory markets and orders (exchanges.fake.FakeBetfair) instead of the Betfair API:
+    python -m src.stats_worker --store stats.sqlite --shards 2 --fake --once
+
+With --record, the exchange data of each shard is recorded under a directory of the shard (see exchanges.recording),
+and --replay computes the shards from such a recording instead of the exchange, e.g. to profile a refresh offline:
+    python -m src.stats_worker --store stats.sqlite --shards 2 --record recordings/today
+    python -m src.stats_worker --store replay.sqlite --shards 2 --replay recordings/today --replay-speed 0 --once
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from functools import partial
+
+current = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(current))
+
+from src.exchanges.betfair import Betfair
+from src.exchanges.catalogue_cache import MarketCatalogueCache
+from src.exchanges.fake import FakeBetfair
+from src.exchanges.recording import RecordingExchange, ReplayExchange
+from src.exchanges.simulated import SimulatedBetfair
+from src.stats_store import StatsStore, POLL_INTERVAL
+from src.utils_sharding import ConsistentHashRing, shard_name
+from src.website_refresher import compute_snapshot, REFRESH_INTERVAL, KEEP_ALIVE_INTERVAL
+from src.website_utils import MarketStatsCache
+
+ACCOUNT_SHARD_INDEX = 0  # The shard that fetches the account funds
+
+
+def get_trading(args : argparse.Namespace, shard : str) -> Betfair:
+    if args.replay is not None:
+        return ReplayExchange(os.path.join(args.replay, shard), speed=args.replay_speed or None)
+    if args.simulated:
+        trading = SimulatedBetfair(markets_qty=args.fake_markets, orders_qty=args.fake_orders, seed=args.fake_seed)
+    elif args.fake:
+        trading = FakeBetfair(markets_qty=args.fake_markets, orders_qty=args.fake_orders, seed=args.fake_seed)
+    else:
+        trading = Betfair()
+    trading.login()
+    if args.catalogue_cache_path is not None:
+        # One snapshot per shard, since the processes would overwrite each other's
+        trading.catalogue_cache = MarketCatalogueCache(path=f"{args.catalogue_cache_path}.{shard}")
+    if args.record is not None:
+        trading = RecordingExchange(trading, path=os.path.join(args.record, shard))
+    return trading
+
+
+def run_shard(args : argparse.Namespace, shard_index : int):
+    """
+    The run_shard function computes the markets of shard_index and writes them to the store every interval seconds,
+    or sooner if the app requests a refresh. Errors are printed and the next refresh tries again.
+    """
+    shard = shard_name(shard_index)
+    ring = ConsistentHashRing.from_shards_qty(args.shards)
+    store = StatsStore(args.store)
+    trading = get_trading(args, shard)
+    stats_cache = MarketStatsCache(price_tolerance=args.price_tolerance)
+    compute = partial(compute_snapshot, trading, args.market_stats_workers, args.market_stats_timeout, stats_cache,
+                      partial(ring.owns, shard), account_funds=shard_index == ACCOUNT_SHARD_INDEX)
+
+    last_keep_alive = time.time()
+    while True:
+        started_at = time.time()
+        try:
+            if time.time() - last_keep_alive > KEEP_ALIVE_INTERVAL:
+                trading.trading.keep_alive()
+                last_keep_alive = time.time()
+            snapshot = compute()
+            store.write_shard(shard, args.shards, snapshot)
+            print(f"{shard}: {len(snapshot.market_stats)} markets written in {round(snapshot.refresh_seconds, 1)}s")
+        except Exception as e:
+            print(f"{shard}: refresh failed : {e}")
+            traceback.print_exc()
+        if args.once:
+            return
+        while time.time() - started_at < args.interval and store.get_refresh_request() <= started_at:
+            time.sleep(POLL_INTERVAL)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", default=os.environ.get("STATS_STORE_PATH", "stats.sqlite"), help="path of the SQLite StatsStore")
+    parser.add_argument("--shards", type=int, default=1, help="number of shards of the markets, over all the hosts")
+    parser.add_argument("--shard-index", type=int, action="append", help="shard computed by this host, repeatable. Default: all of them")
+    parser.add_argument("--interval", type=float, default=REFRESH_INTERVAL, help="seconds between two refreshes of a shard")
+    parser.add_argument("--once", action="store_true", help="refresh each shard once and exit")
+    parser.add_argument("--market-stats-workers", type=int, default=None)
+    parser.add_argument("--market-stats-timeout", type=float, default=None)
+    parser.add_argument("--price-tolerance", type=float, default=0)
+    parser.add_argument("--catalogue-cache-path", default=None, help="SQLite snapshot of the catalogue cache, suffixed by the shard name")
+    parser.add_argument("--fake", action="store_true", help="use exchanges.fake.FakeBetfair instead of the Betfair API")
+    parser.add_argument("--simulated", action="store_true", help="use exchanges.simulated.SimulatedBetfair, whose orders are matched, with the --fake-* options")
+    parser.add_argument("--fake-markets", type=int, default=50)
+    parser.add_argument("--fake-orders", type=int, default=500)
+    parser.add_argument("--fake-seed", type=int, default=0)
+    parser.add_argument("--record", default=None, help="directory where the exchange data of each shard is recorded")
+    parser.add_argument("--replay", default=None, help="directory of a --record recording to compute the shards from, instead of the exchange")
+    parser.add_argument("--replay-speed", type=float, default=1, help="replay speed of the recording, 0 to serve the recorded calls one by one")
+    args = parser.parse_args(argv)
+
+    shard_indexes = args.shard_index if args.shard_index is not None else list(range(args.shards))
+    if any(not 0 <= shard_index < args.shards for shard_index in shard_indexes):
+        parser.error(f"--shard-index must be between 0 and {args.shards - 1}")
+    StatsStore(args.store)  # creates the tables once, before the workers start
+
+    if len(shard_indexes) == 1:
+        run_shard(args, shard_indexes[0])
+        return
+    processes = [multiprocessing.Process(target=run_shard, args=(args, shard_index), name=shard_name(shard_index))
+                 for shard_index in shard_indexes]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
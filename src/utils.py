@@ -27,6 +27,26 @@ class Market:
         self.runners = runners
 
 
+class InstructionReport:
+    """
+    Outcome of one cancel, replace or place instruction sent by Exchange.execute.
+    status is the instruction status of the exchange (SUCCESS, FAILURE, TIMEOUT) or ERROR if the request itself failed,
+    and latency the seconds of the request that carried the instruction.
+    """
+    def __init__(self, action, order, status, bet_id=None, error_code=None, latency=None, size_matched=None):
+        self.action = action
+        self.order = order
+        self.market_id = order.market_id
+        self.status = status
+        self.bet_id = bet_id
+        self.error_code = error_code
+        self.latency = latency
+        self.size_matched = size_matched
+
+    def __repr__(self):
+        return str({k: v for k, v in self.__dict__.items() if k != "order"})
+
+
 class Runner:
 
     def __init__(self, runner_id, available_to_back, available_to_lay):
@@ -88,16 +108,20 @@ def get_pnl_outcomes(matched_orders_market : Dict[int, List[Order]], selection_i
     :param selection_ids:List[str]: Specify the selection_ids of the selections we want to compute the pnl for
     :return: A dictionary with the pnl of each selection and a complementary pnl if there is only one selection
     """
+    # Amounts won if each selection wins (back profit - lay liability) and if it loses (lay stake - back stake)
+    pnl_if_wins = {}
+    pnl_if_loses = {}
+    for selection_j, back_lay_orders in matched_orders_market.items():
+        pnl_if_wins[selection_j] = sum([(x.price - 1) * x.size_matched for x in back_lay_orders["BACK"]]) - sum([(x.price - 1) * x.size_matched for x in back_lay_orders["LAY"]])
+        pnl_if_loses[selection_j] = sum(x.size_matched for x in back_lay_orders["LAY"]) - sum(x.size_matched for x in back_lay_orders["BACK"])
+    pnl_if_all_lose = sum(pnl_if_loses.values())
+
     pnl_selections = {}
     for selection_i in selection_ids:
-        pnl_selection = 0
-        for selection_j, back_lay_orders in matched_orders_market.items():
-            if selection_i == selection_j:  # position on the winning selection
-                pnl_selection += sum([(x.price - 1) * x.size_matched for x in back_lay_orders["BACK"]]) - sum([(x.price - 1) * x.size_matched for x in back_lay_orders["LAY"]])
-            else:  # Winning selection diffrent from position selection or single selection
-                pnl_selection += sum(x.size_matched for x in back_lay_orders["LAY"]) - sum(x.size_matched for x in back_lay_orders["BACK"])
-        pnl_selections[selection_i] = pnl_selection
+        if selection_i in matched_orders_market:  # position on the winning selection
+            pnl_selections[selection_i] = pnl_if_all_lose - pnl_if_loses[selection_i] + pnl_if_wins[selection_i]
+        else:  # Winning selection diffrent from all position selections
+            pnl_selections[selection_i] = pnl_if_all_lose
     if len(selection_ids) == 1:
-        positions_selection = matched_orders_market[selection_ids[0]]
-        pnl_selections["complementary"] = sum(x.size_matched for x in positions_selection["LAY"]) - sum(x.size_matched for x in positions_selection["BACK"])
-    return pnl_selections
\ No newline at end of file
+        pnl_selections["complementary"] = pnl_if_loses[selection_ids[0]]
+    return pnl_selections
@@ -1,31 +1,460 @@
 import cvxpy as cp
 import numpy as np
+import threading
 from collections import OrderedDict
-from copy import deepcopy
+from types import MappingProxyType
 from logzero import logger
-from typing import List, Dict, Literal, Tuple
+from typing import List, Dict, Literal, Tuple, Union
 from src.utils import Order
-from src.exchanges.exchange import BookNormalized
+from src.exchanges.exchange import BookNormalized, BACK_PRICES, LAY_PRICES
 from src.utils import get_pnl_outcomes
+from src.utils_positions import PositionLedger
+from src.utils_orders import reconcile_orders, MIN_STAKE
+
+CASHOUT_PROBLEM_CACHE_SIZE = 64
+CASHOUT_BATCH_PROBLEM_CACHE_SIZE = 16
+MAX_STD_CAP = 10
+MIN_STD_MARGIN = 1e-3
+NUMPY_ENGINE_MAX_ITERATIONS = 50
+NUMPY_ENGINE_TOLERANCE = 1e-9
+CASHOUT_BATCH_SIZE = 32
+# Canonicalizing a batch problem takes time quadratic in its number of stakes, so deep books are solved in smaller batches
+CASHOUT_BATCH_VARIABLES = 2048
+SIDES = ("BACK", "LAY")
+EMPTY_POSITION = MappingProxyType({"BACK": (), "LAY": ()})
 
 class CashoutOutput:
-    def __init__(self, orders = None, expected_pnl_before = None, expected_pnl_after = None, worst_outcome_before = None, worst_outcome_after = None):
+    def __init__(self, orders = None, expected_pnl_before = None, expected_pnl_after = None, worst_outcome_before = None, worst_outcome_after = None,
+                 max_std_used = None, solves_qty = None):
         self.orders = orders
         self.expected_pnl_before = expected_pnl_before
         self.expected_pnl_after = expected_pnl_after
         self.worst_outcome_before = worst_outcome_before
         self.worst_outcome_after = worst_outcome_after
+        self.max_std_used = max_std_used
+        self.solves_qty = solves_qty
+
+
+def _selection_matrix(selections_qty : int, levels_qty : int) -> np.array:
+    """
+    Constant (selections, variables) matrix with a 1 where the stake of the column is on the selection of the row,
+    for the stakes vector of Cashout.get_pnl_matrix
+    """
+    return np.tile(np.eye(selections_qty), 2 * levels_qty)
+
+
+def _signed_prices(pnl_matrix : np.array) -> np.array:
+    """
+    The _signed_prices function returns the price of each column of pnl matrices (back price, minus the lay price, 0 for a missing level).
+    Any pnl matrix is M = G @ diag(prices) + outer(ones, sides) with G = _selection_matrix and sides -1 for back, +1 for lay stakes,
+    and the second term moves all the outcomes together, so it does not change their dispersion.
+
+    :param pnl_matrix:np.array: (..., selections, variables) output(s) of Cashout.get_pnl_matrix
+    :return: The (..., variables) signed prices
+    """
+    selections_qty = pnl_matrix.shape[-2]
+    columns = pnl_matrix.reshape(*pnl_matrix.shape[:-1], -1, selections_qty)
+    selections = np.arange(selections_qty)
+    # The entry of the selection of a column minus the entry of any other selection
+    prices = columns[..., selections, :, selections] - columns[..., (selections + 1) % selections_qty, :, selections]
+    return np.moveaxis(prices, 0, -1).reshape(*pnl_matrix.shape[:-2], -1)
+
+
+class NeutralizerProblem:
+    """
+    DPP-compliant template of the cashout optimization for a given shape (selections_qty, levels_qty, constrain_by_volume).
+    The cvxpy problem is built and canonicalized once, and every market solve only updates the parameter values.
+
+    The pnl matrix M is not a parameter: the dispersion of M @ x only depends on the signed price of each column (see _signed_prices),
+    so it is written as a constant selection matrix times prices * x, with one parameter per stake instead of one per selection and stake.
+    Prices and probabilities are folded into the objective coefficients M.T @ prob, because a product of two parameters
+    multiplying the variable would not be DPP.
+    """
+    def __init__(self, selections_qty : int, levels_qty : int, constrain_by_volume : bool, warm_start_qty : int = CASHOUT_PROBLEM_CACHE_SIZE):
+        self.selections_qty = selections_qty
+        self.levels_qty = levels_qty
+        self.constrain_by_volume = constrain_by_volume
+        variables_qty = 2 * selections_qty * levels_qty
+
+        # This will handle the vector of optimal stakes
+        self.x = cp.Variable(variables_qty)
+        self.prices = cp.Parameter(variables_qty)
+        self.pnl_current = cp.Parameter(selections_qty)
+        self.objective_coefs = cp.Parameter(variables_qty)
+        self.max_std_allowed = cp.Parameter(nonneg=True)
+        self.volume_caps = cp.Parameter(variables_qty, nonneg=True) if constrain_by_volume else None
+
+        centering = np.eye(selections_qty) - 1 / selections_qty
+        variability = (centering @ _selection_matrix(selections_qty, levels_qty)) @ cp.multiply(self.prices, self.x) + centering @ self.pnl_current
+        variance = cp.norm(variability)
+
+        constraints = [self.x >= 0]
+        if constrain_by_volume:
+            constraints.append(self.x <= self.volume_caps)
+        # Auxiliary problem that finds the smallest dispersion achievable with the available stakes
+        self.min_std_problem = cp.Problem(cp.Minimize(variance), list(constraints))
+
+        constraints.append(variance <= self.max_std_allowed)
+        objective = cp.Minimize(-self.objective_coefs @ self.x)
+        self.problem = cp.Problem(objective, constraints)
+
+        self._warm_start_qty = warm_start_qty
+        self._last_solutions = OrderedDict()
+
+    def solve_min_std(self, pnl_matrix : np.array, pnl_current : np.array, volume_caps : np.array = None) -> float:
+        """
+        The solve_min_std function returns the smallest dispersion of the pnl outcomes that any vector of stakes can achieve.
+        Any max_std_allowed at or above this value makes the cashout problem feasible.
+
+        :param pnl_matrix:np.array: M matrix that computes the pnl delta of each selection outcome from the stakes vector
+        :param pnl_current:np.array: Current pnl of each selection outcome
+        :param volume_caps:np.array: Maximum stake for each element of the stakes vector. Required if constrain_by_volume
+        :return: The minimum achievable dispersion
+        """
+        self.prices.value = _signed_prices(pnl_matrix)
+        self.pnl_current.value = pnl_current
+        if self.constrain_by_volume:
+            self.volume_caps.value = volume_caps
+        min_std = self.min_std_problem.solve()
+        if min_std is None or not np.isfinite(min_std):
+            raise Exception(f"min std problem status is {self.min_std_problem.status}")
+        return max(min_std, 0.0)
+
+    def solve(self, market_id : str, pnl_matrix : np.array, pnl_current : np.array, prob_selections : np.array,
+              max_std_allowed : float, volume_caps : np.array = None) -> np.array:
+        """
+        The solve function updates the parameters of the compiled problem with the market data and solves it,
+        warm starting from the previous solution of the same market when there is one. Only the solvers that support warm starts
+        (e.g. SCS) use it: the default solver of this second-order cone problem, CLARABEL, ignores it.
+
+        :param market_id: Identify the market, used to keep its last solution for warm starts
+        :param pnl_matrix:np.array: M matrix that computes the pnl delta of each selection outcome from the stakes vector
+        :param pnl_current:np.array: Current pnl of each selection outcome
+        :param prob_selections:np.array: Probability of each selection outcome
+        :param max_std_allowed:float: Maximum dispersion allowed for the pnl outcomes after the cashout
+        :param volume_caps:np.array: Maximum stake for each element of the stakes vector. Required if constrain_by_volume
+        :return: The vector of optimal stakes
+        """
+        self.prices.value = _signed_prices(pnl_matrix)
+        self.pnl_current.value = pnl_current
+        self.objective_coefs.value = pnl_matrix.T @ prob_selections
+        self.max_std_allowed.value = max_std_allowed
+        if self.constrain_by_volume:
+            self.volume_caps.value = volume_caps
+
+        self.x.value = self._last_solutions.get(market_id)
+        self.problem.solve(warm_start=True)
+        if self.x.value is None:
+            raise Exception(f"cashout problem status is {self.problem.status} for market {market_id}")
+
+        self._last_solutions[market_id] = self.x.value
+        self._last_solutions.move_to_end(market_id)
+        if len(self._last_solutions) > self._warm_start_qty:
+            self._last_solutions.popitem(last=False)
+        return self.x.value
+
+
+class NeutralizerBatchProblem:
+    """
+    Block-diagonal stacking of markets_qty cashout problems of the same shape into one DPP-compliant cvxpy problem,
+    so that a batch of markets is solved with a single solver call. The markets only share the objective, which is the sum of their objectives.
+    As in NeutralizerProblem, each market only has one price parameter per stake, and the dispersions of all the markets are one expression.
+    """
+    def __init__(self, markets_qty : int, selections_qty : int, levels_qty : int, constrain_by_volume : bool):
+        self.markets_qty = markets_qty
+        self.selections_qty = selections_qty
+        self.levels_qty = levels_qty
+        self.constrain_by_volume = constrain_by_volume
+        variables_qty = 2 * selections_qty * levels_qty
+
+        self.x = cp.Variable((markets_qty, variables_qty))
+        self.prices = cp.Parameter((markets_qty, variables_qty))
+        self.pnl_current = cp.Parameter((markets_qty, selections_qty))
+        self.objective_coefs = cp.Parameter((markets_qty, variables_qty))
+        self.max_std_allowed = cp.Parameter(markets_qty, nonneg=True)
+        self.volume_caps = cp.Parameter((markets_qty, variables_qty), nonneg=True) if constrain_by_volume else None
+
+        constraints = [self.x >= 0]
+        if constrain_by_volume:
+            constraints.append(self.x <= self.volume_caps)
+        centering = np.eye(selections_qty) - 1 / selections_qty
+        variability = cp.multiply(self.prices, self.x) @ (centering @ _selection_matrix(selections_qty, levels_qty)).T + self.pnl_current @ centering
+        self._variances = cp.norm(variability, 2, axis=1)
+        # The markets are independent, so minimizing the sum of dispersions minimizes each one of them
+        self.min_std_problem = cp.Problem(cp.Minimize(cp.sum(self._variances)), list(constraints))
+
+        constraints.append(self._variances <= self.max_std_allowed)
+        objective = cp.Minimize(-cp.sum(cp.multiply(self.objective_coefs, self.x)))
+        self.problem = cp.Problem(objective, constraints)
+
+    def _set_parameters(self, pnl_matrices : np.array, pnl_current : np.array, volume_caps : np.array = None):
+        self.prices.value = _signed_prices(pnl_matrices)
+        self.pnl_current.value = pnl_current
+        if self.constrain_by_volume:
+            self.volume_caps.value = volume_caps
+
+    def solve_min_std(self, pnl_matrices : np.array, pnl_current : np.array, volume_caps : np.array = None) -> np.array:
+        """
+        The solve_min_std function returns the smallest achievable dispersion of the pnl outcomes of each market of the batch.
+
+        :param pnl_matrices:np.array: (markets, selections, variables) M matrix of each market
+        :param pnl_current:np.array: (markets, selections) current pnl of each selection outcome
+        :param volume_caps:np.array: (markets, variables) maximum stakes. Required if constrain_by_volume
+        :return: A (markets,) array with the minimum achievable dispersion of each market
+        """
+        self._set_parameters(pnl_matrices, pnl_current, volume_caps)
+        self.min_std_problem.solve()
+        if self.x.value is None:
+            raise Exception(f"min std batch problem status is {self.min_std_problem.status}")
+        return np.maximum(np.asarray(self._variances.value, dtype=float), 0.0)
+
+    def solve(self, pnl_matrices : np.array, pnl_current : np.array, prob_selections : np.array, max_std_allowed : np.array,
+              volume_caps : np.array = None) -> np.array:
+        """
+        The solve function solves the cashout problem of all the markets of the batch at once.
+
+        :param pnl_matrices:np.array: (markets, selections, variables) M matrix of each market
+        :param pnl_current:np.array: (markets, selections) current pnl of each selection outcome
+        :param prob_selections:np.array: (markets, selections) probability of each selection outcome
+        :param max_std_allowed:np.array: (markets,) maximum dispersion allowed for each market
+        :param volume_caps:np.array: (markets, variables) maximum stakes. Required if constrain_by_volume
+        :return: A (markets, variables) array with the optimal stakes of each market
+        """
+        self._set_parameters(pnl_matrices, pnl_current, volume_caps)
+        self.objective_coefs.value = np.einsum("ksv,ks->kv", pnl_matrices, prob_selections)
+        self.max_std_allowed.value = max_std_allowed
+        self.problem.solve()
+        if self.x.value is None:
+            raise Exception(f"cashout batch problem status is {self.problem.status}")
+        return self.x.value
+
+
+class NeutralizerProblemCache:
+    """
+    LRU caches of NeutralizerProblem templates keyed by shape (selections_qty, levels_qty, constrain_by_volume),
+    and of NeutralizerBatchProblem templates keyed by (markets_qty, selections_qty, levels_qty, constrain_by_volume).
+    The two kinds have their own LRU and size, so that the batch templates of a large refresh do not evict the single ones.
+    The caches are guarded by a lock, since the module-wide instance is shared by the threads of the process.
+    """
+    def __init__(self, maxsize : int = CASHOUT_PROBLEM_CACHE_SIZE, batch_maxsize : int = CASHOUT_BATCH_PROBLEM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.batch_maxsize = batch_maxsize
+        self._problems = OrderedDict()
+        self._batch_problems = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, problems : OrderedDict, maxsize : int, key : tuple, build):
+        with self._lock:
+            problem = problems.get(key)
+            if problem is None:
+                problem = build()
+                problems[key] = problem
+                if len(problems) > maxsize:
+                    problems.popitem(last=False)
+            else:
+                problems.move_to_end(key)
+            return problem
+
+    def get(self, selections_qty : int, levels_qty : int, constrain_by_volume : bool) -> NeutralizerProblem:
+        return self._get(self._problems, self.maxsize, (selections_qty, levels_qty, constrain_by_volume),
+                         lambda: NeutralizerProblem(selections_qty, levels_qty, constrain_by_volume))
+
+    def get_batch(self, markets_qty : int, selections_qty : int, levels_qty : int, constrain_by_volume : bool) -> NeutralizerBatchProblem:
+        return self._get(self._batch_problems, self.batch_maxsize, (markets_qty, selections_qty, levels_qty, constrain_by_volume),
+                         lambda: NeutralizerBatchProblem(markets_qty, selections_qty, levels_qty, constrain_by_volume))
+
+    def __len__(self):
+        return len(self._problems) + len(self._batch_problems)
+
+    def clear(self):
+        with self._lock:
+            self._problems.clear()
+            self._batch_problems.clear()
+
+
+neutralizer_problem_cache = NeutralizerProblemCache()
+
+
+def _get_batch_size(variables_qty : int) -> int:
+    """
+    The _get_batch_size function returns the number of markets of variables_qty stakes solved together: the largest power of two
+    up to CASHOUT_BATCH_SIZE keeping the batch within CASHOUT_BATCH_VARIABLES stakes, and at least 1
+    """
+    return min(CASHOUT_BATCH_SIZE, 1 << max(0, (CASHOUT_BATCH_VARIABLES // max(variables_qty, 1)).bit_length() - 1))
+
+
+def _get_levels_bucket(levels_qty : int) -> int:
+    """
+    The _get_levels_bucket function returns the number of levels a book of levels_qty levels is padded to for a volume constrained cashout:
+    the next power of two, so that books of full ladders of any depth share a few problem templates
+    """
+    return 1 << max(0, levels_qty - 1).bit_length()
+
+
+def pad_levels(book : BookNormalized, levels_qty : int) -> BookNormalized:
+    """
+    The pad_levels function returns book with levels_qty levels: the first ones of book, then missing levels (NaN price, size 0)
+    """
+    if book.levels_qty == levels_qty:
+        return book
+    if book.levels_qty > levels_qty:
+        return book.slice(levels=levels_qty)
+    data = np.zeros((4, levels_qty, book.selections_qty))
+    data[[BACK_PRICES, LAY_PRICES]] = np.nan
+    data[:, :book.levels_qty] = book.data
+    return BookNormalized.from_array(market_id=book.market_id, data=data, selection_ids=book.selection_ids)
+
+
+def _padded_batches(indices : np.array, batch_size : int = CASHOUT_BATCH_SIZE):
+    """
+    Splits indices into batches of at most batch_size, each one padded to a power of two by repeating its last index,
+    so that batch problem templates are reused across refreshes whatever the number of markets.
+    """
+    for start in range(0, len(indices), batch_size):
+        batch = indices[start: start + batch_size]
+        padded_qty = min(1 << (len(batch) - 1).bit_length(), batch_size)
+        yield batch, np.concatenate((batch, np.repeat(batch[-1:], padded_qty - len(batch))))
+
+
+def _clip_dispersion(pnl_current : np.array, lower : np.array, upper : np.array, mu : np.array) -> Tuple[np.array, np.array, np.array]:
+    """
+    For each market, finds the level m such that w = clip(pnl_current - m, mu * lower, mu * upper) sums to zero and returns w,
+    its derivative with respect to mu and m. The root is found exactly, since the sum is piecewise linear in m
+    with breakpoints at pnl_current - mu * lower and pnl_current - mu * upper.
+    """
+    mu = mu[:, None]
+    breakpoints = np.sort(np.concatenate((pnl_current - mu * lower, pnl_current - mu * upper), axis=1), axis=1)
+    sums = np.clip(pnl_current[:, None, :] - breakpoints[:, :, None], (mu * lower)[:, None, :], (mu * upper)[:, None, :]).sum(axis=2)
+    rows = np.arange(len(breakpoints))
+    idx = np.clip((sums >= 0).sum(axis=1) - 1, 0, breakpoints.shape[1] - 2)
+    m0, m1 = breakpoints[rows, idx], breakpoints[rows, idx + 1]
+    s0, s1 = sums[rows, idx], sums[rows, idx + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        m = np.where(s0 != s1, m0 + (m1 - m0) * s0 / (s0 - s1), m0)[:, None]
+
+    w = np.clip(pnl_current - m, mu * lower, mu * upper)
+    at_lower = w <= mu * lower
+    at_upper = ~at_lower & (w >= mu * upper)
+    free = ~(at_lower | at_upper)
+    clipped_slope = np.where(at_lower, lower, 0) + np.where(at_upper, upper, 0)
+    dm_dmu = clipped_slope.sum(axis=1, keepdims=True) / np.maximum(free.sum(axis=1, keepdims=True), 1)
+    dw_dmu = np.where(free, -dm_dmu, clipped_slope)
+    return w, dw_dmu, m
+
+
+def equalise_outcomes(pnl_current : np.array, back_prices : np.array, lay_prices : np.array, prob_selections : np.array,
+                      max_std_allowed : np.array) -> Tuple[np.array, np.array]:
+    """
+    The equalise_outcomes function is a pure NumPy solver of the cashout problem without volume constraints, vectorized over markets.
+    It maximizes the expected pnl subject to the norm of the pnl outcomes dispersion being below max_std_allowed, as in NeutralizerProblem.
+
+    Without volume caps, only the best back and lay price of each selection are used, and the pnl of outcome i moves by
+    u_i = back_price_i * back_stake_i - lay_price_i * lay_stake_i plus a term common to all outcomes. The expected pnl is then
+    separable and piecewise linear in u, and the optimality conditions give u = m + clip(pnl_current - m, mu * lower, mu * upper) - pnl_current,
+    where lower/upper are the expected pnl slopes of backing/laying (lower <= upper as long as back prices are below lay prices).
+    The multiplier mu is found with a safeguarded Newton search on the dispersion, and m exactly for each mu.
+
+    :param pnl_current:np.array: (markets, selections) current pnl of each selection outcome
+    :param back_prices:np.array: (markets, levels, selections) back prices of the book
+    :param lay_prices:np.array: (markets, levels, selections) lay prices of the book
+    :param prob_selections:np.array: (markets, selections) probability of each selection outcome
+    :param max_std_allowed:np.array: (markets,) maximum dispersion allowed for the pnl outcomes after the cashout
+    :return: The (markets, 2 * selections * levels) optimal stakes, ordered as in Cashout.get_pnl_matrix, and a (markets,) mask
+    of the markets that could be solved. Markets with arbitrage in the book, crossed prices, a selection without back or lay price
+    or max_std_allowed <= 0 are not supported.
+    """
+    markets_qty, levels_qty, selections_qty = back_prices.shape
+    # Missing levels (NaN prices) are never the best ones
+    back_prices = np.where(np.isnan(back_prices), -np.inf, back_prices)
+    lay_prices = np.where(np.isnan(lay_prices), np.inf, lay_prices)
+    best_back_level = back_prices.argmax(axis=1)
+    best_lay_level = lay_prices.argmin(axis=1)
+    best_back_prices = back_prices.max(axis=1)
+    best_lay_prices = lay_prices.min(axis=1)
+
+    prob_total = prob_selections.sum(axis=1, keepdims=True)
+    lower = prob_selections - prob_total / best_back_prices
+    upper = prob_selections - prob_total / best_lay_prices
+    # Backing or laying every selection in proportion to its price moves all outcomes together, so the book must not allow it for a profit
+    supported = (best_back_prices <= best_lay_prices).all(axis=1) & (lower.sum(axis=1) < 0) & (upper.sum(axis=1) > 0) & (max_std_allowed > 0) \
+        & np.isfinite(best_back_prices).all(axis=1) & np.isfinite(best_lay_prices).all(axis=1)
+
+    deviation = pnl_current - pnl_current.mean(axis=1, keepdims=True)
+    # Not cashing out is optimal if it is within the dispersion limit and neither backing nor laying increases the expected pnl
+    no_cashout = (np.linalg.norm(deviation, axis=1) <= max_std_allowed) & (lower <= 0).all(axis=1) & (upper >= 0).all(axis=1)
+    needs_cashout = supported & ~no_cashout
+
+    u = np.zeros((markets_qty, selections_qty))
+    if needs_cashout.any():
+        pnl, lo, up, target = pnl_current[needs_cashout], lower[needs_cashout], upper[needs_cashout], max_std_allowed[needs_cashout]
+
+        # Dispersion is nondecreasing in mu and is 0 at mu = 0. Find an upper bracket where it reaches the target
+        mu_low = np.zeros(len(pnl))
+        mu_high = (np.linalg.norm(deviation[needs_cashout], axis=1) + target) / np.maximum(np.abs(lo), np.abs(up)).min(axis=1)
+        for _ in range(NUMPY_ENGINE_MAX_ITERATIONS):
+            w, _, _ = _clip_dispersion(pnl, lo, up, mu_high)
+            below_target = np.linalg.norm(w, axis=1) < target
+            if not below_target.any():
+                break
+            mu_low = np.where(below_target, mu_high, mu_low)
+            mu_high = np.where(below_target, 2 * mu_high, mu_high)
+
+        mu = mu_high
+        for _ in range(NUMPY_ENGINE_MAX_ITERATIONS):
+            w, dw_dmu, m = _clip_dispersion(pnl, lo, up, mu)
+            dispersion = np.linalg.norm(w, axis=1)
+            excess = dispersion - target
+            converged = np.abs(excess) <= NUMPY_ENGINE_TOLERANCE * target
+            if converged.all():
+                break
+            mu_low = np.where(excess <= 0, mu, mu_low)
+            mu_high = np.where(excess > 0, mu, mu_high)
+            # w is linear in mu while the clipped outcomes do not change, so a Newton step on the dispersion is nearly exact.
+            # Far from the root, scale mu by target / dispersion, which is exact once every outcome is clipped (w proportional to mu)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                slope = (w * dw_dmu).sum(axis=1) / dispersion
+                mu_newton = mu - excess / slope
+                mu_scaled = mu * target / dispersion
+            newton_inside = (slope > 0) & (mu_newton > mu_low) & (mu_newton < mu_high)
+            scaled_inside = (mu_scaled > mu_low) & (mu_scaled < mu_high)
+            mu_next = np.where(newton_inside, mu_newton, np.where(scaled_inside, mu_scaled, (mu_low + mu_high) / 2))
+            mu = np.where(converged, mu, mu_next)
+        else:
+            # Fall back to the last mu known to satisfy the dispersion constraint
+            mu = np.where(converged, mu, mu_low)
+            w, _, m = _clip_dispersion(pnl, lo, up, mu)
+        u[needs_cashout] = m + w - pnl
+
+    stakes = np.zeros((markets_qty, levels_qty, 2, selections_qty))
+    markets_idx, selections_idx = np.indices((markets_qty, selections_qty))
+    stakes[markets_idx, best_back_level, 0, selections_idx] = np.maximum(u, 0) / best_back_prices
+    stakes[markets_idx, best_lay_level, 1, selections_idx] = np.maximum(-u, 0) / best_lay_prices
+    stakes[~supported] = 0
+    return stakes.reshape(markets_qty, -1), supported
 
 class Cashout:
     def __init__(self, market_book : BookNormalized, matched_orders : Dict[int, List[Order]],
-                 open_orders: Dict[int, List[Order]], mode : Literal["maker", "taker"], constrain_by_volume : bool = True, max_std_allowed : float = 0.05):
-        self.market_book = market_book
+                 open_orders: Dict[int, List[Order]], mode : Literal["maker", "taker"], constrain_by_volume : bool = True, max_std_allowed : float = 0.05,
+                 problem_cache : NeutralizerProblemCache = None, engine : Literal["cvxpy", "numpy"] = "cvxpy",
+                 pnl_outcomes : Dict = None):
+        """
+        :param pnl_outcomes:Dict: Optional pnl of each selection outcome, as returned by get_pnl_outcomes.
+        If given, it is used instead of computing it from matched_orders, which can then be empty
+        """
+        # Without volume caps the best level of each side is always the best price to trade, so the deeper ones are dropped.
+        # With volume caps, the levels are padded to a power of two so that books of any depth share a few problem templates
+        self.market_book = pad_levels(market_book, _get_levels_bucket(market_book.levels_qty) if constrain_by_volume else 1)
         self.matched_orders = self.fill_missing_selections(orders = matched_orders, selection_ids=self.market_book.selection_ids)
         self.open_orders = open_orders
         self.mode = mode
         self.max_std_allowed = max_std_allowed
-        self.pnl_outcomes = get_pnl_outcomes(self.matched_orders, self.market_book.selection_ids)
+        self.pnl_outcomes = get_pnl_outcomes(self.matched_orders, self.market_book.selection_ids) if pnl_outcomes is None else pnl_outcomes
         self.constrain_by_volume = constrain_by_volume
+        self.problem_cache = neutralizer_problem_cache if problem_cache is None else problem_cache
+        if engine not in ("cvxpy", "numpy"):
+            raise Exception("engine must be cvxpy or numpy")
+        self.engine = engine
+
     def get_cashout_orders(self) -> List[Order]:
         """
         The get_cashout_orders function is called by the executioner to place orders on the market.
@@ -62,6 +491,145 @@ class Cashout:
             return self._get_neutralizer_orders_retry(max_std_allowed=2*max_std_allowed)
 
 
+    @classmethod
+    def solve_many(cls, books : List[BookNormalized], matched_orders : Dict[str, Dict], open_orders : Dict[str, Dict],
+                   mode : Literal["maker", "taker"], constrain_by_volume : bool = True, max_std_allowed : float = 0.05,
+                   engine : Literal["cvxpy", "numpy"] = "cvxpy", max_std_cap : float = MAX_STD_CAP,
+                   problem_cache : NeutralizerProblemCache = None, positions : PositionLedger = None) -> Dict[str, CashoutOutput]:
+        """
+        The solve_many function computes the cashout of many markets at once, with the semantics of _get_neutralizer_orders_min_risk.
+        Markets with the same shape are stacked and solved together, with the vectorized numpy engine when possible,
+        and otherwise with block-diagonal cvxpy problems of up to CASHOUT_BATCH_SIZE markets (fewer for deep books, see _get_batch_size).
+
+        :param books:List[BookNormalized]: The normalized books of the markets
+        :param matched_orders:Dict[str, Dict]: The matched orders of each market, as returned by split_matched_and_open
+        :param open_orders:Dict[str, Dict]: The open orders of each market, as returned by split_matched_and_open
+        :param positions:PositionLedger: Optional ledger of the matched positions. If given, the pnl outcomes are read from it instead of matched_orders
+        :return: A dictionary with the CashoutOutput of each market_id (None if no cashout is possible), in the order of books
+        """
+        outputs = {}
+        groups = {}
+        for book in books:
+            cashout = cls(market_book=book, matched_orders=matched_orders.get(book.market_id, {}),
+                          open_orders=open_orders.get(book.market_id, {}), mode=mode, constrain_by_volume=constrain_by_volume,
+                          max_std_allowed=max_std_allowed, problem_cache=problem_cache, engine=engine,
+                          pnl_outcomes=positions.get_pnl_outcomes(book.market_id, book.selection_ids) if positions is not None else None)
+            if book.selections_qty == 1:
+                outputs[book.market_id] = cashout._get_single_selection_output()
+            else:
+                groups.setdefault((book.selections_qty, cashout.market_book.levels_qty), []).append(cashout)
+
+        for cashouts in groups.values():
+            outputs.update(cls._solve_same_shape(cashouts, max_std_allowed=max_std_allowed, max_std_cap=max_std_cap))
+        return {book.market_id: outputs[book.market_id] for book in books}
+
+    @staticmethod
+    def _solve_same_shape(cashouts : List["Cashout"], max_std_allowed : float, max_std_cap : float) -> Dict[str, CashoutOutput]:
+        first = cashouts[0]
+        selections_qty, levels_qty = first.market_book.selections_qty, first.market_book.levels_qty
+        constrain_by_volume = first.constrain_by_volume
+        markets_qty = len(cashouts)
+        batch_size = _get_batch_size(2 * selections_qty * levels_qty)
+
+        pnl_current = np.array([cashout.get_pnl_selections_current() for cashout in cashouts])
+        prob_selections = np.array([cashout.get_prob_selections() for cashout in cashouts])
+        pnl_matrices = np.array([cashout.get_pnl_matrix() for cashout in cashouts])
+        volume_caps = np.array([cashout.get_volume_caps() for cashout in cashouts]) if constrain_by_volume else None
+        max_std = np.full(markets_qty, max_std_allowed, dtype=float)
+        solves_qty = np.ones(markets_qty, dtype=int)
+        stakes = np.zeros((markets_qty, 2 * selections_qty * levels_qty))
+        pending = np.ones(markets_qty, dtype=bool)
+        failed = np.zeros(markets_qty, dtype=bool)
+
+        if first.engine == "numpy" and not constrain_by_volume:
+            numpy_stakes, supported = equalise_outcomes(
+                pnl_current=pnl_current,
+                back_prices=np.array([cashout.market_book.back_prices for cashout in cashouts]),
+                lay_prices=np.array([cashout.market_book.lay_prices for cashout in cashouts]),
+                prob_selections=prob_selections,
+                max_std_allowed=max_std,
+            )
+            stakes[supported] = numpy_stakes[supported]
+            pending &= ~supported
+
+        # Clamp max_std_allowed to the smallest achievable dispersion, which is 0 without volume caps
+        if constrain_by_volume:
+            dispersion = np.linalg.norm(pnl_current - pnl_current.mean(axis=1, keepdims=True), axis=1)
+            needs_min_std = pending & (dispersion > max_std)
+            min_std = np.zeros(markets_qty)
+            for batch, padded in _padded_batches(np.flatnonzero(needs_min_std), batch_size=batch_size):
+                problem = first.problem_cache.get_batch(len(padded), selections_qty, levels_qty, constrain_by_volume)
+                try:
+                    min_std[batch] = problem.solve_min_std(pnl_matrices[padded], pnl_current[padded], volume_caps[padded])[:len(batch)]
+                except Exception as e:
+                    print(f"CASHOUT - Failed min std batch of {len(batch)} markets : {e}. Solving them one by one")
+                    failed[batch] = True
+            solves_qty[needs_min_std] += 1
+            too_risky = needs_min_std & ~failed & (min_std > max_std_cap)
+            pending &= ~(too_risky | failed)
+            max_std = np.where(needs_min_std, np.maximum(max_std, min_std * (1 + MIN_STD_MARGIN) + MIN_STD_MARGIN), max_std)
+
+        for batch, padded in _padded_batches(np.flatnonzero(pending), batch_size=batch_size):
+            problem = first.problem_cache.get_batch(len(padded), selections_qty, levels_qty, constrain_by_volume)
+            try:
+                stakes[batch] = problem.solve(pnl_matrices[padded], pnl_current[padded], prob_selections[padded], max_std[padded],
+                                              volume_caps[padded] if constrain_by_volume else None)[:len(batch)]
+            except Exception as e:
+                print(f"CASHOUT - Failed batch of {len(batch)} markets : {e}. Solving them one by one")
+                failed[batch] = True
+                pending[batch] = False
+
+        outputs = {}
+        for idx, cashout in enumerate(cashouts):
+            market_id = cashout.market_book.market_id
+            if failed[idx]:
+                outputs[market_id] = cashout._get_neutralizer_orders_min_risk(max_std_allowed=max_std_allowed, max_std_cap=max_std_cap)
+            elif constrain_by_volume and too_risky[idx]:
+                print(f"CASHOUT - min std achievable {min_std[idx]} is above {max_std_cap}. Returning no orders to cashout")
+                outputs[market_id] = None
+            else:
+                outputs[market_id] = cashout.solution_to_output(stakes[idx], max_std_allowed=max_std[idx],
+                                                                solves_qty=int(solves_qty[idx]), pnl_matrix=pnl_matrices[idx])
+        return outputs
+
+    def _get_neutralizer_orders_min_risk(self, max_std_allowed, max_std_cap : float = MAX_STD_CAP) -> CashoutOutput:
+        """
+        The _get_neutralizer_orders_min_risk function is an alternative to _get_neutralizer_orders_retry with bounded latency.
+        Instead of doubling max_std_allowed until the problem becomes feasible, it computes the smallest achievable
+        dispersion of the pnl outcomes with one auxiliary solve, clamps max_std_allowed to it and solves the cashout once.
+
+        :param max_std_allowed: Requested maximum dispersion of the pnl outcomes after the cashout
+        :param max_std_cap: Return no orders if the smallest achievable dispersion is above this value
+        :return: A CashoutOutput reporting the max_std_used and the number of solves, or None if no cashout is possible
+        """
+        if self.market_book.selections_qty == 1:
+            return self._get_single_selection_output()
+
+        try:
+            pnl_selections_current = self.get_pnl_selections_current()
+            solves_qty = 1
+            # Not cashing out is feasible if the current dispersion is already within the limit
+            # Without volume caps any pnl outcomes can be reached, so the smallest achievable dispersion is 0
+            if self.constrain_by_volume and np.linalg.norm(pnl_selections_current - pnl_selections_current.mean()) > max_std_allowed:
+                problem = self.problem_cache.get(selections_qty=self.market_book.selections_qty,
+                                                 levels_qty=self.market_book.levels_qty,
+                                                 constrain_by_volume=self.constrain_by_volume)
+                volume_caps = self.get_volume_caps() if self.constrain_by_volume else None
+                min_std = problem.solve_min_std(pnl_matrix=self.get_pnl_matrix(), pnl_current=pnl_selections_current, volume_caps=volume_caps)
+                solves_qty += 1
+                if min_std > max_std_cap:
+                    print(f"CASHOUT - min std achievable {min_std} is above {max_std_cap}. Returning no orders to cashout")
+                    return None
+                max_std_allowed = max(max_std_allowed, min_std * (1 + MIN_STD_MARGIN) + MIN_STD_MARGIN)
+
+            cashout_output = self._get_neutralizer_orders(max_std_allowed=max_std_allowed)
+        except Exception as e:
+            print(f"CASHOUT - Failed with max_std = {max_std_allowed} : {e}")
+            return None
+
+        cashout_output.solves_qty = solves_qty
+        return cashout_output
+
     def _get_neutralizer_orders(self, max_std_allowed = None) -> CashoutOutput:
         """
         The _get_neutralizer_orders_single_selection function is a helper function that returns the orders to neutralize the position of in a market.
@@ -76,75 +644,113 @@ class Cashout:
         if max_std_allowed is None:
             max_std_allowed = self.max_std_allowed
 
-        book_back_prices = deepcopy(self.market_book.back_prices)
-        book_lay_prices = deepcopy(self.market_book.lay_prices)
         # TODO: Add a check not to cashout if pnl is too much degradeted
         # TODO: Add mechanism to zero small orders before computing actual pnl
         # TODO: Add a mechanism to retry the optimization with a less rigid constraint on variance
 
         if self.market_book.selections_qty == 1:
-            parsed_orders = self._get_neutralizer_orders_single_selection()
-            return parsed_orders
-
-        # This will handle the vector of optimal stakes
-        x = cp.Variable(2 * self.market_book.selections_qty * self.market_book.levels_qty)
-
-        pnl_selections_current = np.array([self.pnl_outcomes[selection] for selection in self.market_book.selection_ids])
-        prob_selections = 0.5 / (book_back_prices[0]) + 0.5 / (book_lay_prices[0])
-        expected_pnl_current = pnl_selections_current @ prob_selections.T
+            return self._get_single_selection_output()
 
-        # Remove 1 from odds
-        for i in range(self.market_book.levels_qty):
-            book_back_prices[i] -= 1
-            book_lay_prices[i] -= 1
+        pnl_selections_current = self.get_pnl_selections_current()
+        prob_selections = self.get_prob_selections()
 
         # Compute M matrix that computes pnl for different selection_id outcomes
-        M = []
-        for level in range(self.market_book.levels_qty):
-            back_diag = -1 * np.ones((self.market_book.selections_qty, self.market_book.selections_qty))
-            np.fill_diagonal(back_diag, book_back_prices[level])
-
-            lay_diag = np.ones((self.market_book.selections_qty, self.market_book.selections_qty))
-            np.fill_diagonal(lay_diag, -book_lay_prices[level])
-            M_level = np.concatenate((back_diag, lay_diag), axis=1)
-            M.append(M_level)
-        M = np.concatenate(M, axis=1)
-        pnl_selections_delta = M @ x
-
-        pnl_selections_new = pnl_selections_delta + pnl_selections_current
-        expected_pnl_new = pnl_selections_new @ prob_selections
-
-        variability = pnl_selections_new - cp.sum(pnl_selections_new)/self.market_book.selections_qty
-        variance = cp.norm(variability)
-
-        constraints = [x >= 0]
-        if self.constrain_by_volume:
-            size_constraints = self.create_bounds(x)
-            constraints.extend(size_constraints)
+        M = self.get_pnl_matrix()
+
+        opt_stake_array = None
+        if self.engine == "numpy":
+            opt_stake_array = self._solve_numpy(pnl_selections_current, prob_selections, max_std_allowed)
+        if opt_stake_array is None:
+            problem = self.problem_cache.get(selections_qty=self.market_book.selections_qty,
+                                             levels_qty=self.market_book.levels_qty,
+                                             constrain_by_volume=self.constrain_by_volume)
+            volume_caps = self.get_volume_caps() if self.constrain_by_volume else None
+            opt_stake_array = problem.solve(market_id=self.market_book.market_id, pnl_matrix=M,
+                                            pnl_current=pnl_selections_current, prob_selections=prob_selections,
+                                            max_std_allowed=max_std_allowed, volume_caps=volume_caps)
+
+        cashout_output = self.solution_to_output(opt_stake_array, max_std_allowed=max_std_allowed, solves_qty=1, pnl_matrix=M)
+        return cashout_output
 
-        constraints.append((variance <= max_std_allowed))
-        objective = cp.Minimize(-expected_pnl_new)
-        prob = cp.Problem(objective, constraints)
-        result = prob.solve()
+    def solution_to_output(self, opt_stake_array : np.array, max_std_allowed : float, solves_qty : int, pnl_matrix : np.array = None) -> CashoutOutput:
+        """
+        The solution_to_output function builds the CashoutOutput of a vector of optimal stakes.
 
-        parsed_orders = self.vector_solution_to_orders(x.value)
+        :param opt_stake_array:np.array: Vector of optimal stakes, ordered as in get_pnl_matrix
+        :param max_std_allowed:float: Maximum dispersion used to compute the stakes
+        :param solves_qty:int: Number of solves used to compute the stakes
+        :param pnl_matrix:np.array: The output of get_pnl_matrix, if already computed
+        :return: The CashoutOutput
+        """
+        M = self.get_pnl_matrix() if pnl_matrix is None else pnl_matrix
+        # The stakes of missing levels have no effect in M, so the solver may leave any value there
+        opt_stake_array = np.where(self.get_stakes_mask(), opt_stake_array, 0)
+        pnl_selections_current = self.get_pnl_selections_current()
+        prob_selections = self.get_prob_selections()
+        expected_pnl_current = pnl_selections_current @ prob_selections.T
 
-        print(f"Expected PNL before: {expected_pnl_current}")
-        print(f"expected PNL after ideal neutralization: {expected_pnl_new.value}")
+        pnl_selections_new = M @ opt_stake_array + pnl_selections_current
+        expected_pnl_new = pnl_selections_new @ prob_selections
 
-        print(f"PNL selections before: {pnl_selections_current}")
-        print(f"PNL selections after: {pnl_selections_new.value}")
+        parsed_orders = self.vector_solution_to_orders(opt_stake_array)
 
         cashout_output = CashoutOutput(
             orders = parsed_orders,
             expected_pnl_before = expected_pnl_current,
-            expected_pnl_after = expected_pnl_new.value,
+            expected_pnl_after = expected_pnl_new,
             worst_outcome_before = min(self.pnl_outcomes.values()),
             worst_outcome_after = None,
+            max_std_used = max_std_allowed,
+            solves_qty = solves_qty,
         )
-
         return cashout_output
 
+    def _solve_numpy(self, pnl_selections_current : np.array, prob_selections : np.array, max_std_allowed : float) -> Union[np.array, None]:
+        """
+        The _solve_numpy function solves the cashout problem with the equalise_outcomes NumPy engine.
+        It returns None for the cases the engine cannot handle (volume constraints, arbitrage in the book, max_std_allowed <= 0),
+        so the caller falls back to cvxpy.
+        """
+        if self.constrain_by_volume:
+            return None
+        opt_stake_array, supported = equalise_outcomes(
+            pnl_current=pnl_selections_current[None, :],
+            back_prices=self.market_book.back_prices[None],
+            lay_prices=self.market_book.lay_prices[None],
+            prob_selections=prob_selections[None, :],
+            max_std_allowed=np.array([max_std_allowed], dtype=float),
+        )
+        if not supported[0]:
+            logger.info(f"CASHOUT market {self.market_book.market_id}: numpy engine not supported. Falling back to cvxpy")
+            return None
+        return opt_stake_array[0]
+
+    def _get_single_selection_output(self) -> Union[CashoutOutput, None]:
+        """
+        The _get_single_selection_output function wraps the orders of _get_neutralizer_orders_single_selection in a CashoutOutput,
+        with the expected pnl of the two outcomes (the selection wins or not) before and after them. None if there is no price to trade
+        """
+        orders = self._get_neutralizer_orders_single_selection()
+        if orders is None:
+            return None
+        selection_id = self.market_book.selection_ids[0]
+        pnl_happen, pnl_not_happen = self.pnl_outcomes[selection_id], self.pnl_outcomes["complementary"]
+        prob_happen = self.get_prob_selections()[0]
+        expected_pnl_before = prob_happen * pnl_happen + (1 - prob_happen) * pnl_not_happen
+        for order in orders:
+            sign = 1 if order.side == "BACK" else -1
+            pnl_happen += sign * (order.price - 1) * order.size_remaining
+            pnl_not_happen -= sign * order.size_remaining
+        return CashoutOutput(
+            orders = orders,
+            expected_pnl_before = expected_pnl_before,
+            expected_pnl_after = prob_happen * pnl_happen + (1 - prob_happen) * pnl_not_happen,
+            worst_outcome_before = min(self.pnl_outcomes.values()),
+            worst_outcome_after = None,
+            max_std_used = 0,
+            solves_qty = 0,
+        )
+
     def _get_neutralizer_orders_single_selection(self) -> List[Order]:
         """
         The _get_neutralizer_orders_single_selection function is a helper function that returns the orders to neutralize the position of a single selection.
@@ -173,8 +779,12 @@ class Cashout:
                 best_lay_price = self.market_book.back_prices[0][0]
             else:
                 raise Exception("mode must be taker or maker")
+            if np.isnan(best_lay_price):
+                logger.info(f"CASHOUT market {self.market_book.market_id}: no price to lay selection {selection_id}")
+                return None
             qty_to_lay = (pnl_event_happen - pnl_not_happen) / best_lay_price
-            lay_order = {"selection_id": selection_id, "side": "LAY", "price": best_lay_price, "size_remaining": qty_to_lay}
+            lay_order = {"market_id": self.market_book.market_id, "runner_id": selection_id, "selection_id": selection_id, "side": "LAY",
+                         "price": best_lay_price, "size_remaining": qty_to_lay}
             return [Order(**lay_order)]
         else:
             if self.mode == "taker":
@@ -183,8 +793,12 @@ class Cashout:
                 best_back_price = self.market_book.lay_prices[0][0]
             else:
                 raise Exception("mode must be taker or maker")
+            if np.isnan(best_back_price):
+                logger.info(f"CASHOUT market {self.market_book.market_id}: no price to back selection {selection_id}")
+                return None
             qty_to_back = (pnl_not_happen - pnl_event_happen) / best_back_price
-            back_order = {"selection_id": selection_id, "side": "BACK", "price": best_back_price, "size_remaining": qty_to_back}
+            back_order = {"market_id": self.market_book.market_id, "runner_id": selection_id, "selection_id": selection_id, "side": "BACK",
+                          "price": best_back_price, "size_remaining": qty_to_back}
             return [Order(**back_order)]
 
     @staticmethod
@@ -197,14 +811,69 @@ class Cashout:
         :param orders:Dict[int: Store the orders for each selection
         :param Dict]: Store the orders for each selection
         :param selection_ids:List[int]: Store a list of selection ids that are present in the orderbook
-        :return: A dictionary of orderbooks with all the selections that are missing in each orderbook
+        :return: A dictionary of orderbooks with all the selections that are missing in each orderbook.
+        The input is not copied: each selection maps to a read-only view of the caller's {"BACK": [...], "LAY": [...]} dictionary
         """
-        orders = deepcopy(orders)
-        missing_selection_positions = selection_ids - orders.keys()
-        for selection_id in missing_selection_positions:
-            orders[selection_id] = {"BACK": [], "LAY": []}
-        orders = OrderedDict(sorted(orders.items()))
-        return orders
+        filled_orders = {selection_id: MappingProxyType(selection_orders) for selection_id, selection_orders in orders.items()}
+        for selection_id in selection_ids - orders.keys():
+            filled_orders[selection_id] = EMPTY_POSITION
+        return OrderedDict(sorted(filled_orders.items()))
+
+    def get_pnl_selections_current(self) -> np.array:
+        """
+        :return: The current pnl of each selection outcome, ordered as the selection_ids of the book
+        """
+        return np.array([self.pnl_outcomes[selection] for selection in self.market_book.selection_ids])
+
+    def get_prob_selections(self) -> np.array:
+        """
+        :return: The probability of each selection outcome, implied by the mid of the best back and lay prices.
+        If one side has no price, the other one is used, and the probability is 0 without any price
+        """
+        implied = 1 / np.stack((self.market_book.back_prices[0], self.market_book.lay_prices[0]))
+        prices_qty = (~np.isnan(implied)).sum(axis=0)
+        return np.divide(np.nansum(implied, axis=0), prices_qty, out=np.zeros(self.market_book.selections_qty), where=prices_qty > 0)
+
+    def get_pnl_matrix(self) -> np.array:
+        """
+        The get_pnl_matrix function computes the M matrix such that M @ x is the pnl delta of each selection outcome
+        for the vector of stakes x = [back level 0, lay level 0, back level 1, lay level 1, ...]
+
+        :param self: Access the variables and methods of the class in which it is used
+        :return: A (selections_qty, 2 * selections_qty * levels_qty) matrix. The columns of missing levels are 0
+        """
+        selections_qty = self.market_book.selections_qty
+        M = []
+        for level in range(self.market_book.levels_qty):
+            back_diag = -1 * np.ones((selections_qty, selections_qty))
+            np.fill_diagonal(back_diag, self.market_book.back_prices[level] - 1)
+
+            lay_diag = np.ones((selections_qty, selections_qty))
+            np.fill_diagonal(lay_diag, -(self.market_book.lay_prices[level] - 1))
+            M.append(back_diag)
+            M.append(lay_diag)
+        M = np.concatenate(M, axis=1)
+        M[:, ~self.get_stakes_mask()] = 0
+        return M
+
+    def get_stakes_mask(self) -> np.array:
+        """
+        :return: A 2 * selections_qty * levels_qty boolean array, ordered as in get_pnl_matrix, True where the level of the stake exists
+        """
+        return np.stack((self.market_book.back_mask, self.market_book.lay_mask), axis=1).reshape(-1)
+
+    def get_volume_caps(self) -> np.array:
+        """
+        The get_volume_caps function returns the maximum stake of each element of the stakes vector, ordered as in get_pnl_matrix
+
+        :param self: Access the variables and methods of the class in which it is used
+        :return: A 2 * selections_qty * levels_qty array of sizes available in the book
+        """
+        caps = []
+        for level in range(self.market_book.levels_qty):
+            caps.append(self.market_book.back_sizes[level])
+            caps.append(self.market_book.lay_sizes[level])
+        return np.where(self.get_stakes_mask(), np.concatenate(caps).astype(float), 0)
 
     def create_bounds(self, x : np.array) -> List:
         """
@@ -236,35 +905,39 @@ class Cashout:
         the problem: given a set of market prices (back_prices, lay_prices) and a desired minimum variance in pnl outcomes, what are the optimal orders to optimize the expected pnl?
         The solution is found by minimising over all possible combinations of back/lay orders for each selection. The result is an array
         of optimal stakes for each combination - (SELECTION_ID, PRICE, SIDE), one per order. This function then converts that array into a list containing all orders
+        with a stake that does not round to 0
 
         """
+        if self.mode == "taker":
+            back_order_prices, lay_order_prices = self.market_book.back_prices, self.market_book.lay_prices
+        elif self.mode == "maker":
+            back_order_prices, lay_order_prices = self.market_book.lay_prices, self.market_book.back_prices
+        else:
+            raise Exception("mode must be maker or taker")
+
+        # (levels, selections, side) stakes, so that orders come out by level, then selection, then BACK before LAY
+        stakes = np.round(np.asarray(opt_stake_array).reshape(self.market_book.levels_qty, 2, self.market_book.selections_qty), 1).transpose(0, 2, 1)
+        prices = np.stack((back_order_prices, lay_order_prices), axis=2)
+
+        # Zero stakes, and the ones without a price to place them at, are not emitted
         orders = []
-        selections_qty = len(self.market_book.back_prices[0])
-        levels_qty = len(self.market_book.back_prices)
-
-        for level in range(levels_qty):
-            for selection_number in range(selections_qty):
-                selection_id = self.market_book.selection_ids[selection_number]
-                back_idx = 2 * level * selections_qty + selection_number
-                lay_idx = (2 * level + 1) * selections_qty + selection_number
-
-                back_order_qty = opt_stake_array[back_idx]
-                lay_order_qty = opt_stake_array[lay_idx]
-
-                if self.mode == "taker":
-                    back_order_px = self.market_book.back_prices[level][selection_number]
-                    lay_order_px = self.market_book.lay_prices[level][selection_number]
-                elif self.mode == "maker":
-                    back_order_px = self.market_book.lay_prices[level][selection_number]
-                    lay_order_px = self.market_book.back_prices[level][selection_number]
-                else:
-                    raise Exception("mode must be maker or taker")
-                back_order = {"market_id" : self.market_book.market_id, "runner_id": selection_id, "side": "BACK", "price": back_order_px, "size_remaining": round(back_order_qty, 1)}
-                lay_order = {"market_id" : self.market_book.market_id, "runner_id": selection_id, "side": "LAY", "price": lay_order_px, "size_remaining": round(lay_order_qty, 1)}
-                orders.append(Order(**back_order))
-                orders.append(Order(**lay_order))
+        for level, selection_number, side in zip(*np.nonzero((stakes > 0) & ~np.isnan(prices))):
+            orders.append(Order(market_id=self.market_book.market_id, runner_id=self.market_book.selection_ids[selection_number],
+                                side=SIDES[side], price=prices[level, selection_number, side],
+                                size_remaining=stakes[level, selection_number, side]))
         return orders
 
+    def reconcile(self, orders : List[Order], min_stake : float = MIN_STAKE) -> Tuple[List[Order], List[Order], List[Order]]:
+        """
+        The reconcile function compares the target orders of a cashout with the open orders of the market,
+        and returns the minimal (orders_to_cancel, orders_to_replace, orders_to_place) to pass to Exchange.execute (see utils_orders.reconcile_orders)
+
+        :param orders:List[Order]: The target orders, e.g. CashoutOutput.orders
+        :param min_stake:float: The minimum stake accepted by the exchange
+        """
+        open_orders = [order for selection_orders in self.open_orders.values() for order in selection_orders]
+        return reconcile_orders(orders, open_orders, min_stake=min_stake)
+
     def check_positions_balanced(self) -> bool:
         """
         The check_positions_balanced function checks whether the positions are balanced.
@@ -0,0 +1,271 @@
+import numpy as np
+import pandas as pd
+from typing import List, Dict, Iterable, Iterator, Tuple
+from src.utils import Order
+
+MIN_STAKE = 1  # Betfair minimum stake, in the account currency
+
+ORDER_COLUMNS = {
+    "market_id": object,
+    "runner_id": np.int64,
+    "price": np.float64,
+    "size_remaining": np.float64,
+    "size_matched": np.float64,
+    "side": object,
+    "bet_id": object,
+}
+
+
+class OrderView:
+    """
+    Read-only view of one row of an OrderTable, with the attributes of utils.Order.
+    It only holds the table and the row number, so iterating over a table does not copy the orders.
+    """
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table : "OrderTable", row : int):
+        self._table = table
+        self._row = row
+
+    @property
+    def market_id(self) -> str:
+        return self._table._columns["market_id"][self._row]
+
+    @property
+    def runner_id(self) -> int:
+        return int(self._table._columns["runner_id"][self._row])
+
+    @property
+    def price(self) -> float:
+        return float(self._table._columns["price"][self._row])
+
+    @property
+    def size_remaining(self) -> float:
+        return float(self._table._columns["size_remaining"][self._row])
+
+    @property
+    def size_matched(self) -> float:
+        return float(self._table._columns["size_matched"][self._row])
+
+    @property
+    def side(self) -> str:
+        return self._table._columns["side"][self._row]
+
+    @property
+    def bet_id(self) -> str:
+        return self._table._columns["bet_id"][self._row]
+
+    def to_dict(self) -> Dict:
+        return {column: getattr(self, column) for column in ORDER_COLUMNS}
+
+    def to_order(self) -> Order:
+        return Order(**self.to_dict())
+
+    def __repr__(self):
+        return str(self.to_dict())
+
+    def __eq__(self, other):
+        return self.price == other.price and self.size_remaining == other.size_remaining and self.side == other.side and \
+               self.market_id == other.market_id and self.runner_id == other.runner_id
+
+
+class OrderTable:
+    """
+    Current orders of the account stored as one NumPy array per column of utils.Order (see ORDER_COLUMNS).
+    Iterating over the table yields OrderView rows, so it can be used wherever a list of Order is expected.
+    Lookups by market_id, runner_id and side go through indexes built on first use and dropped on append.
+    """
+    def __init__(self, capacity : int = 1024):
+        self._columns = {column: np.empty(capacity, dtype=dtype) for column, dtype in ORDER_COLUMNS.items()}
+        self._rows_qty = 0
+        self._indexes = {}
+
+    @classmethod
+    def from_orders(cls, orders : Iterable[Order]) -> "OrderTable":
+        orders = list(orders)
+        table = cls(capacity=max(len(orders), 1))
+        for column in ORDER_COLUMNS:
+            table._columns[column][:len(orders)] = [getattr(order, column) for order in orders]
+        table._rows_qty = len(orders)
+        return table
+
+    @classmethod
+    def from_columns(cls, **columns) -> "OrderTable":
+        """
+        The from_columns function builds the table from one array (or list) per column of ORDER_COLUMNS, all of the same length.
+        """
+        rows_qty = len(columns["market_id"])
+        table = cls(capacity=max(rows_qty, 1))
+        for column in ORDER_COLUMNS:
+            table._columns[column][:rows_qty] = columns[column]
+        table._rows_qty = rows_qty
+        return table
+
+    def _reserve(self, rows_qty : int):
+        capacity = len(self._columns["market_id"])
+        if self._rows_qty + rows_qty <= capacity:
+            return
+        while capacity < self._rows_qty + rows_qty:
+            capacity *= 2
+        for column, dtype in ORDER_COLUMNS.items():
+            values = np.empty(capacity, dtype=dtype)
+            values[:self._rows_qty] = self._columns[column][:self._rows_qty]
+            self._columns[column] = values
+
+    def append(self, market_id : str, runner_id : int, price : float, size_remaining : float, size_matched : float, side : str,
+               bet_id : str = None):
+        self._reserve(1)
+        row = self._rows_qty
+        for column, value in zip(ORDER_COLUMNS, (market_id, runner_id, price, size_remaining, size_matched, side, bet_id)):
+            self._columns[column][row] = value
+        self._rows_qty += 1
+        self._indexes = {}
+
+    def extend(self, **columns):
+        """
+        The extend function appends one array (or list) per column of ORDER_COLUMNS, all of the same length.
+        """
+        rows_qty = len(columns["market_id"])
+        self._reserve(rows_qty)
+        for column in ORDER_COLUMNS:
+            self._columns[column][self._rows_qty:self._rows_qty + rows_qty] = columns[column]
+        self._rows_qty += rows_qty
+        self._indexes = {}
+
+    def column(self, column : str) -> np.ndarray:
+        return self._columns[column][:self._rows_qty]
+
+    def __getattr__(self, column : str) -> np.ndarray:
+        if column in ORDER_COLUMNS:
+            return self.column(column)
+        raise AttributeError(column)
+
+    def __len__(self):
+        return self._rows_qty
+
+    def __getitem__(self, row : int) -> OrderView:
+        if row < 0:
+            row += self._rows_qty
+        if not 0 <= row < self._rows_qty:
+            raise IndexError(row)
+        return OrderView(self, row)
+
+    def __iter__(self) -> Iterator[OrderView]:
+        return (OrderView(self, row) for row in range(self._rows_qty))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        The to_dataframe function returns the orders as a DataFrame with the columns of ORDER_COLUMNS.
+        The columns are views of the arrays of the table, not copies, so the DataFrame must not be modified in place.
+        """
+        return pd.DataFrame({column: self.column(column) for column in ORDER_COLUMNS}, copy=False)
+
+    def _get_index(self, column : str) -> Dict:
+        if column not in self._indexes:
+            values = self.column(column)
+            if values.dtype == object:
+                values = values.astype(str)
+            unique_values, inverse = np.unique(values, return_inverse=True)
+            rows = np.argsort(inverse.reshape(-1), kind="stable")
+            bounds = np.cumsum(np.bincount(inverse.reshape(-1), minlength=len(unique_values)))[:-1]
+            self._indexes[column] = {value.item(): group for value, group in zip(unique_values, np.split(rows, bounds))}
+        return self._indexes[column]
+
+    def get_rows(self, market_id : str = None, runner_id : int = None, side : str = None) -> np.ndarray:
+        """
+        The get_rows function returns the sorted row numbers of the orders matching all the given fields.
+
+        :param market_id:str: Keep only the orders of this market
+        :param runner_id:int: Keep only the orders of this runner
+        :param side:str: Keep only the orders of this side
+        :return: The row numbers, usable with __getitem__ or to index the columns
+        """
+        rows = np.arange(self._rows_qty)
+        for column, value in (("market_id", market_id), ("runner_id", runner_id), ("side", side)):
+            if value is not None:
+                rows = np.intersect1d(rows, self._get_index(column).get(value, np.empty(0, dtype=np.int64)), assume_unique=True)
+        return rows
+
+    def select(self, market_id : str = None, runner_id : int = None, side : str = None) -> "OrderTable":
+        """
+        The select function returns a new OrderTable with the orders matching all the given fields (see get_rows).
+        """
+        rows = self.get_rows(market_id=market_id, runner_id=runner_id, side=side)
+        return OrderTable.from_columns(**{column: self.column(column)[rows] for column in ORDER_COLUMNS})
+
+    def select_markets(self, market_ids : Iterable[str]) -> "OrderTable":
+        """
+        The select_markets function returns a new OrderTable with the orders of any of market_ids, e.g. the markets of one shard.
+        """
+        mask = np.isin(self.column("market_id").astype(str), list(market_ids))
+        return OrderTable.from_columns(**{column: self.column(column)[mask] for column in ORDER_COLUMNS})
+
+    @property
+    def market_ids(self) -> List[str]:
+        return list(self._get_index("market_id").keys())
+
+
+def _price_key(price : float) -> float:
+    return round(float(price), 2)
+
+
+def reconcile_orders(target_orders : Iterable[Order], open_orders : Iterable[Order], min_stake : float = MIN_STAKE
+                     ) -> Tuple[List[Order], List[Order], List[Order]]:
+    """
+    The reconcile_orders function computes the minimal instructions that turn the open orders into the target orders,
+    for each (market_id, runner_id, side):
+    - the open orders at a target price are kept, up to the target size. An excess is cancelled, with a size reduction
+      when only part of an order is in excess, so that the rest of the order keeps its queue position
+    - the open orders at a price that is not targeted are replaced to a targeted price that still needs at least their size,
+      largest orders first, or cancelled otherwise
+    - the size still needed at each target price is placed
+    Places and size reductions below min_stake are dropped, as the exchange would reject them.
+
+    :param target_orders:Iterable[Order]: The orders wanted (price and size_remaining), e.g. the output of Cashout.vector_solution_to_orders
+    :param open_orders:Iterable[Order]: The open orders, with their bet_id
+    :param min_stake:float: The minimum stake accepted by the exchange
+    :return: (orders_to_cancel, orders_to_replace, orders_to_place), as expected by Exchange.execute. A partial cancel has
+    a size_reduction attribute, and a replace has the new price
+    """
+    targets, opens = {}, {}
+    for order in target_orders:
+        key = (order.market_id, order.runner_id, order.side.upper())
+        needs = targets.setdefault(key, {})
+        needs[_price_key(order.price)] = needs.get(_price_key(order.price), 0) + order.size_remaining
+    for order in open_orders:
+        if order.size_remaining > 0:
+            opens.setdefault((order.market_id, order.runner_id, order.side.upper()), []).append(order)
+
+    orders_to_cancel, orders_to_replace, orders_to_place = [], [], []
+    for key in list(targets) + [key for key in opens if key not in targets]:
+        market_id, runner_id, side = key
+        needs = dict(targets.get(key, {}))
+        misplaced = []
+        for order in opens.get(key, []):
+            price = _price_key(order.price)
+            if price not in needs:
+                misplaced.append(order)
+                continue
+            kept = min(order.size_remaining, needs[price])
+            needs[price] -= kept
+            excess = round(order.size_remaining - kept, 2)
+            if kept <= 0:
+                orders_to_cancel.append(order)
+            elif excess >= min_stake:
+                orders_to_cancel.append(Order(market_id, runner_id, order.price, order.size_remaining, order.size_matched, order.side,
+                                              order.bet_id, size_reduction=excess))
+
+        for order in sorted(misplaced, key=lambda x: -x.size_remaining):
+            price = max(needs, key=needs.get) if needs else None
+            if price is not None and needs[price] >= order.size_remaining:
+                needs[price] -= order.size_remaining
+                orders_to_replace.append(Order(market_id, runner_id, price, order.size_remaining, order.size_matched, order.side, order.bet_id))
+            else:
+                orders_to_cancel.append(order)
+
+        for price, size in needs.items():
+            size = round(size, 2)
+            if size >= min_stake:
+                orders_to_place.append(Order(market_id=market_id, runner_id=runner_id, price=price, size_remaining=size, side=side))
+
+    return orders_to_cancel, orders_to_replace, orders_to_place
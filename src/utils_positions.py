@@ -0,0 +1,180 @@
+import numpy as np
+from typing import List, Dict, Iterable, Tuple
+from src.utils import Order
+from src.utils_orders import OrderTable
+
+
+class PositionLedger:
+    """
+    Matched positions of the account stored as NumPy arrays, with one row per (market_id, selection_id):
+    - back_stake: sum of the size matched of the BACK orders
+    - back_profit: sum of (price - 1) * size matched of the BACK orders, won if the selection wins
+    - lay_stake: sum of the size matched of the LAY orders, won if the selection loses
+    - lay_liability: sum of (price - 1) * size matched of the LAY orders, lost if the selection wins
+
+    If selection i of a market wins, the pnl is back_profit_i - lay_liability_i + sum over the other selections j of (lay_stake_j - back_stake_j),
+    so the pnl of every outcome of every market comes out of a single product with the (rows, markets) membership matrix of the rows.
+    """
+    def __init__(self, capacity : int = 64):
+        self.market_ids : List[str] = []
+        self._market_index : Dict[str, int] = {}
+        self._row_index : Dict[Tuple[str, int], int] = {}
+        self._rows_qty = 0
+        self._row_market = np.zeros(capacity, dtype=np.int64)
+        self._row_selection = np.zeros(capacity, dtype=np.int64)
+        self._amounts = np.zeros((4, capacity), dtype=np.float64)  # back_stake, back_profit, lay_stake, lay_liability
+        self._pnl = None
+        self._market_net = None
+
+    @classmethod
+    def from_orders(cls, orders : Iterable[Order]) -> "PositionLedger":
+        """
+        The from_orders function builds the ledger in one pass over the orders, aggregating the matched amounts with np.bincount.
+
+        :param orders:Iterable[Order]: The current orders, as returned by get_current_orders
+        :return: The PositionLedger
+        """
+        if isinstance(orders, OrderTable):
+            matched = orders.size_matched > 0
+            return cls.from_arrays(orders.market_id[matched], orders.runner_id[matched],
+                                   np.char.upper(orders.side[matched].astype(str)) == "LAY", orders.price[matched], orders.size_matched[matched])
+        market_ids, selection_ids, is_lay, prices, sizes = [], [], [], [], []
+        for order in orders:
+            if order.size_matched > 0:
+                market_ids.append(order.market_id)
+                selection_ids.append(order.runner_id)
+                is_lay.append(order.side.upper() == "LAY")
+                prices.append(order.price)
+                sizes.append(order.size_matched)
+        return cls.from_arrays(market_ids, selection_ids, is_lay, prices, sizes)
+
+    @classmethod
+    def from_arrays(cls, market_ids, selection_ids, is_lay, prices, sizes) -> "PositionLedger":
+        """
+        The from_arrays function builds the ledger from column arrays of matched fills.
+
+        :param market_ids: Market id of each fill
+        :param selection_ids: Selection id of each fill
+        :param is_lay: True for LAY fills, False for BACK fills
+        :param prices: Price of each fill
+        :param sizes: Size matched of each fill
+        :return: The PositionLedger
+        """
+        market_ids = np.asarray(market_ids, dtype=object)
+        selection_ids = np.asarray(selection_ids, dtype=np.int64)
+        is_lay = np.asarray(is_lay, dtype=bool)
+        prices = np.asarray(prices, dtype=np.float64)
+        sizes = np.asarray(sizes, dtype=np.float64)
+
+        unique_markets, market_inverse = np.unique(market_ids.astype(str), return_inverse=True)
+        keys = np.stack((market_inverse.reshape(-1), selection_ids), axis=1) if len(sizes) else np.empty((0, 2), dtype=np.int64)
+        unique_keys, row_inverse = np.unique(keys, axis=0, return_inverse=True)
+        row_inverse = row_inverse.reshape(-1)
+        rows_qty = len(unique_keys)
+
+        ledger = cls(capacity=max(rows_qty, 1))
+        ledger.market_ids = [str(market_id) for market_id in unique_markets]
+        ledger._market_index = {market_id: idx for idx, market_id in enumerate(ledger.market_ids)}
+        ledger._rows_qty = rows_qty
+        ledger._row_market[:rows_qty] = unique_keys[:, 0]
+        ledger._row_selection[:rows_qty] = unique_keys[:, 1]
+        ledger._row_index = {(ledger.market_ids[market], int(selection)): row for row, (market, selection) in enumerate(unique_keys)}
+
+        profits = (prices - 1) * sizes
+        ledger._amounts[0, :rows_qty] = np.bincount(row_inverse, weights=np.where(is_lay, 0, sizes), minlength=rows_qty)
+        ledger._amounts[1, :rows_qty] = np.bincount(row_inverse, weights=np.where(is_lay, 0, profits), minlength=rows_qty)
+        ledger._amounts[2, :rows_qty] = np.bincount(row_inverse, weights=np.where(is_lay, sizes, 0), minlength=rows_qty)
+        ledger._amounts[3, :rows_qty] = np.bincount(row_inverse, weights=np.where(is_lay, profits, 0), minlength=rows_qty)
+        return ledger
+
+    def _get_row(self, market_id : str, selection_id : int) -> int:
+        row = self._row_index.get((market_id, selection_id))
+        if row is not None:
+            return row
+        if market_id not in self._market_index:
+            self._market_index[market_id] = len(self.market_ids)
+            self.market_ids.append(market_id)
+        if self._rows_qty == self._amounts.shape[1]:
+            capacity = 2 * self._amounts.shape[1]
+            self._row_market = np.resize(self._row_market, capacity)
+            self._row_selection = np.resize(self._row_selection, capacity)
+            self._amounts = np.concatenate((self._amounts, np.zeros_like(self._amounts)), axis=1)
+        row = self._rows_qty
+        self._row_market[row] = self._market_index[market_id]
+        self._row_selection[row] = selection_id
+        self._amounts[:, row] = 0
+        self._row_index[(market_id, selection_id)] = row
+        self._rows_qty += 1
+        return row
+
+    def add_fill(self, market_id : str, selection_id : int, side : str, price : float, size : float):
+        """
+        The add_fill function updates the ledger incrementally with a new matched fill.
+        A negative size removes a fill, e.g. when a matched order is voided.
+        """
+        row = self._get_row(market_id, selection_id)
+        offset = 2 if side.upper() == "LAY" else 0
+        self._amounts[offset, row] += size
+        self._amounts[offset + 1, row] += (price - 1) * size
+        self._pnl = None
+
+    @property
+    def back_stake(self) -> np.ndarray:
+        return self._amounts[0, :self._rows_qty]
+
+    @property
+    def back_profit(self) -> np.ndarray:
+        return self._amounts[1, :self._rows_qty]
+
+    @property
+    def lay_stake(self) -> np.ndarray:
+        return self._amounts[2, :self._rows_qty]
+
+    @property
+    def lay_liability(self) -> np.ndarray:
+        return self._amounts[3, :self._rows_qty]
+
+    def __len__(self):
+        return self._rows_qty
+
+    def get_pnl_rows(self) -> np.ndarray:
+        """
+        The get_pnl_rows function returns, for each (market_id, selection_id) row, the pnl of the market if that selection wins.
+        The net lay - back stakes of each market are summed and broadcast back to its rows with the membership matrix E:
+        pnl = back_profit - lay_liability - net + E @ (E.T @ net), where E.T @ net is computed with np.bincount.
+        """
+        if self._pnl is None:
+            markets = self._row_market[:self._rows_qty]
+            net = self.lay_stake - self.back_stake
+            market_net = np.bincount(markets, weights=net, minlength=len(self.market_ids))
+            self._pnl = self.back_profit - self.lay_liability - net + market_net[markets]
+            self._market_net = market_net
+        return self._pnl
+
+    def get_pnl_outcomes(self, market_id : str, selection_ids : List[int]) -> Dict:
+        """
+        The get_pnl_outcomes function returns the same dictionary as utils.get_pnl_outcomes, without going through the orders.
+        Selections without position win the net lay - back stakes of the whole market.
+
+        :param market_id:str: The market id
+        :param selection_ids:List[int]: The selection ids to compute the pnl for
+        :return: A dictionary with the pnl of each selection and a complementary pnl if there is only one selection
+        """
+        pnl_rows = self.get_pnl_rows()
+        market = self._market_index.get(market_id)
+        market_net = self._market_net[market] if market is not None else 0.0
+        pnl_selections = {}
+        for selection_id in selection_ids:
+            row = self._row_index.get((market_id, selection_id))
+            pnl_selections[selection_id] = float(pnl_rows[row]) if row is not None else float(market_net)
+        if len(selection_ids) == 1:
+            row = self._row_index.get((market_id, selection_ids[0]))
+            pnl_selections["complementary"] = float(self.lay_stake[row] - self.back_stake[row]) if row is not None else 0.0
+        return pnl_selections
+
+    def get_position(self, market_id : str, selection_ids : List[int]) -> np.ndarray:
+        """
+        :return: The pnl of each outcome of the market, ordered as selection_ids
+        """
+        pnl_outcomes = self.get_pnl_outcomes(market_id, selection_ids)
+        return np.array([pnl_outcomes[selection_id] for selection_id in selection_ids])
@@ -0,0 +1,48 @@
+import bisect
+import hashlib
+from typing import Iterable, List, Dict
+
+VIRTUAL_NODES = 64
+
+
+def _hash(key : str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def shard_name(shard_index : int) -> str:
+    return f"shard-{shard_index}"
+
+
+class ConsistentHashRing:
+    """
+    Consistent hashing of market ids over nodes (worker processes or hosts): each node owns the arcs of the ring
+    that end at one of its virtual_nodes points, so adding or removing a node only moves about 1/len(nodes) of the markets.
+    The hash does not depend on the process (unlike hash()), so every worker computes the same assignment.
+    """
+    def __init__(self, nodes : Iterable[str], virtual_nodes : int = VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError("ConsistentHashRing needs at least one node")
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    @classmethod
+    def from_shards_qty(cls, shards_qty : int, virtual_nodes : int = VIRTUAL_NODES) -> "ConsistentHashRing":
+        return cls([shard_name(shard_index) for shard_index in range(shards_qty)], virtual_nodes=virtual_nodes)
+
+    def get_node(self, key : str) -> str:
+        position = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[position]
+
+    def owns(self, node : str, key : str) -> bool:
+        return self.get_node(key) == node
+
+    def split(self, keys : Iterable[str]) -> Dict[str, List[str]]:
+        """
+        The split function groups keys by the node owning them. Every node is in the result, possibly with no keys.
+        """
+        groups = {node: [] for node in self.nodes}
+        for key in keys:
+            groups[self.get_node(key)].append(key)
+        return groups
@@ -0,0 +1,158 @@
+import threading
+import time
+import traceback
+from types import MappingProxyType
+from typing import Callable, Union
+import pandas as pd
+from src.utils import split_matched_and_open
+from src.utils_positions import PositionLedger
+from src.website_utils import get_selection_stats, get_market_stats, MarketStatsCache
+
+REFRESH_INTERVAL = 60
+KEEP_ALIVE_INTERVAL = 15 * 60
+
+
+class DashboardSnapshot:
+    """
+    Result of one refresh of the dashboard data. A snapshot is published once and never modified afterwards:
+    sessions only read it, so its frames must not be modified in place either.
+    """
+    __slots__ = ("created_at", "refresh_seconds", "orders_df", "selection_stats", "market_stats", "account_stats", "market_stats_cache")
+
+    def __init__(self, orders_df : pd.DataFrame, selection_stats : pd.DataFrame, market_stats : pd.DataFrame, account_stats : dict,
+                 created_at : float, refresh_seconds : float, market_stats_cache : Union[dict, None] = None):
+        """
+        :param created_at:float: Time at which the refresh started pulling the data
+        :param refresh_seconds:float: Duration of the refresh
+        :param market_stats_cache:dict: Hit and miss counts of the MarketStatsCache at the end of the refresh
+        """
+        self.created_at = created_at
+        self.refresh_seconds = refresh_seconds
+        self.orders_df = orders_df
+        self.selection_stats = selection_stats
+        self.market_stats = market_stats
+        self.account_stats = MappingProxyType(account_stats)
+        self.market_stats_cache = MappingProxyType(market_stats_cache or {})
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+
+def get_account_stats(available_to_bet_balance : Union[float, None], selection_stats : pd.DataFrame, market_stats : pd.DataFrame) -> dict:
+    expected_pnl_before = market_stats.expected_pnl_before
+    expected_pnl_after = market_stats.expected_pnl_after
+    return {
+        "Available to bet" : round(available_to_bet_balance, 2) if available_to_bet_balance is not None else None,
+        "Total matched LAY" :  round(selection_stats.LAY_SIZE_MATCHED.sum(),2),
+        "Total BACK matched" : round(selection_stats.BACK_SIZE_MATCHED.sum(),2),
+        "Expected pnl before cashout" : round(expected_pnl_before.sum(),2),
+        "Expected pnl after cashout" : round(expected_pnl_after.sum(),2),
+        "Hit ratio (before cashout) %" : 100*round((expected_pnl_before > 0).mean(),3),
+        "Hit ratio (after cashout) %" : 100*round((expected_pnl_after > 0).mean(),3)
+    }
+
+
+def compute_snapshot(trading, market_stats_workers : Union[int, None] = None, market_stats_timeout : Union[float, None] = None,
+                     stats_cache : Union[MarketStatsCache, None] = None, shard : Union[Callable[[str], bool], None] = None,
+                     account_funds : bool = True) -> DashboardSnapshot:
+    """
+    The compute_snapshot function pulls the account funds and the current orders, and computes the selection, market and account stats of the dashboard.
+    With a stats_cache kept across refreshes, only the markets whose prices or position changed are solved again.
+
+    :param shard:Callable: Optional filter of the market ids to compute, e.g. the markets owned by one worker (see stats_worker)
+    :param account_funds:bool: If False, the account funds are not requested and the available to bet balance is None,
+    e.g. for the workers other than the one that fetches them for the whole account
+    """
+    start = time.time()
+    available_to_bet_balance = trading.trading.account.get_account_funds().available_to_bet_balance if account_funds else None
+
+    orders = trading.get_current_orders(incremental=True)
+    if shard is not None:
+        orders = orders.select_markets([market_id for market_id in orders.market_ids if shard(market_id)])
+    orders_df = orders.to_dataframe()
+    matched_orders, open_orders = split_matched_and_open(orders)
+    positions = PositionLedger.from_orders(orders)
+
+    selection_stats = get_selection_stats(orders_df)
+
+    market_ids_matched = list(selection_stats["market_id"].unique())
+
+    market_stats = get_market_stats(trading=trading, market_ids=market_ids_matched, matched_orders=matched_orders,
+                                    open_orders=open_orders, workers=market_stats_workers, market_timeout=market_stats_timeout,
+                                    positions=positions, stats_cache=stats_cache)
+    market_stats.index.name = "market_id"
+    market_stats.reset_index(inplace=True,drop=False)
+
+    account_stats = get_account_stats(available_to_bet_balance, selection_stats, market_stats)
+    return DashboardSnapshot(orders_df, selection_stats, market_stats, account_stats, created_at=start, refresh_seconds=time.time() - start,
+                             market_stats_cache=stats_cache.stats if stats_cache is not None else None)
+
+
+class StatsRefresher:
+    """
+    Process-wide background refresher: a daemon thread calls compute every `interval` seconds (or right away after force_refresh)
+    and publishes the result as the current snapshot, which every session reads without waiting.
+    If a refresh fails, the previous snapshot stays published and the error is kept in last_error.
+    """
+    def __init__(self, compute : Callable[[], DashboardSnapshot], interval : float = REFRESH_INTERVAL,
+                 keep_alive : Union[Callable[[], object], None] = None, keep_alive_interval : float = KEEP_ALIVE_INTERVAL):
+        """
+        :param compute:Callable: Builds a new snapshot, e.g. functools.partial(compute_snapshot, trading)
+        :param interval:float: Seconds between two refreshes
+        :param keep_alive:Callable: Called every keep_alive_interval seconds to keep the exchange session alive
+        """
+        self.compute = compute
+        self.interval = interval
+        self.keep_alive = keep_alive
+        self.keep_alive_interval = keep_alive_interval
+        self.last_error = None
+        self._snapshot = None
+        self._published = threading.Condition()
+        self._refresh_requested = threading.Event()
+        self._last_keep_alive = time.time()
+        self._thread = None
+
+    @property
+    def snapshot(self) -> Union[DashboardSnapshot, None]:
+        return self._snapshot
+
+    def start(self) -> "StatsRefresher":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="dashboard-refresher", daemon=True)
+            self._thread.start()
+        return self
+
+    def wait_for_snapshot(self, timeout : Union[float, None] = None, newer_than : float = 0) -> Union[DashboardSnapshot, None]:
+        """
+        The wait_for_snapshot function returns the current snapshot once there is one created after newer_than, or None after timeout
+        """
+        with self._published:
+            self._published.wait_for(lambda: self._snapshot is not None and self._snapshot.created_at > newer_than, timeout=timeout)
+            return self._snapshot if self._snapshot is not None and self._snapshot.created_at > newer_than else None
+
+    def force_refresh(self, timeout : Union[float, None] = None) -> Union[DashboardSnapshot, None]:
+        """
+        The force_refresh function starts a refresh now and waits up to timeout seconds for its snapshot
+        """
+        requested_at = time.time()
+        self._refresh_requested.set()
+        return self.wait_for_snapshot(timeout=timeout, newer_than=requested_at)
+
+    def _run(self):
+        while True:
+            self._refresh_requested.clear()
+            try:
+                if self.keep_alive is not None and time.time() - self._last_keep_alive > self.keep_alive_interval:
+                    self.keep_alive()
+                    self._last_keep_alive = time.time()
+                snapshot = self.compute()
+                with self._published:
+                    self._snapshot = snapshot
+                    self.last_error = None
+                    self._published.notify_all()
+            except Exception as e:
+                print(f"Dashboard refresh failed : {e}")
+                traceback.print_exc()
+                self.last_error = e
+            self._refresh_requested.wait(timeout=self.interval)
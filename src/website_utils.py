@@ -1,47 +1,167 @@
+import hashlib
+import math
+import multiprocessing
+import os
 import pandas as pd
+import signal
 import time
-from typing import List
-from src.utils_cashout import Cashout
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Tuple, Union
+from src.exchanges.exchange import BookNormalized, BACK_PRICES, LAY_PRICES
+from src.utils import get_pnl_outcomes
+from src.utils_cashout import Cashout, CashoutOutput
+from src.utils_positions import PositionLedger
 import numpy as np
 
-def get_market_stats(trading, market_ids: List[str], matched_orders, open_orders) -> pd.DataFrame:
+CASHOUT_MODE = "taker"
+CASHOUT_MAX_STD_ALLOWED = 1
+# Levels of the books used by the cashouts (None for the full ladders of the markets), and whether the stakes are capped by their sizes.
+# Without volume caps only the best level is used, see Cashout
+CASHOUT_BOOK_LEVELS = 1
+CASHOUT_CONSTRAIN_BY_VOLUME = False
+MARKET_STATS_CACHE_SIZE = 4096
+
+_process_pool = None
+_process_pool_workers = None
+_process_pool_pids = None  # SimpleQueue of the pids of the workers of _process_pool, filled by _register_worker
+
+
+class MarketStatsCache:
+    """
+    Cache of the CashoutOutput of each market between two calls of get_market_stats, keyed by a fingerprint of the prices of the
+    normalized book and of the pnl of each outcome of the position. get_market_stats only solves the markets whose fingerprint changed,
+    and also reuses the output when the position is unchanged and every price moved by at most price_tolerance (relative),
+    instead of a new solve. hits, tolerance_hits and misses count the outcomes of the lookups, to tune the tolerance.
+    The book sizes are only part of the fingerprint if the cashouts are constrained by volume (CASHOUT_CONSTRAIN_BY_VOLUME).
+    Missing levels (NaN prices) must be the same for a tolerance hit.
+    """
+    def __init__(self, price_tolerance : float = 0, maxsize : int = MARKET_STATS_CACHE_SIZE, with_sizes : bool = CASHOUT_CONSTRAIN_BY_VOLUME):
+        self.price_tolerance = price_tolerance
+        self.maxsize = maxsize
+        self.with_sizes = with_sizes
+        self.hits = 0
+        self.tolerance_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # market_id: (fingerprint, selection_ids, prices, position, cashout_output)
+
+    def _get_values(self, book : BookNormalized) -> np.ndarray:
+        return book.data if self.with_sizes else book.data[[BACK_PRICES, LAY_PRICES]]
+
+    @staticmethod
+    def fingerprint(prices : np.ndarray, position : np.ndarray, selection_ids : List[int]) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(prices).tobytes())
+        digest.update(np.ascontiguousarray(position, dtype=np.float64).tobytes())
+        digest.update(np.asarray(selection_ids, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def lookup(self, book : BookNormalized, position : np.ndarray) -> Tuple[bool, Union[CashoutOutput, None], str]:
+        """
+        The lookup function returns (found, cashout_output, fingerprint) for the market of book. cashout_output can be None
+        when the market was solved without a possible cashout, so found tells a hit from a miss.
+        """
+        prices = self._get_values(book)
+        fingerprint = self.fingerprint(prices, position, book.selection_ids)
+        entry = self._entries.get(book.market_id)
+        if entry is not None:
+            self._entries.move_to_end(book.market_id)
+            if entry[0] == fingerprint:
+                self.hits += 1
+                return True, entry[4], fingerprint
+            if self.price_tolerance > 0 and entry[1] == list(book.selection_ids) and entry[2].shape == prices.shape \
+                    and np.array_equal(entry[3], position) and np.array_equal(np.isnan(prices), np.isnan(entry[2])) \
+                    and self._get_max_change(prices, entry[2]) <= self.price_tolerance:
+                self.tolerance_hits += 1
+                return True, entry[4], fingerprint
+        self.misses += 1
+        return False, None, fingerprint
+
+    @staticmethod
+    def _get_max_change(values : np.ndarray, previous_values : np.ndarray) -> float:
+        """
+        The largest relative change between the values of two books with the same missing levels. A size that was 0 only matches 0
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            changes = np.abs(values - previous_values) / np.abs(previous_values)
+        changes = changes[~np.isnan(changes)]
+        return float(changes.max(initial=0))
+
+    def store(self, book : BookNormalized, position : np.ndarray, fingerprint : str, cashout_output : Union[CashoutOutput, None]):
+        self._entries[book.market_id] = (fingerprint, list(book.selection_ids), self._get_values(book),
+                                         np.array(position, dtype=np.float64), cashout_output)
+        self._entries.move_to_end(book.market_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "tolerance_hits": self.tolerance_hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_market_stats(trading, market_ids: List[str], matched_orders, open_orders, workers: int = None,
+                     market_timeout: float = None, positions: PositionLedger = None, stats_cache: MarketStatsCache = None) -> pd.DataFrame:
+    """
+    The get_market_stats function computes the expected pnl before and after cashout of each market.
+
+    :param workers:int: Number of worker processes used to solve the cashouts. If None or 1, the markets are solved in this process with Cashout.solve_many
+    :param market_timeout:float: Only used with workers. Seconds allowed per market solve: the table waits at most
+    market_timeout for each round of `workers` markets from the submission, and the markets not solved by then get a row of None
+    :param positions:PositionLedger: Optional ledger of the matched positions, used instead of matched_orders to get the pnl of each outcome
+    :param stats_cache:MarketStatsCache: Optional cache of the previous cashouts: only the markets whose book prices or position changed are solved
+    :return: A dataframe with one row per market_id
+    """
     markets = trading.get_markets(event_type_ids=None,
                                   market_type_codes=['MATCH_ODDS', 'BOTH_TEAMS_TO_SCORE', 'OVER_UNDER_25'],
                                   min_volume=0,
                                   market_ids=market_ids
                                   )
+    normalized_books = [trading.normalize_book(market, orderbook_levels=CASHOUT_BOOK_LEVELS) for market in markets]
+
+    cashout_outputs = {}
+    dirty_books = normalized_books
+    if stats_cache is not None:
+        dirty_books, fingerprints = [], {}
+        for book in normalized_books:
+            position = _get_market_position(book, matched_orders.get(book.market_id, {}), positions)[0]
+            found, cashout_output, fingerprint = stats_cache.lookup(book, position)
+            if found:
+                cashout_outputs[book.market_id] = cashout_output
+            else:
+                dirty_books.append(book)
+                fingerprints[book.market_id] = (position, fingerprint)
+
+    if dirty_books and (workers is None or workers <= 1):
+        cashout_outputs.update(Cashout.solve_many(
+            books=dirty_books,
+            matched_orders=matched_orders,
+            open_orders=open_orders,
+            mode=CASHOUT_MODE,
+            constrain_by_volume=CASHOUT_CONSTRAIN_BY_VOLUME,
+            max_std_allowed=CASHOUT_MAX_STD_ALLOWED,
+            engine="numpy",
+            positions=positions,
+        ))
+    elif dirty_books:
+        cashout_outputs.update(_get_cashout_outputs_parallel(dirty_books, matched_orders, workers=workers, market_timeout=market_timeout,
+                                                             positions=positions))
+
+    if stats_cache is not None:
+        for book in dirty_books:
+            # A market that timed out or failed is not cached, so that it is solved again next time
+            if book.market_id in cashout_outputs:
+                position, fingerprint = fingerprints[book.market_id]
+                stats_cache.store(book, position, fingerprint, cashout_outputs[book.market_id])
+
     stats = {}
     for market in markets:
         print(f"Market id: {market.market_id}")
-        market_stats = {}
-        normalized_book = trading.normalize_book(market, orderbook_levels=1)
-        matched_orders_market = matched_orders.get(market.market_id, {})
-        open_orders_market = open_orders.get(market.market_id, {})
-        cashout = Cashout(
-            market_book=normalized_book,
-            matched_orders=matched_orders_market,
-            open_orders=open_orders_market,
-            mode="taker",
-            constrain_by_volume=False,
-            max_std_allowed=1
-        )
-
-        hours_to_start = round((market.start_time - time.time()) / 3600,2)
-        cashout_output = cashout._get_neutralizer_orders_retry(max_std_allowed=1)
-
-        if cashout_output is not None:
-            expected_pnl_before = round(cashout_output.expected_pnl_before,2)
-            expected_pnl_after = round(cashout_output.expected_pnl_after,2)
-            worst_outcome_before = round(cashout_output.worst_outcome_before, 2)
-        else:
-            expected_pnl_before = None
-            expected_pnl_after = None
-            worst_outcome_before = None
-
-        market_stats["expected_pnl_before"] = expected_pnl_before
-        market_stats["expected_pnl_after"] = expected_pnl_after
-        market_stats["worst_outcome_before"] = worst_outcome_before
-        market_stats["hours_to_start"] = hours_to_start
+        market_stats = get_cashout_stats(cashout_outputs.get(market.market_id))
+        market_stats["hours_to_start"] = round((market.start_time - time.time()) / 3600,2)
         stats[market.market_id] = market_stats
 
     market_stats = pd.DataFrame.from_records(stats).T
@@ -49,18 +169,142 @@ def get_market_stats(trading, market_ids: List[str], matched_orders, open_orders
     return market_stats
 
 
+def get_cashout_stats(cashout_output: Union[CashoutOutput, None]) -> Dict[str, Union[float, None]]:
+    if cashout_output is not None:
+        expected_pnl_before = round(cashout_output.expected_pnl_before,2)
+        expected_pnl_after = round(cashout_output.expected_pnl_after,2)
+        worst_outcome_before = round(cashout_output.worst_outcome_before, 2)
+    else:
+        expected_pnl_before = None
+        expected_pnl_after = None
+        worst_outcome_before = None
+    return {"expected_pnl_before": expected_pnl_before, "expected_pnl_after": expected_pnl_after, "worst_outcome_before": worst_outcome_before}
+
+
+def _get_market_position(book: BookNormalized, matched_orders_market: Dict, positions: PositionLedger = None) -> Tuple[np.ndarray, Union[float, None]]:
+    """
+    The pnl of each outcome of the market, ordered as the selections of the book, and the complementary pnl of a single selection market
+    """
+    selection_ids = list(book.selection_ids)
+    if positions is not None:
+        pnl_outcomes = positions.get_pnl_outcomes(book.market_id, selection_ids)
+    else:
+        pnl_outcomes = get_pnl_outcomes(Cashout.fill_missing_selections(matched_orders_market, selection_ids), selection_ids)
+    position = np.array([pnl_outcomes[selection_id] for selection_id in selection_ids], dtype=float)
+    return position, pnl_outcomes.get("complementary")
+
+
+def _get_market_payload(book: BookNormalized, matched_orders_market: Dict, positions: PositionLedger = None) -> Tuple:
+    """
+    Compact, picklable inputs of the cashout of a market: the book arrays and the pnl of each outcome
+    """
+    position, complementary = _get_market_position(book, matched_orders_market, positions)
+    return book.market_id, list(book.selection_ids), book.data, position, complementary
+
+
+def _solve_market_payload(payload: Tuple) -> Union[CashoutOutput, None]:
+    market_id, selection_ids, book_arrays, position, complementary = payload
+    book = BookNormalized.from_array(market_id=market_id, data=book_arrays, selection_ids=selection_ids)
+    pnl_outcomes = dict(zip(selection_ids, position.tolist()))
+    if complementary is not None:
+        pnl_outcomes["complementary"] = complementary
+    cashout = Cashout(market_book=book, matched_orders={}, open_orders={}, mode=CASHOUT_MODE, constrain_by_volume=CASHOUT_CONSTRAIN_BY_VOLUME,
+                      max_std_allowed=CASHOUT_MAX_STD_ALLOWED, engine="numpy", pnl_outcomes=pnl_outcomes)
+    return cashout._get_neutralizer_orders_min_risk(max_std_allowed=CASHOUT_MAX_STD_ALLOWED)
+
+
+def _register_worker(pids: multiprocessing.SimpleQueue):
+    pids.put(os.getpid())
+
+
+def _get_process_pool(workers: int) -> ProcessPoolExecutor:
+    global _process_pool, _process_pool_workers, _process_pool_pids
+    if _process_pool is None or _process_pool_workers != workers:
+        _discard_process_pool()
+        _process_pool_pids = multiprocessing.SimpleQueue()
+        _process_pool = ProcessPoolExecutor(max_workers=workers, initializer=_register_worker, initargs=(_process_pool_pids,))
+        _process_pool_workers = workers
+    return _process_pool
+
+
+def _discard_process_pool(terminate: bool = False):
+    """
+    Shuts the process pool down without waiting for it. With terminate, its worker processes are also killed,
+    since shutdown does not stop a solve that is already running. The workers are found by the pids they registered on start,
+    and the pool reaps them once they exit
+    """
+    global _process_pool, _process_pool_workers, _process_pool_pids
+    if _process_pool is not None:
+        pids = []
+        while terminate and not _process_pool_pids.empty():
+            pids.append(_process_pool_pids.get())
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    _process_pool, _process_pool_workers, _process_pool_pids = None, None, None
+
+
+def _get_cashout_outputs_parallel(books: List[BookNormalized], matched_orders: Dict, workers: int, market_timeout: float = None,
+                                  positions: PositionLedger = None) -> Dict[str, Union[CashoutOutput, None]]:
+    """
+    Solves the cashout of each market in a process pool and returns the CashoutOutput of each market_id, in the order of books.
+    Markets that time out or fail are left out. All the markets share one deadline, market_timeout per round of `workers` markets,
+    so that stuck markets do not add up their timeouts.
+    The pool is kept across calls, and its processes are killed if a market times out so that a stuck solve does not hold a worker
+    of the next refresh. A pool broken by a worker that died is discarded too, and the next call starts a new one.
+    """
+    payloads = [_get_market_payload(book, matched_orders.get(book.market_id, {}), positions) for book in books]
+    try:
+        futures = [_get_process_pool(workers).submit(_solve_market_payload, payload) for payload in payloads]
+    except BrokenProcessPool:
+        # A worker of the cached pool died since the last call
+        _discard_process_pool(terminate=True)
+        futures = [_get_process_pool(workers).submit(_solve_market_payload, payload) for payload in payloads]
+    timeout = market_timeout * math.ceil(len(books) / workers) if market_timeout is not None else None
+    _, not_done = wait(futures, timeout=timeout)
+    cashout_outputs = {}
+    broken = False
+    for book, future in zip(books, futures):
+        if future in not_done:
+            print(f"Market id: {book.market_id} - cashout timed out after {timeout}s")
+            continue
+        try:
+            cashout_outputs[book.market_id] = future.result()
+        except BrokenProcessPool as e:
+            broken = True
+            print(f"Market id: {book.market_id} - cashout failed, process pool broken : {e}")
+        except Exception as e:
+            print(f"Market id: {book.market_id} - cashout failed : {e}")
+    if not_done or broken:
+        _discard_process_pool(terminate=True)
+    return cashout_outputs
+
+
 def get_selection_stats(orders_df) -> pd.DataFrame:
+    """
+    The get_selection_stats function computes the size matched and the average matched price of each (market_id, selection_id) and side.
+    The size-weighted price sums and the sizes are aggregated together in one groupby pass, and the average price is their ratio.
+
+    :param orders_df:pd.DataFrame: The current orders, with the columns market_id, runner_id, price, size_matched and side
+    :return: A flat dataframe with the columns BACK_AVG_PRICE, LAY_AVG_PRICE, BACK_SIZE_MATCHED, LAY_SIZE_MATCHED, market_id and selection_id
+    """
     matched_orders_df = orders_df[orders_df["size_matched"] != 0]
-    size_matched = matched_orders_df.groupby(["market_id", "runner_id", "side"])["size_matched"].sum().rename("size_matched").to_frame()
-    size_matched = size_matched.reset_index(level = 2)
-    size_matched = size_matched.pivot_table(index = size_matched.index, columns = "side", values = "size_matched")
-    size_matched.columns = size_matched.columns + "_SIZE_MATCHED"
-
-    avg_matched_price = matched_orders_df.groupby(["market_id", "runner_id", "side"]).apply(lambda g: np.average(g['price'], weights=g['size_matched']))
-    avg_matched_price = avg_matched_price.rename("avg_price").to_frame()
-    avg_matched_price = avg_matched_price.reset_index(level = 2)
-    avg_matched_price = avg_matched_price.pivot_table(index = avg_matched_price.index, columns = "side", values = "avg_price")
-    avg_matched_price.columns = avg_matched_price.columns + "_AVG_PRICE"
-    matches_df = pd.concat([avg_matched_price, size_matched], axis = 1)
-
-    return matches_df
+    sums = pd.DataFrame({
+        "market_id": matched_orders_df["market_id"].to_numpy(),
+        "selection_id": matched_orders_df["runner_id"].to_numpy(),
+        "side": matched_orders_df["side"].to_numpy(),
+        "weighted_price": matched_orders_df["price"].to_numpy() * matched_orders_df["size_matched"].to_numpy(),
+        "size_matched": matched_orders_df["size_matched"].to_numpy(),
+    }).groupby(["market_id", "selection_id", "side"], sort=True).sum()
+    sums = sums.unstack("side").reindex(columns=pd.MultiIndex.from_product([["weighted_price", "size_matched"], ["BACK", "LAY"]]))
+
+    size_matched = sums["size_matched"]
+    avg_matched_price = sums["weighted_price"] / size_matched
+    matches_df = pd.concat([avg_matched_price.add_suffix("_AVG_PRICE"), size_matched.add_suffix("_SIZE_MATCHED")], axis = 1)
+    matches_df.columns.name = None
+    matches_df.reset_index(inplace = True)
+
+    return matches_df[[column for column in matches_df.columns if column not in ("market_id", "selection_id")] + ["market_id", "selection_id"]]
@@ -0,0 +1,100 @@
+"""
+Parity of the async adapter (exchanges.betfair_async.AsyncBetfair) with the sync one (exchanges.betfair.Betfair).
+
+The mock_server fixture serves the seeded synthetic markets and orders of benchmarks.synthetic through MockBetfairServer,
+on an event loop of its own thread, and the sync adapter is the fake exchange serving the same data. The prices of the fake
+exchange move on every call, so its books are taken once and served frozen by both.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import asyncio
+import threading
+import numpy as np
+import pytest
+from benchmarks.synthetic import make_fake_exchange
+from src.exchanges.betfair import Betfair
+from src.exchanges.betfair_async import AsyncBetfair
+from src.exchanges.mock_server import MockBetfairServer
+from src.utils_orders import ORDER_COLUMNS
+
+SEED = 0
+MARKETS_QTY = 40
+ORDERS_QTY = 2500  # More than two pages of listCurrentOrders
+LEVELS = 3
+LATENCY = 0.05
+ACCOUNT_FUNDS = {"availableToBetBalance": 1234.5, "exposure": -67.8}
+
+
+@pytest.fixture(scope="module")
+def sync_trading():
+    trading = make_fake_exchange(MARKETS_QTY, ORDERS_QTY, levels=LEVELS, seed=SEED)
+    betting = trading.trading.betting
+    price_projection, _ = Betfair.get_price_projection(LEVELS)
+    books = betting.list_market_book(list(betting.catalogue), price_projection=price_projection)
+    betting.list_market_book = lambda market_ids, price_projection=None, lightweight=True: [book for book in books if book["marketId"] in market_ids]
+    trading.frozen_books = books
+    return trading
+
+
+@pytest.fixture(scope="module")
+def mock_server(sync_trading):
+    betting = sync_trading.trading.betting
+    server = MockBetfairServer(market_catalogue=list(betting.catalogue.values()), market_books=sync_trading.frozen_books,
+                               current_orders=betting.orders, account_funds=ACCOUNT_FUNDS, latency=LATENCY)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result(timeout=10)
+    yield server
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result(timeout=10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=10)
+    loop.close()
+
+
+async def fetch_all(server : MockBetfairServer, market_ids : list) -> tuple:
+    async with AsyncBetfair(**server.urls, session_token="token", app_key="key") as trading:
+        trading.book_depth = LEVELS
+        return await asyncio.gather(trading.get_account_funds(), trading.get_current_orders(),
+                                    trading.get_markets(None, None, 0, market_ids=market_ids))
+
+
+@pytest.fixture(scope="module")
+def async_results(mock_server, sync_trading):
+    market_ids = list(sync_trading.trading.betting.catalogue)
+    return asyncio.run(fetch_all(mock_server, market_ids))
+
+
+def test_calls_overlap(mock_server, async_results):
+    assert mock_server.max_concurrency > 1
+    assert mock_server.requests["listCurrentOrders"] == -(-ORDERS_QTY // 1000)
+    assert mock_server.requests["getAccountFunds"] == 1
+
+
+def test_account_funds(async_results):
+    account_funds, _, _ = async_results
+    assert account_funds == ACCOUNT_FUNDS
+
+
+def test_current_orders_match_sync(async_results, sync_trading):
+    _, async_orders, _ = async_results
+    sync_orders = sync_trading.get_current_orders()
+    assert len(async_orders) == len(sync_orders) == ORDERS_QTY
+    for column in ORDER_COLUMNS:
+        np.testing.assert_array_equal(async_orders.column(column), sync_orders.column(column), err_msg=column)
+
+
+def test_markets_match_sync(async_results, sync_trading):
+    _, _, async_markets = async_results
+    market_ids = list(sync_trading.trading.betting.catalogue)
+    sync_markets = sync_trading.get_markets(None, None, 0, market_ids=market_ids)
+    assert len(async_markets) > 0
+    assert [market.market_id for market in async_markets] == [market.market_id for market in sync_markets]
+    for async_market, sync_market in zip(async_markets, sync_markets):
+        assert async_market.start_time == sync_market.start_time
+        assert async_market.volume_matched == sync_market.volume_matched
+        async_book = Betfair.normalize_book(async_market, orderbook_levels=LEVELS)
+        sync_book = Betfair.normalize_book(sync_market, orderbook_levels=LEVELS)
+        assert async_book.selection_ids == sync_book.selection_ids
+        np.testing.assert_array_equal(async_book.data, sync_book.data)
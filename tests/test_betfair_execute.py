@@ -0,0 +1,135 @@
+"""
+Betfair.execute: one InstructionReport per order, cancels first, then replaces, then places, each in the given order,
+whatever the number of markets, of requests per market and of failed requests.
+
+The betting endpoint is a stand-in answering each instruction with a report whose betId tells the instruction it answers.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import threading
+from types import SimpleNamespace
+import pytest
+from src.exchanges.betfair import Betfair, CANCEL_INSTRUCTIONS_MAX
+from src.utils import Order
+
+FAILING_MARKET_ID = "1.999"
+
+
+class EchoBettingEndpoint:
+    """
+    Answers each instruction with a SUCCESS report: cancels echo their betId, the placed bets of replaces and places get
+    "<market_id>:<selection_id>:<price>:<size>" as betId. Requests on FAILING_MARKET_ID raise, and truncate_market_id answers without reports
+    """
+    def __init__(self, truncate_market_id : str = None):
+        self.truncate_market_id = truncate_market_id
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _respond(self, market_id : str, action : str, instruction_reports : list) -> dict:
+        with self._lock:
+            self.requests.append((market_id, action, len(instruction_reports)))
+        if market_id == FAILING_MARKET_ID:
+            raise Exception("connection reset")
+        if market_id == self.truncate_market_id:
+            return {"status": "FAILURE", "errorCode": "TOO_MUCH_DATA", "instructionReports": instruction_reports[:1]}
+        return {"status": "SUCCESS", "instructionReports": instruction_reports}
+
+    def cancel_orders(self, market_id, instructions, lightweight=True):
+        return self._respond(market_id, "CANCEL", [{"status": "SUCCESS", "instruction": instruction, "sizeCancelled": 1.0}
+                                                   for instruction in instructions])
+
+    def replace_orders(self, market_id, instructions, lightweight=True):
+        return self._respond(market_id, "REPLACE", [
+            {"status": "SUCCESS", "cancelInstructionReport": {"status": "SUCCESS", "instruction": {"betId": instruction["betId"]}},
+             "placeInstructionReport": {"status": "SUCCESS", "betId": f"{market_id}:replaced:{instruction['betId']}:{instruction['newPrice']}",
+                                        "sizeMatched": 0.0}}
+            for instruction in instructions])
+
+    def place_orders(self, market_id, instructions, lightweight=True):
+        return self._respond(market_id, "PLACE", [
+            {"status": "SUCCESS", "betId": f"{market_id}:{instruction['selectionId']}:{instruction['limitOrder']['price']}:{instruction['limitOrder']['size']}",
+             "sizeMatched": 0.0}
+            for instruction in instructions])
+
+
+def make_trading(betting : EchoBettingEndpoint) -> Betfair:
+    trading = Betfair()
+    trading.trading = SimpleNamespace(betting=betting)
+    return trading
+
+
+def make_orders(market_ids : list, qty : int, prefix : str) -> list:
+    return [Order(market_id, 100 + i, 2.0 + i / 100, 5.0 + i, 0.0, "BACK" if i % 2 else "LAY", f"{prefix}-{market_id}-{i}")
+            for i in range(qty) for market_id in market_ids]
+
+
+def test_reports_follow_the_orders_across_markets():
+    market_ids = ["1.1", "1.2", "1.3"]
+    orders_to_cancel = make_orders(market_ids, 3, "cancel")
+    orders_to_replace = make_orders(market_ids[::-1], 2, "replace")
+    orders_to_place = make_orders(market_ids[1:], 4, "place")
+
+    reports = make_trading(EchoBettingEndpoint()).execute(orders_to_cancel, orders_to_replace, orders_to_place)
+
+    orders = orders_to_cancel + orders_to_replace + orders_to_place
+    assert len(reports) == len(orders)
+    assert [report.order for report in reports] == orders
+    assert [report.action for report in reports] == ["CANCEL"] * len(orders_to_cancel) + ["REPLACE"] * len(orders_to_replace) + \
+        ["PLACE"] * len(orders_to_place)
+    assert all(report.status == "SUCCESS" and report.market_id == report.order.market_id for report in reports)
+    for report in reports:
+        order = report.order
+        if report.action == "CANCEL":
+            assert report.bet_id == order.bet_id
+        elif report.action == "REPLACE":
+            assert report.bet_id == f"{order.market_id}:replaced:{order.bet_id}:{order.price}"
+        else:
+            assert report.bet_id == f"{order.market_id}:{order.runner_id}:{order.price}:{round(order.size_remaining, 1)}"
+
+
+def test_same_order_sent_twice_gets_two_reports():
+    order = Order("1.1", 101, 3.0, 10.0, 0.0, "BACK", None)
+    other = Order("1.2", 102, 4.0, 10.0, 0.0, "LAY", None)
+
+    reports = make_trading(EchoBettingEndpoint()).execute([], [], [order, other, order])
+
+    assert [report.order for report in reports] == [order, other, order]
+    assert [report.bet_id for report in reports] == ["1.1:101:3.0:10.0", "1.2:102:4.0:10.0", "1.1:101:3.0:10.0"]
+
+
+def test_instructions_split_into_requests():
+    orders_to_cancel = make_orders(["1.1"], CANCEL_INSTRUCTIONS_MAX + 5, "cancel")
+    betting = EchoBettingEndpoint()
+
+    reports = make_trading(betting).execute(orders_to_cancel, [], [])
+
+    assert betting.requests == [("1.1", "CANCEL", CANCEL_INSTRUCTIONS_MAX), ("1.1", "CANCEL", 5)]
+    assert [report.bet_id for report in reports] == [order.bet_id for order in orders_to_cancel]
+
+
+def test_failed_request_only_fails_its_orders():
+    orders_to_place = make_orders(["1.1", FAILING_MARKET_ID, "1.2"], 2, "place")
+
+    reports = make_trading(EchoBettingEndpoint()).execute([], [], orders_to_place)
+
+    assert [report.order for report in reports] == orders_to_place
+    for report in reports:
+        if report.market_id == FAILING_MARKET_ID:
+            assert (report.status, report.error_code) == ("ERROR", "connection reset")
+        else:
+            assert report.status == "SUCCESS"
+
+
+@pytest.mark.parametrize("markets_qty", [1, 2])
+def test_missing_instruction_reports_get_the_request_status(markets_qty):
+    market_ids = ["1.1", "1.2"][:markets_qty]
+    orders_to_place = make_orders(market_ids, 3, "place")
+
+    reports = make_trading(EchoBettingEndpoint(truncate_market_id="1.1")).execute([], [], orders_to_place)
+
+    assert [report.order for report in reports] == orders_to_place
+    truncated = [report for report in reports if report.market_id == "1.1"]
+    assert truncated[0].status == "SUCCESS"
+    assert [(report.status, report.error_code) for report in truncated[1:]] == [("FAILURE", "TOO_MUCH_DATA")] * 2
+    assert all(report.status == "SUCCESS" for report in reports if report.market_id != "1.1")
@@ -0,0 +1,90 @@
+"""
+Streaming mode of the Betfair adapter (see Betfair.start_streaming and Betfair.start_replay), on the recorded stream messages of tests/data:
+market_stream.jsonl has the images of two markets then deltas of both, order_stream.jsonl an order image then a match and a new order.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import json
+import os
+import numpy as np
+import pytest
+from src.exchanges.betfair import Betfair
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data")
+MARKET_FILE = os.path.join(DATA_PATH, "market_stream.jsonl")
+ORDER_FILE = os.path.join(DATA_PATH, "order_stream.jsonl")
+MARKET_IDS = ["1.100000001", "1.100000002"]
+NEW_MARKET_ID = "1.100000003"
+
+
+class SubscriptionStream:
+    """
+    Stand-in of a betfairlightweight market stream: each subscription registers a new stream in the listener, as BetfairStream does,
+    and then delivers the images of `images`
+    """
+    def __init__(self, listener, images : list):
+        self.listener = listener
+        self.images = images
+        self.subscriptions = []
+
+    def subscribe_to_markets(self, market_filter : dict, market_data_filter : dict, conflate_ms : int = None) -> int:
+        self.subscriptions.append(market_filter["marketIds"])
+        unique_id = len(self.subscriptions)
+        self.listener.register_stream(unique_id, "marketSubscription")
+        for image in self.images:
+            self.listener.on_data(json.dumps(dict(image, id=unique_id)))
+        return unique_id
+
+
+@pytest.fixture
+def trading():
+    trading = Betfair()
+    trading.start_replay(market_file=MARKET_FILE, order_file=ORDER_FILE)
+    return trading
+
+
+def test_replay_books(trading):
+    markets = trading.get_markets(None, None, 0, market_ids=MARKET_IDS)
+    assert [market.market_id for market in markets] == MARKET_IDS
+    assert [market.volume_matched for market in markets] == [1500.0, 300.0]
+    book = trading.normalize_book(markets[0], orderbook_levels=2)
+    assert book.selection_ids == [101, 102, 103]
+    # The delta of runner 101 moved its best back price and replaced its lay ladder
+    np.testing.assert_array_equal(book.back_prices, [[2.02, 3.5, 5.0], [2.0, np.nan, np.nan]])
+    np.testing.assert_array_equal(book.back_sizes, [[50.0, 40.0, 25.0], [120.0, 0, 0]])
+    np.testing.assert_array_equal(book.lay_prices, [[2.04, 3.6, 5.2], [2.06, np.nan, np.nan]])
+    book = trading.normalize_book(markets[1], orderbook_levels=1)
+    # A size of 0 removes the level
+    np.testing.assert_array_equal(book.back_prices, [[1.5, np.nan]])
+    np.testing.assert_array_equal(book.lay_prices, [[1.52, 2.96]])
+
+
+def test_replay_orders(trading):
+    orders = trading.get_current_orders().to_dataframe().sort_values("bet_id").reset_index(drop=True)
+    assert orders.bet_id.tolist() == ["300000000001", "300000000002"]
+    assert orders.runner_id.tolist() == [101, 103]
+    assert orders.side.tolist() == ["BACK", "LAY"]
+    assert orders.size_matched.tolist() == [10.0, 0.0]
+    assert orders.size_remaining.tolist() == [0.0, 8.0]
+
+
+def test_resubscribe_keeps_books(trading):
+    books_before = {book["marketId"]: book for book in trading.market_listener.snap(MARKET_IDS)}
+    new_image = {"op": "mcm", "clk": "4", "pt": 1792263603000, "mc": [
+        {"id": NEW_MARKET_ID, "img": True, "marketDefinition": books_before[MARKET_IDS[1]]["marketDefinition"] | {"runners": [
+            {"status": "ACTIVE", "sortPriority": 1, "id": 301}, {"status": "ACTIVE", "sortPriority": 2, "id": 302}]},
+         "rc": [{"id": 301, "batb": [[0, 1.8, 10.0]]}, {"id": 302, "batl": [[0, 2.3, 5.0]]}]}]}
+    stream = SubscriptionStream(trading.market_listener, [new_image])
+    trading._market_stream = stream
+    trading._streamed_market_ids = frozenset(MARKET_IDS)
+
+    books = trading.get_market_books([NEW_MARKET_ID])
+
+    assert [book["marketId"] for book in books] == [NEW_MARKET_ID]
+    assert stream.subscriptions == [sorted(MARKET_IDS + [NEW_MARKET_ID])]
+    # The images of the previous markets are not received yet, and their books are still served
+    books_after = {book["marketId"]: book for book in trading.market_listener.snap(MARKET_IDS)}
+    assert books_after.keys() == books_before.keys()
+    for market_id in MARKET_IDS:
+        assert books_after[market_id]["runners"] == books_before[market_id]["runners"]
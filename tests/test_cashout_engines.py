@@ -0,0 +1,236 @@
+"""
+Parity of the numpy cashout engine (equalise_outcomes) with the cvxpy engine, on seeded random books.
+
+Both engines solve the same problem, so every field of their CashoutOutput must agree: the expected pnls within PNL_TOLERANCE
+(the precision of the cvxpy solver) and the order sizes within SIZE_TOLERANCE (the 0.1 rounding of vector_solution_to_orders,
+which may round a size up with one engine and down with the other). The books the numpy engine does not support
+must fall back to cvxpy, and give the same output or the same failure.
+
+Without volume caps, Cashout keeps the best level of the books only (see pad_levels), so the deeper levels of the random books
+only reach the solvers in test_missing_deeper_levels (volume caps) and test_equalise_outcomes_deeper_levels (the engines called directly).
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import contextlib
+import io
+import numpy as np
+import pytest
+from src.exchanges.exchange import BookNormalized, BACK_PRICES, BACK_SIZES, LAY_PRICES, LAY_SIZES
+from src.utils import Order
+from src.utils_cashout import Cashout, NeutralizerProblem, NeutralizerProblemCache, equalise_outcomes
+
+SEED = 0
+BOOKS_QTY = 60
+SELECTIONS_RANGE = (2, 9)
+LEVELS_RANGE = (1, 3)
+MAX_STDS = (0.5, 1, 5, 20)
+MODES = ("taker", "maker")
+FALLBACK_KINDS = ("arbitrage", "crossed", "missing_best_price", None, None)
+PNL_TOLERANCE = 1e-4
+SIZE_TOLERANCE = 0.1 + 1e-9
+MARKET_ID = "1.100000000"
+
+
+def make_book(rng : np.random.Generator, selections_qty : int, levels_qty : int) -> BookNormalized:
+    """
+    A book around random fair odds, with a spread of 1% to 8% and prices moving away from it level after level
+    """
+    probs = rng.dirichlet(np.ones(selections_qty) * 2)
+    probs = np.maximum(probs, 0.01) / np.maximum(probs, 0.01).sum()
+    spreads = rng.uniform(0.01, 0.08, selections_qty)
+    steps = np.cumsum(rng.uniform(0.005, 0.03, (levels_qty, selections_qty)), axis=0)
+    steps -= steps[0]
+    data = np.zeros((4, levels_qty, selections_qty))
+    data[BACK_PRICES] = np.maximum(np.round(1 / probs * (1 - spreads - steps), 2), 1.01)
+    data[LAY_PRICES] = np.round(1 / probs * (1 + spreads + steps), 2)
+    data[BACK_SIZES] = np.round(rng.uniform(1, 200, (levels_qty, selections_qty)), 2)
+    data[LAY_SIZES] = np.round(rng.uniform(1, 200, (levels_qty, selections_qty)), 2)
+    return BookNormalized.from_array(market_id=MARKET_ID, data=data, selection_ids=list(range(100, 100 + selections_qty)))
+
+
+def make_matched_orders(rng : np.random.Generator, book : BookNormalized) -> dict:
+    """
+    Matched orders on about 70% of the selections, at prices within 20% of the best back price
+    """
+    matched_orders = {}
+    for selection_number, selection_id in enumerate(book.selection_ids):
+        if rng.random() < 0.3:
+            continue
+        matched_orders[selection_id] = {"BACK": [], "LAY": []}
+        for _ in range(rng.integers(1, 4)):
+            side = "BACK" if rng.random() < 0.5 else "LAY"
+            price = round(float(book.back_prices[0][selection_number] * rng.uniform(0.8, 1.2)), 2)
+            matched_orders[selection_id][side].append(Order(market_id=book.market_id, runner_id=selection_id, price=max(price, 1.01),
+                                                            size_matched=round(float(rng.uniform(2, 100)), 2), side=side))
+    return matched_orders
+
+
+def make_cases(seed : int = SEED, books_qty : int = BOOKS_QTY) -> list:
+    rng = np.random.default_rng(seed)
+    cases = []
+    for _ in range(books_qty):
+        book = make_book(rng, int(rng.integers(SELECTIONS_RANGE[0], SELECTIONS_RANGE[1] + 1)), int(rng.integers(LEVELS_RANGE[0], LEVELS_RANGE[1] + 1)))
+        cases.append((book, make_matched_orders(rng, book), float(rng.choice(MAX_STDS))))
+    return cases
+
+
+@pytest.fixture(scope="module")
+def cases() -> list:
+    return make_cases()
+
+
+def with_data(book : BookNormalized, data : np.ndarray) -> BookNormalized:
+    return BookNormalized.from_array(market_id=book.market_id, data=data, selection_ids=book.selection_ids)
+
+
+def solve(book : BookNormalized, matched_orders : dict, engine : str, mode : str, max_std_allowed : float, constrain_by_volume : bool = False):
+    """
+    The CashoutOutput of _get_neutralizer_orders with engine, or the exception it raised
+    """
+    cashout = Cashout(book, matched_orders, {}, mode, constrain_by_volume=constrain_by_volume, max_std_allowed=max_std_allowed,
+                      problem_cache=NeutralizerProblemCache(), engine=engine)
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            return cashout._get_neutralizer_orders(max_std_allowed=max_std_allowed)
+        except Exception as e:
+            return e
+
+
+def is_supported(book : BookNormalized, matched_orders : dict, max_std_allowed : float) -> bool:
+    cashout = Cashout(book, matched_orders, {}, "taker", constrain_by_volume=False, max_std_allowed=max_std_allowed)
+    _, supported = equalise_outcomes(pnl_current=cashout.get_pnl_selections_current()[None, :], back_prices=cashout.market_book.back_prices[None],
+                                     lay_prices=cashout.market_book.lay_prices[None], prob_selections=cashout.get_prob_selections()[None, :],
+                                     max_std_allowed=np.array([max_std_allowed], dtype=float))
+    return bool(supported[0])
+
+
+def assert_same_output(output, expected):
+    if isinstance(expected, Exception) or expected is None:
+        assert type(output) is type(expected)
+        return
+    assert not isinstance(output, Exception), output
+    for field in ("expected_pnl_before", "expected_pnl_after", "worst_outcome_before"):
+        assert getattr(output, field) == pytest.approx(getattr(expected, field), abs=PNL_TOLERANCE, rel=PNL_TOLERANCE), field
+    for field in ("worst_outcome_after", "max_std_used", "solves_qty"):
+        assert getattr(output, field) == getattr(expected, field), field
+
+    sizes = {(order.market_id, order.runner_id, order.side, order.price): order.size_remaining for order in output.orders}
+    expected_sizes = {(order.market_id, order.runner_id, order.side, order.price): order.size_remaining for order in expected.orders}
+    for key in sizes.keys() | expected_sizes.keys():
+        assert abs(sizes.get(key, 0) - expected_sizes.get(key, 0)) <= SIZE_TOLERANCE, key
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("case", range(BOOKS_QTY))
+def test_random_books(cases, case, mode):
+    book, matched_orders, max_std_allowed = cases[case]
+    assert is_supported(book, matched_orders, max_std_allowed)
+    assert_same_output(solve(book, matched_orders, "numpy", mode, max_std_allowed), solve(book, matched_orders, "cvxpy", mode, max_std_allowed))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_solve_many(cases, mode):
+    # One book in five is not supported by the numpy engine, so that the batch mixes both engines
+    books = [BookNormalized.from_array(market_id=f"1.{200000000 + i}", data=make_fallback_book(FALLBACK_KINDS[i % 5], book).data,
+                                       selection_ids=book.selection_ids)
+             for i, (book, _, _) in enumerate(cases)]
+    matched_orders = {book.market_id: orders for book, (_, orders, _) in zip(books, cases)}
+    with contextlib.redirect_stdout(io.StringIO()):
+        outputs = Cashout.solve_many(books, matched_orders, {}, mode=mode, constrain_by_volume=False, max_std_allowed=1, engine="numpy",
+                                     problem_cache=NeutralizerProblemCache())
+        expected = Cashout.solve_many(books, matched_orders, {}, mode=mode, constrain_by_volume=False, max_std_allowed=1, engine="cvxpy",
+                                      problem_cache=NeutralizerProblemCache())
+    for market_id in expected:
+        assert_same_output(outputs[market_id], expected[market_id])
+
+
+def make_fallback_book(kind : str, book : BookNormalized) -> BookNormalized:
+    data = book.data.copy()
+    if kind == "arbitrage":
+        # Backing every selection at these prices wins whatever the outcome
+        data[BACK_PRICES] *= 1.5
+        data[LAY_PRICES] *= 1.5
+    elif kind == "crossed":
+        data[BACK_PRICES, 0, 0] = data[LAY_PRICES, 0, 0] + 0.5
+    elif kind == "missing_best_price":
+        data[[BACK_PRICES, LAY_PRICES], :, 0] = np.nan
+        data[[BACK_SIZES, LAY_SIZES], :, 0] = 0
+    elif kind is not None:
+        raise ValueError(kind)
+    return with_data(book, data)
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("kind", FALLBACK_KINDS[:3])
+def test_unsupported_books(cases, kind, mode):
+    for book, matched_orders, max_std_allowed in cases[:10]:
+        book = make_fallback_book(kind, book)
+        assert not is_supported(book, matched_orders, max_std_allowed)
+        assert_same_output(solve(book, matched_orders, "numpy", mode, max_std_allowed), solve(book, matched_orders, "cvxpy", mode, max_std_allowed))
+
+
+def make_missing_deeper_levels_book(book : BookNormalized) -> BookNormalized:
+    """
+    The book with the levels below the best one missing on every other selection
+    """
+    data = book.data.copy()
+    data[[BACK_PRICES, LAY_PRICES], 1:, ::2] = np.nan
+    data[[BACK_SIZES, LAY_SIZES], 1:, ::2] = 0
+    return with_data(book, data)
+
+
+def assert_missing_deeper_levels(cashout : Cashout):
+    # The levels must reach the solvers: without volume caps Cashout keeps the best level only
+    assert cashout.market_book.levels_qty > 1
+    assert np.isnan(cashout.market_book.back_prices[1:]).any() and np.isnan(cashout.market_book.lay_prices[1:]).any()
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_missing_deeper_levels(cases, mode):
+    deep_cases = [case for case in cases if case[0].levels_qty > 1][:10]
+    assert deep_cases
+    for book, matched_orders, max_std_allowed in deep_cases:
+        book = make_missing_deeper_levels_book(book)
+        assert_missing_deeper_levels(Cashout(book, matched_orders, {}, mode, constrain_by_volume=True, max_std_allowed=max_std_allowed))
+        assert_same_output(solve(book, matched_orders, "numpy", mode, max_std_allowed, constrain_by_volume=True),
+                           solve(book, matched_orders, "cvxpy", mode, max_std_allowed, constrain_by_volume=True))
+
+
+def test_equalise_outcomes_deeper_levels(cases):
+    """
+    equalise_outcomes on all the levels of the books, with missing ones, against the cvxpy problem of the same levels without volume caps.
+    The stakes may differ between levels of the same price, so the expected pnl and the dispersion of the outcomes are compared
+    """
+    deep_cases = [case for case in cases if case[0].levels_qty > 1]
+    assert deep_cases
+    for book, matched_orders, max_std_allowed in deep_cases:
+        cashout = Cashout(make_missing_deeper_levels_book(book), matched_orders, {}, "taker", constrain_by_volume=True, max_std_allowed=max_std_allowed)
+        assert_missing_deeper_levels(cashout)
+        pnl_current, prob_selections, pnl_matrix = cashout.get_pnl_selections_current(), cashout.get_prob_selections(), cashout.get_pnl_matrix()
+        stakes, supported = equalise_outcomes(pnl_current=pnl_current[None, :], back_prices=cashout.market_book.back_prices[None],
+                                              lay_prices=cashout.market_book.lay_prices[None], prob_selections=prob_selections[None, :],
+                                              max_std_allowed=np.array([max_std_allowed], dtype=float))
+        assert supported[0]
+        problem = NeutralizerProblem(cashout.market_book.selections_qty, cashout.market_book.levels_qty, constrain_by_volume=False)
+        expected_stakes = problem.solve(market_id=book.market_id, pnl_matrix=pnl_matrix, pnl_current=pnl_current,
+                                        prob_selections=prob_selections, max_std_allowed=max_std_allowed)
+        mask = cashout.get_stakes_mask()
+        assert (stakes[0][~mask] == 0).all()
+        pnl_after, expected_pnl_after = pnl_matrix @ stakes[0] + pnl_current, pnl_matrix @ np.where(mask, expected_stakes, 0) + pnl_current
+        assert pnl_after @ prob_selections == pytest.approx(expected_pnl_after @ prob_selections, abs=PNL_TOLERANCE, rel=PNL_TOLERANCE)
+        assert np.linalg.norm(pnl_after - pnl_after.mean()) <= max_std_allowed * (1 + PNL_TOLERANCE)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_zero_max_std(cases, mode):
+    for book, matched_orders, _ in cases[:10]:
+        assert not is_supported(book, matched_orders, 0)
+        assert_same_output(solve(book, matched_orders, "numpy", mode, 0), solve(book, matched_orders, "cvxpy", mode, 0))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_constrain_by_volume(cases, mode):
+    for book, matched_orders, max_std_allowed in cases[:10]:
+        assert_same_output(solve(book, matched_orders, "numpy", mode, max_std_allowed, constrain_by_volume=True),
+                           solve(book, matched_orders, "cvxpy", mode, max_std_allowed, constrain_by_volume=True))
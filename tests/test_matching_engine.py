@@ -0,0 +1,125 @@
+"""
+MatchingEngine of the simulated exchange: price-time priority per runner, and the lapse of LAPSE orders when a market turns in play.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import pytest
+from src.exchanges.matching_engine import MatchingEngine, BACK, LAY
+
+MARKET_ID = "1.1"
+SELECTION_ID = 101
+
+
+@pytest.fixture
+def engine():
+    engine = MatchingEngine()
+    engine.add_market(MARKET_ID, [SELECTION_ID, 102])
+    return engine
+
+
+def place(engine : MatchingEngine, side : str, size : float, price : float, persistence_type : str = "LAPSE", account : bool = True):
+    order, error_code = engine.place(MARKET_ID, SELECTION_ID, side, size, price, persistence_type=persistence_type, account=account)
+    assert error_code is None
+    return order
+
+
+def ladder(engine : MatchingEngine, side : int) -> list:
+    return [(level["price"], level["size"]) for level in engine.markets[MARKET_ID].runners[SELECTION_ID].get_ladder(side, None)]
+
+
+def test_order_matches_the_best_prices_first(engine):
+    place(engine, "LAY", 10, 2.0, account=False)
+    place(engine, "LAY", 5, 2.04, account=False)
+    place(engine, "LAY", 5, 1.98, account=False)
+
+    order = place(engine, "BACK", 12, 2.0)
+
+    # A back matches the lays at its price or higher, highest first, at their prices
+    assert order.size_matched == 12
+    assert order.average_price_matched == round((5 * 2.04 + 7 * 2.0) / 12, 2)
+    assert order.size_remaining == 0
+    assert ladder(engine, LAY) == [(2.0, 3.0), (1.98, 5.0)]
+    assert engine.markets[MARKET_ID].total_matched == 12
+
+
+def test_orders_at_a_price_match_oldest_first(engine):
+    first = place(engine, "BACK", 5, 3.0, account=False)
+    second = place(engine, "BACK", 5, 3.0, account=False)
+
+    order = place(engine, "LAY", 7, 3.0)
+
+    assert (first.size_matched, second.size_matched) == (5, 2)
+    assert engine.get_order(MARKET_ID, first.bet_id) is None  # Filled liquidity leaves the market
+    assert engine.get_order(MARKET_ID, second.bet_id) is second
+    assert order.size_matched == 7
+    assert ladder(engine, BACK) == [(3.0, 3.0)]
+
+
+def test_unmatched_size_rests_at_its_price(engine):
+    place(engine, "LAY", 4, 2.5, account=False)
+
+    order = place(engine, "BACK", 10, 2.5)
+
+    assert (order.size_matched, order.size_remaining) == (4, 6)
+    assert ladder(engine, LAY) == []
+    assert ladder(engine, BACK) == [(2.5, 6.0)]
+    # The resting back is matched by a later lay at its price or lower
+    lay = place(engine, "LAY", 2, 2.4)
+    assert lay.size_matched == 0
+    lay = place(engine, "LAY", 2, 2.6)
+    assert (lay.size_matched, lay.average_price_matched) == (2, 2.5)
+    assert order.size_remaining == 4
+
+
+def test_partial_cancel_keeps_the_queue_position(engine):
+    first = place(engine, "BACK", 10, 3.0)
+    second = place(engine, "BACK", 10, 3.0)
+
+    assert engine.cancel(MARKET_ID, first.bet_id, size_reduction=6) == (6, None)
+    place(engine, "LAY", 5, 3.0, account=False)
+
+    assert (first.size_matched, first.size_cancelled, first.size_remaining) == (4, 6, 0)
+    assert (second.size_matched, second.size_remaining) == (1, 9)
+    assert engine.cancel(MARKET_ID, first.bet_id) == (0.0, "BET_TAKEN_OR_LAPSED")
+    assert ladder(engine, BACK) == [(3.0, 9.0)]
+
+
+def test_turn_in_play_lapses_the_unmatched_lapse_orders(engine):
+    liquidity = place(engine, "LAY", 3, 2.0, account=False)
+    partly_matched = place(engine, "BACK", 5, 2.0, persistence_type="LAPSE")
+    unmatched = place(engine, "BACK", 4, 1.9, persistence_type="LAPSE")
+    persisted = place(engine, "BACK", 6, 1.8, persistence_type="PERSIST")
+    liquidity_resting = place(engine, "LAY", 8, 1.5, account=False)
+
+    assert engine.turn_in_play(MARKET_ID) == 3
+
+    assert engine.markets[MARKET_ID].in_play
+    assert liquidity.size_matched == 3
+    assert (partly_matched.size_matched, partly_matched.size_lapsed, partly_matched.size_remaining) == (3, 2, 0)
+    assert (unmatched.size_lapsed, unmatched.size_remaining) == (4, 0)
+    assert (persisted.size_lapsed, persisted.size_remaining) == (0, 6)
+    assert liquidity_resting.size_lapsed == 8
+    assert engine.get_order(MARKET_ID, liquidity_resting.bet_id) is None
+    assert ladder(engine, BACK) == [(1.8, 6.0)]
+    assert ladder(engine, LAY) == []
+    # The orders lapsed without any match are not listed anymore, like on Betfair
+    assert [order.bet_id for order in engine.get_account_orders()] == [partly_matched.bet_id, persisted.bet_id]
+    assert engine.cancel(MARKET_ID, unmatched.bet_id) == (0.0, "BET_TAKEN_OR_LAPSED")
+    assert partly_matched.to_current_order()["status"] == "EXECUTION_COMPLETE"
+    assert persisted.to_current_order()["status"] == "EXECUTABLE"
+
+
+@pytest.mark.parametrize("market_id, selection_id, side, size, price, persistence_type, error_code", [
+    ("1.2", SELECTION_ID, "BACK", 5, 2.0, "LAPSE", "INVALID_MARKET_ID"),
+    (MARKET_ID, 999, "BACK", 5, 2.0, "LAPSE", "INVALID_RUNNER"),
+    (MARKET_ID, SELECTION_ID, "BUY", 5, 2.0, "LAPSE", "ERROR_IN_ORDER"),
+    (MARKET_ID, SELECTION_ID, "BACK", 5, 2.0, "MARKET_ON_CLOSE", "INVALID_PERSISTENCE_TYPE"),
+    (MARKET_ID, SELECTION_ID, "BACK", 0.5, 2.0, "LAPSE", "INVALID_BET_SIZE"),
+    (MARKET_ID, SELECTION_ID, "BACK", 5.001, 2.0, "LAPSE", "INVALID_BET_SIZE"),
+    (MARKET_ID, SELECTION_ID, "BACK", 5, 2.01, "LAPSE", "INVALID_ODDS"),
+])
+def test_rejected_instructions(engine, market_id, selection_id, side, size, price, persistence_type, error_code):
+    version = engine.version
+    assert engine.place(market_id, selection_id, side, size, price, persistence_type=persistence_type) == (None, error_code)
+    assert engine.version == version
@@ -0,0 +1,96 @@
+"""
+reconcile_orders: the instructions turning the open orders of a runner into the target orders.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+from src.utils import Order
+from src.utils_orders import reconcile_orders, OrderTable
+
+MARKET_ID = "1.1"
+
+
+def target(price : float, size : float, side : str = "BACK", runner_id : int = 101) -> Order:
+    return Order(MARKET_ID, runner_id, price, size, 0, side)
+
+
+def open_order(bet_id : str, price : float, size : float, side : str = "BACK", runner_id : int = 101) -> Order:
+    return Order(MARKET_ID, runner_id, price, size, 0, side, bet_id)
+
+
+def summary(orders : list) -> list:
+    return [(order.bet_id, order.price, order.size_remaining, getattr(order, "size_reduction", None)) for order in orders]
+
+
+def test_open_orders_matching_the_targets_are_kept():
+    assert reconcile_orders([target(2.0, 10), target(2.02, 5)], [open_order("a", 2.0, 10), open_order("b", 2.02, 5)]) == ([], [], [])
+
+
+def test_excess_is_cancelled_with_a_size_reduction():
+    orders_to_cancel, orders_to_replace, orders_to_place = reconcile_orders([target(2.0, 6)], [open_order("a", 2.0, 10)])
+    assert summary(orders_to_cancel) == [("a", 2.0, 10, 4)]
+    assert (orders_to_replace, orders_to_place) == ([], [])
+
+
+def test_excess_is_cancelled_from_the_orders_past_the_target():
+    # Once the first order fills the target, the next one is cancelled in full, otherwise it is reduced to what the target still needs
+    orders_to_cancel, _, _ = reconcile_orders([target(2.0, 12)], [open_order("a", 2.0, 12), open_order("b", 2.0, 3)])
+    assert summary(orders_to_cancel) == [("b", 2.0, 3, None)]
+    orders_to_cancel, _, _ = reconcile_orders([target(2.0, 12)], [open_order("a", 2.0, 8), open_order("b", 2.0, 7)])
+    assert summary(orders_to_cancel) == [("b", 2.0, 7, 3)]
+
+
+def test_excess_below_min_stake_is_left():
+    assert reconcile_orders([target(2.0, 9.5)], [open_order("a", 2.0, 10)]) == ([], [], [])
+    orders_to_cancel, _, _ = reconcile_orders([target(2.0, 9.5)], [open_order("a", 2.0, 10)], min_stake=0.5)
+    assert summary(orders_to_cancel) == [("a", 2.0, 10, 0.5)]
+
+
+def test_misplaced_order_is_replaced_when_a_target_needs_its_size():
+    orders_to_cancel, orders_to_replace, orders_to_place = reconcile_orders([target(2.1, 10)], [open_order("a", 2.0, 6)])
+    assert orders_to_cancel == []
+    assert summary(orders_to_replace) == [("a", 2.1, 6, None)]
+    assert summary(orders_to_place) == [(None, 2.1, 4, None)]
+
+
+def test_misplaced_order_is_cancelled_when_no_target_needs_its_size():
+    orders_to_cancel, orders_to_replace, orders_to_place = reconcile_orders([target(2.1, 4)], [open_order("a", 2.0, 6)])
+    assert summary(orders_to_cancel) == [("a", 2.0, 6, None)]
+    assert orders_to_replace == []
+    assert summary(orders_to_place) == [(None, 2.1, 4, None)]
+
+
+def test_largest_misplaced_orders_are_replaced_first():
+    orders_to_cancel, orders_to_replace, orders_to_place = reconcile_orders(
+        [target(2.1, 8)], [open_order("small", 2.0, 3), open_order("large", 1.9, 7)])
+    assert summary(orders_to_replace) == [("large", 2.1, 7, None)]
+    assert summary(orders_to_cancel) == [("small", 2.0, 3, None)]
+    assert summary(orders_to_place) == [(None, 2.1, 1, None)]
+
+
+def test_misplaced_order_goes_to_the_target_needing_the_most():
+    _, orders_to_replace, orders_to_place = reconcile_orders([target(2.1, 5), target(2.2, 9)], [open_order("a", 2.0, 4)])
+    assert summary(orders_to_replace) == [("a", 2.2, 4, None)]
+    assert sorted(summary(orders_to_place)) == [(None, 2.1, 5, None), (None, 2.2, 5, None)]
+
+
+def test_places_below_min_stake_are_dropped():
+    orders_to_cancel, orders_to_replace, orders_to_place = reconcile_orders([target(2.0, 10.5), target(3.0, 0.4)], [open_order("a", 2.0, 10)])
+    assert (orders_to_cancel, orders_to_replace, orders_to_place) == ([], [], [])
+    _, _, orders_to_place = reconcile_orders([target(2.0, 10.5), target(3.0, 0.4)], [open_order("a", 2.0, 10)], min_stake=0.1)
+    assert summary(orders_to_place) == [(None, 2.0, 0.5, None), (None, 3.0, 0.4, None)]
+
+
+def test_open_orders_without_target_are_cancelled():
+    orders_to_cancel, orders_to_replace, orders_to_place = reconcile_orders(
+        [target(2.0, 5, side="LAY")], [open_order("back", 2.0, 5), open_order("other runner", 2.0, 5, side="LAY", runner_id=102),
+                                       open_order("lay", 2.0, 5, side="lay")])
+    assert summary(orders_to_cancel) == [("back", 2.0, 5, None), ("other runner", 2.0, 5, None)]
+    assert (orders_to_replace, orders_to_place) == ([], [])
+
+
+def test_targets_are_summed_by_price_and_open_orders_read_from_a_table():
+    open_orders = OrderTable.from_orders([open_order("a", 2.0, 4), Order(MARKET_ID, 101, 2.0, 0, 5, "BACK", "matched")])
+    orders_to_cancel, orders_to_replace, orders_to_place = reconcile_orders([target(2.0, 3), target(2.0, 3)], open_orders)
+    assert (orders_to_cancel, orders_to_replace) == ([], [])
+    assert summary(orders_to_place) == [(None, 2.0, 2, None)]
@@ -0,0 +1,107 @@
+"""
+Round trip of the Arrow recordings of exchanges.recording: what ReplayExchange serves must be what RecordingExchange recorded,
+on the seeded synthetic markets and orders of benchmarks.synthetic.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import contextlib
+import glob
+import io
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from benchmarks.synthetic import make_fake_exchange
+from src.exchanges.recording import RecordingExchange, ReplayExchange, RECORD_SUFFIX
+from src.utils_orders import ORDER_COLUMNS
+from src.website_refresher import compute_snapshot
+
+SEED = 0
+MARKETS_QTY = 30
+ORDERS_QTY = 400
+LEVELS = 5
+CALLS_QTY = 3
+
+
+def assert_same_markets(replayed : list, recorded : list):
+    assert [market.market_id for market in replayed] == [market.market_id for market in recorded]
+    for replayed_market, recorded_market in zip(replayed, recorded):
+        assert replayed_market.start_time == recorded_market.start_time
+        assert replayed_market.volume_matched == recorded_market.volume_matched
+        replayed_book, recorded_book = replayed_market.normalize(None), recorded_market.normalize(None)
+        assert replayed_book.selection_ids == recorded_book.selection_ids
+        np.testing.assert_array_equal(replayed_book.data, recorded_book.data)
+
+
+def assert_same_orders(replayed, recorded):
+    assert len(replayed) == len(recorded)
+    for column in ORDER_COLUMNS:
+        np.testing.assert_array_equal(replayed.column(column), recorded.column(column), err_msg=column)
+
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    """
+    CALLS_QTY refreshes recorded from the fake exchange, whose prices move on every call, and the results of each call
+    """
+    path = str(tmp_path_factory.mktemp("recording"))
+    trading = make_fake_exchange(MARKETS_QTY, ORDERS_QTY, levels=LEVELS, seed=SEED)
+    market_ids = list(trading.trading.betting.catalogue)
+    recorder = RecordingExchange(trading, path=path)
+    calls = []
+    for _ in range(CALLS_QTY):
+        calls.append((recorder.get_markets(None, None, 0, market_ids=market_ids), recorder.get_current_orders(),
+                      recorder.trading.account.get_account_funds().available_to_bet_balance))
+    recorder.close()
+    return path, market_ids, calls
+
+
+def test_replay_serves_the_recorded_calls(recording):
+    path, market_ids, calls = recording
+    replay = ReplayExchange(path, speed=None)
+    for markets, orders, available_to_bet_balance in calls:
+        assert not replay.finished
+        assert_same_markets(replay.get_markets(None, None, 0, market_ids=market_ids), markets)
+        assert_same_orders(replay.get_current_orders(), orders)
+        assert replay.trading.account.get_account_funds().available_to_bet_balance == available_to_bet_balance
+    assert replay.finished
+    # Past the end of the recording, the last records are served again
+    assert_same_markets(replay.get_markets(None, None, 0, market_ids=market_ids), calls[-1][0])
+
+
+def test_replay_filters_the_markets(recording):
+    path, market_ids, calls = recording
+    replay = ReplayExchange(path, speed=None)
+    # Each call serves the next record
+    markets = calls[0][0]
+    assert_same_markets(replay.get_markets(None, None, 0, market_ids=market_ids[::3]), [market for market in markets if market.market_id in market_ids[::3]])
+    markets = calls[1][0]
+    min_volume = float(np.median([market.volume_matched for market in markets]))
+    assert_same_markets(replay.get_markets(None, None, min_volume), [market for market in markets if market.volume_matched > min_volume])
+
+
+def test_recording_cut_short_is_read_up_to_its_last_complete_call(recording, tmp_path):
+    path, market_ids, calls = recording
+    for file_path in glob.glob(os.path.join(path, f"*{RECORD_SUFFIX}")):
+        with open(file_path, "rb") as f:
+            data = f.read()
+        with open(os.path.join(tmp_path, os.path.basename(file_path)), "wb") as f:
+            f.write(data[:-100] if os.path.basename(file_path).startswith("markets") else data)
+    replay = ReplayExchange(str(tmp_path), speed=None)
+    assert len(replay.records["markets"]) == CALLS_QTY - 1
+    assert len(replay.records["orders"]) == CALLS_QTY
+
+
+def test_snapshot_of_the_replay(tmp_path):
+    trading = make_fake_exchange(MARKETS_QTY, ORDERS_QTY, levels=LEVELS, seed=SEED)
+    recorder = RecordingExchange(trading, path=str(tmp_path))
+    with contextlib.redirect_stdout(io.StringIO()):
+        recorded = compute_snapshot(recorder)
+        recorder.close()
+        replayed = compute_snapshot(ReplayExchange(str(tmp_path), speed=None))
+    assert replayed.account_stats == recorded.account_stats
+    assert replayed.orders_df.equals(recorded.orders_df)
+    assert replayed.market_stats.equals(recorded.market_stats)